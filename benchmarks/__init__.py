@@ -0,0 +1,5 @@
+"""Benchmarks for each, run with asv.
+
+``asv run --python=same --quick`` gives a quick reading against the current
+checkout, and ``scripts/compare-benchmarks.sh`` compares two revisions.
+"""
@@ -0,0 +1,63 @@
+"""Benchmarks for prefetching inputs from slow storage.
+
+Inputs are written and then evicted from the page cache before every
+sample, so each command reads its input cold. On a local SSD that costs
+little, so to see what prefetching buys, set ``EACH_BENCHMARK_SLOW_DIR`` to
+a directory on throttled storage, e.g. a loop device behind dm-delay::
+
+    truncate -s 1G /tmp/slow.img
+    losetup /dev/loop0 /tmp/slow.img
+    echo "0 $(blockdev --getsz /dev/loop0) delay /dev/loop0 0 20" | dmsetup create slow
+    mkfs.ext4 /dev/mapper/slow && mount /dev/mapper/slow /mnt/slow
+    EACH_BENCHMARK_SLOW_DIR=/mnt/slow asv run --bench Prefetch
+"""
+
+import os
+import shutil
+import tempfile
+
+from each import Each, work_items_from_path
+
+FILES = 16
+FILE_SIZE = 2 * 1024 * 1024
+
+
+def write_cold(path, size):
+    """Write 'size' bytes to 'path' and make sure none of them are left in
+    the page cache."""
+    with open(path, "wb") as o:
+        o.write(os.urandom(size))
+        o.flush()
+        os.fsync(o.fileno())
+        os.posix_fadvise(o.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+class Prefetch:
+    """Commands that compute for a while and read their whole input, so
+    there's time to prefetch the next inputs while they run."""
+
+    params = [0, 4, 16]
+    param_names = ["prefetch"]
+    number = 1
+    repeat = (3, 10, 120.0)
+    warmup_time = 0
+
+    def setup(self, prefetch):
+        self.tmpdir = tempfile.mkdtemp(dir=os.environ.get("EACH_BENCHMARK_SLOW_DIR"))
+        source = os.path.join(self.tmpdir, "source")
+        os.mkdir(source)
+        for i in range(FILES):
+            write_cold(os.path.join(source, str(i)), FILE_SIZE)
+        self.each = Each(
+            command="sleep 0.05; cat > /dev/null",
+            work_items=work_items_from_path(source),
+            destination=os.path.join(self.tmpdir, "output"),
+            processes=2,
+            prefetch=prefetch,
+        )
+
+    def teardown(self, prefetch):
+        shutil.rmtree(self.tmpdir)
+
+    def time_cold_inputs(self, prefetch):
+        self.each.clear_queue()
@@ -0,0 +1,116 @@
+"""Benchmarks for the hot paths of the ``Each`` scheduling loop."""
+
+import os
+import shutil
+import tempfile
+
+from each import Each
+from each.each import LineWorkItem, work_items_from_lines
+from each.prediction import predict_timing
+
+
+def line_items(n):
+    return [LineWorkItem("item-%d" % (i,), "line %d\n" % (i,)) for i in range(n)]
+
+
+def wait_for_exit_without_reaping(pids):
+    """Block until every pid has exited, leaving them for ``os.wait`` to reap."""
+    for pid in pids:
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+
+
+class TrivialCommands:
+    """Shared setup for spawning and reaping trivial commands.
+
+    Each sample forks ``processes`` children, so these run once per sample
+    with fresh state.
+    """
+
+    params = [1, 8, 32]
+    param_names = ["processes"]
+    number = 1
+    repeat = (5, 20, 30.0)
+    warmup_time = 0
+
+    def setup(self, processes):
+        self.tmpdir = tempfile.mkdtemp()
+        self.each = Each(
+            command="true",
+            work_items=line_items(processes),
+            destination=os.path.join(self.tmpdir, "output"),
+            processes=processes,
+        )
+
+    def teardown(self, processes):
+        self.each.clear_queue()
+        shutil.rmtree(self.tmpdir)
+
+
+class Spawning(TrivialCommands):
+    def time_fill_work_in_progress(self, processes):
+        self.each.fill_work_in_progress()
+
+
+class Reaping(TrivialCommands):
+    def setup(self, processes):
+        TrivialCommands.setup(self, processes)
+        self.each.fill_work_in_progress()
+        wait_for_exit_without_reaping(list(self.each.work_in_progress))
+
+    def time_collect_completed_work(self, processes):
+        self.each.collect_completed_work()
+
+
+RESUME_SIZES = [10**4, 10**5, 10**6]
+
+
+class ResumeScan:
+    """Startup cost when most of the destination already has results."""
+
+    params = RESUME_SIZES
+    param_names = ["existing"]
+    number = 1
+    repeat = (3, 10, 60.0)
+    timeout = 600
+
+    def setup_cache(self):
+        destination = os.path.abspath("resume-destination")
+        os.makedirs(destination)
+        for item in line_items(max(RESUME_SIZES)):
+            os.mkdir(os.path.join(destination, item.name))
+            with open(os.path.join(destination, item.name, "status"), "w") as o:
+                print(0, file=o)
+        return destination
+
+    setup_cache.timeout = 3600
+
+    def setup(self, destination, existing):
+        self.work_items = line_items(existing)
+
+    def time_resume_scan(self, destination, existing):
+        Each(command="true", work_items=self.work_items, destination=destination)
+
+
+class LineIngestion:
+    params = [10**3, 10**5]
+    param_names = ["lines"]
+
+    def setup(self, lines):
+        self.lines = ["line %d" % (i,) for i in range(lines)]
+
+    def time_work_items_from_lines(self, lines):
+        list(work_items_from_lines(self.lines))
+
+
+class Prediction:
+    params = ([1, 16], [10, 1000, 100000])
+    param_names = ["parallelism", "remaining"]
+    number = 1
+    timeout = 600
+
+    def setup(self, parallelism, remaining):
+        self.historical = [float(i % 17 + 1) for i in range(1000)]
+        self.current = [1.0] * parallelism
+
+    def time_predict_timing(self, parallelism, remaining):
+        predict_timing(self.historical, self.current, remaining, seed=0)
@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+
+# Compare benchmark results between two revisions, e.g.
+#
+#   scripts/compare-benchmarks.sh master HEAD
+#
+# Any extra arguments are passed through to asv, so e.g. adding
+# --bench=Spawning restricts the comparison to the spawn/reap benchmarks.
+
+set -e -u -x
+
+cd "$(dirname $0)"/..
+
+BASE="$1"
+CONTENDER="$2"
+shift 2
+
+asv machine --yes
+asv continuous --factor 1.1 --show-stderr "$@" "$BASE" "$CONTENDER"
@@ -4,5 +4,5 @@ set -e -u -x
 
 cd "$(dirname $0)"/..
 
-pipenv run black src tests setup.py
-pipenv run isort -rc src tests setup.py
+pipenv run black src tests benchmarks setup.py
+pipenv run isort -rc src tests benchmarks setup.py
@@ -1,13 +1,97 @@
-import multiprocessing as mp
-from datetime import datetime, timedelta
+import json
+import os
+import sys
+from datetime import timedelta
 
+import attr
 import click
-from tqdm import tqdm
 
 from each import SHELL, Each, work_items_from_path
+from each.affinity import PIN_MODES
+from each.each import (
+    METADATA_DIR,
+    ORDERS,
+    RANDOM,
+    RETRY_POLICIES,
+    RunAborted,
+    work_items_from_stream,
+)
+from each.junkdrawer import parse_size
+from each.progress import JSONL, PROGRESS_MODES, TTY, JsonlProgress, NullProgress, TqdmProgress
+from each.simulation import DISTRIBUTIONS, LOGNORMAL, POLICIES
+from each.tracing import NullTracer, Tracer
+
+
+class EachGroup(click.Group):
+    """The ``each`` command line.
+
+    ``each SOURCE COMMAND`` runs the command over each item in the source. If
+    the first argument names a subcommand instead, e.g. ``each cache stats``,
+    that subcommand is run.
+    """
+
+    def parse_args(self, ctx, args):
+        if not args or args[0] not in self.commands:
+            args = ["run"] + list(args)
+        return super().parse_args(ctx, args)
+
+
+class Size(click.ParamType):
+    name = "size"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        try:
+            return parse_size(value)
+        except ValueError:
+            self.fail("%r is not a size like 512K, 100M or 10G" % (value,), param, ctx)
+
+
+SIZE = Size()
 
 
-@click.command(
+def parse_retry_policies(ctx, param, value):
+    policies = {}
+    for policy in value:
+        status, _, name = policy.partition("=")
+        if not status.strip().isdigit() or name not in RETRY_POLICIES:
+            raise click.BadParameter(
+                "%r should look like STATUS=POLICY, where POLICY is one of %s"
+                % (policy, ", ".join(RETRY_POLICIES))
+            )
+        policies[int(status)] = name
+    return policies
+
+
+@click.group(cls=EachGroup)
+def main():
+    pass
+
+
+def describe_pilot(report):
+    lines = ["Pilot: %d of %d items failed." % (report.failures, report.items)]
+    if report.runtimes:
+        lines.append(
+            "Pilot runtimes: %s."
+            % ", ".join("p%d %.2fs" % (q, report.runtime_percentile(q)) for q in (10, 50, 90, 100))
+        )
+    if report.prediction is not None:
+        lines.append(
+            "Predicted time for the remaining %d items: %s."
+            % (
+                report.remaining,
+                ", ".join(
+                    "p%d %s" % (q, timedelta(seconds=round(report.prediction.percentile(q))))
+                    for q in (50, 99)
+                ),
+            )
+        )
+    return "\n".join(lines)
+
+
+@main.command(
+    "run",
     help="""
 each runs a command on each file in a source directory, writing its results to
 files in a destination directory.
@@ -25,7 +109,21 @@ done
 Unlike this loop it comes with a variety of ways to configure it,
 will run its body in parallel, and handles resuming from interruptions and
 such robustly.
-"""
+
+If the source is a file rather than a directory, the command is run on each
+line of it instead. If the source is -, lines are read from stdin and run as
+they arrive, so each can sit in the middle of a pipeline.
+
+Other subcommands are:
+
+\b
+each cache stats|prune  Inspect or shrink a --cache directory.
+each status DEST        Summarise how the items in a destination went.
+each failures DEST      List the items in a destination that failed.
+each simulate           Compare orders and predictions on a simulated run.
+each control DEST CMD   Change the number of processes of, pause, resume or
+                        drain a run that's in progress.
+""",
 )
 @click.argument("source")
 @click.argument("command")
@@ -69,7 +167,7 @@ process.""",
 @click.option(
     "--processes",
     "-j",
-    default=max(1, mp.cpu_count() - 1),
+    default=max(1, (os.cpu_count() or 1) - 1),
     help="""
 The number of child processes to run in parallel.""",
 )
@@ -84,41 +182,734 @@ By default will use stdin unless {} is present in the command.
         "\n", " "
     ),
 )
-def main(command, source, destination, recreate, processes, stdin, shell, retries):
+@click.option(
+    "--trace",
+    default="",
+    help="""
+Record a trace of what each was doing when to this file. The trace is in
+Chrome's trace event format, and can be viewed with chrome://tracing or
+https://ui.perfetto.dev.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--cache",
+    default="",
+    help="""
+A directory of results to share between runs. If an item with the same
+contents has been successfully run before with the same command, its results
+are reused from here instead of running the command again.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--cache-size",
+    type=SIZE,
+    default=None,
+    help="""
+The most space the --cache directory may take up, e.g. 10G. Least recently used
+results are evicted when it grows beyond this.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--incremental/--no-incremental",
+    default=False,
+    help="""
+Rerun items whose input or command has changed since they were last run,
+even if they succeeded. Files count as changed if their size or modification
+time has. Only results recorded by a previous --incremental run are known to
+be up to date.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--buffer-size",
+    default=1000,
+    help="""
+When reading lines from stdin, how many to read ahead of the ones being run.
+Once this many are waiting, each stops reading until it catches up.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--watch/--no-watch",
+    default=False,
+    help="""
+Keep running after processing the source directory, and process each new
+file that appears in it as soon as it has been written. Files whose names
+start with a dot are ignored, so that files written under a temporary name
+and then renamed into place are only processed once complete.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--retry-delay",
+    default=1.0,
+    help="""
+How many seconds to wait before retrying a failed item for the first time.
+The wait doubles with each further failure, with some random jitter, and
+other items are run in the meantime.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--max-retry-delay",
+    default=60.0,
+    help="The longest to ever wait before retrying a failed item, in seconds.",
+)
+@click.option(
+    "--retry-policy",
+    multiple=True,
+    callback=parse_retry_policies,
+    metavar="STATUS=POLICY",
+    help="""
+How to handle failures with a particular exit status: retry (immediately),
+backoff (after a delay, as set by --retry-delay) or never. Failures are retried
+with backoff unless set otherwise. May be given more than once.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--pilot",
+    default=0,
+    help="""
+Run this many randomly chosen items first, and report how many failed, how
+long they took, and how long the rest are predicted to take before running
+the rest. Combine with --max-failure-rate and --max-predicted-time to stop
+after the pilot if things look bad.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--max-failure-rate",
+    type=click.FloatRange(0, 1),
+    default=None,
+    help="""
+Stop if more than this fraction of items fail, e.g. 0.1. Checked after the
+pilot, and throughout the rest of the run once at least ten items have
+finished. In-progress items are allowed to finish.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--max-predicted-time",
+    type=float,
+    default=None,
+    help="""
+Stop after the pilot if the remaining items are predicted to take more than
+this many seconds.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--pin",
+    type=click.Choice(PIN_MODES),
+    default=None,
+    help="""
+Pin each of the --processes slots to a fixed set of CPUs: a single core each
+with cores, or all the cores of one NUMA node with numa. Slots are spread
+across NUMA nodes, and the CPUs each item ran on are recorded in its affinity
+file.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--progress",
+    type=click.Choice(PROGRESS_MODES),
+    default=None,
+    help="""
+How to report progress on stderr: a progress bar (tty), a JSON record of
+counts, rate and ETA every --progress-interval seconds (jsonl), or not at all
+(none). Defaults to tty if stderr is a terminal and jsonl otherwise.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--progress-interval",
+    default=10.0,
+    help="How many seconds apart --progress=jsonl records are.",
+)
+@click.option(
+    "--size-model/--no-size-model",
+    default=False,
+    help="""
+Predict how long items will take from their size (the size of a file, or
+the length of a line), rather than assuming every item is like any other.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--order",
+    type=click.Choice(ORDERS),
+    default=RANDOM,
+    help="""
+The order to run items in. random gives the most reliable predictions early
+on. largest-first avoids waiting on one big item at the end of the run, and
+is best combined with --size-model.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--speculate",
+    type=float,
+    default=None,
+    metavar="FACTOR",
+    help="""
+Once there is nothing left to start, run a second copy of any item that has
+been running for more than FACTOR times the p99 runtime so far, and keep
+whichever copy succeeds first. Only use this with commands that give the
+same result every time they're run.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--then",
+    multiple=True,
+    metavar="COMMAND",
+    help="""
+A further command to run on the out file of each item as soon as the command
+before it succeeds on that item, making a pipeline. May be given more than
+once. The results of the second command go to the destination with -2
+appended, of the third -3, and so on. As for the first command, the input is
+passed on stdin unless the command contains {}.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--stage-priorities",
+    default="",
+    metavar="P1,P2,...",
+    help="""
+The priorities of the commands in a --then pipeline, one for each command.
+When items are waiting to run more than one command, those waiting for the
+command with the highest priority are started first. By default later
+commands go first.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--reduce",
+    "reduce_command",
+    default="",
+    metavar="COMMAND",
+    help="""
+Keep a running aggregate of the out files of items that succeed, in
+.each/reduce/aggregate in the destination. The command is given the paths of
+the files to combine as its arguments, e.g. 'cat "$@" | sort -u', and writes
+their combination to stdout. It is run on batches of out files together with
+the aggregate so far, and on its own output, so must be associative.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--reduce-batch-size",
+    default=100,
+    help="How many out files --reduce combines into the aggregate at a time.",
+)
+@click.option(
+    "--scratch",
+    default=None,
+    metavar="DIR",
+    type=click.Path(exists=True, file_okay=False, writable=True),
+    help="""
+Give each running item a private scratch directory inside DIR, e.g. /dev/shm
+or a local SSD, passed to the command as $EACH_SCRATCH_DIR and $TMPDIR. It is
+deleted when the item finishes.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--keep-scratch",
+    multiple=True,
+    metavar="PATTERN",
+    help="""
+A glob pattern of files in the scratch directory to move into the item's
+results when it succeeds, e.g. '*.parquet'. May be given more than once.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--scratch-quota",
+    type=SIZE,
+    default=None,
+    help="""
+Kill any item using more than this much scratch space, e.g. 2G, and record
+its status as 250.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--max-output",
+    type=SIZE,
+    default=None,
+    help="""
+Kill any item that writes more than this much to its stdout, e.g. 1G, keep
+only that much of what it wrote, and record its status as 251.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--max-err",
+    type=SIZE,
+    default=None,
+    help="""
+The same as --max-output, for stderr.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--slot-dir",
+    default=None,
+    metavar="DIR",
+    help="""
+Where to keep a directory for each of the --processes slots, which is passed
+to the command as $EACH_SLOT_DIR along with the slot's number as $EACH_SLOT.
+Items that run in the same slot, in this run or later ones, share its
+directory, so it's a good place for a cache. Defaults to .each/slots in the
+destination.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--checkpoints/--no-checkpoints",
+    default=False,
+    help="""
+Give each item a directory, passed to the command as $EACH_CHECKPOINT_DIR,
+to save its progress in. It's kept when the item fails, so that retries, in
+this run or a later one, can carry on from the last checkpoint rather than
+start again, and deleted once the item succeeds.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--prefetch",
+    default=0,
+    metavar="N",
+    help="""
+Ask the OS to start reading the input files of the next N items in the queue
+while the current ones run, for when the source is on slow storage.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--prefetch-budget",
+    type=SIZE,
+    default="256M",
+    help="""
+The most input that --prefetch will have read ahead, counting each file until
+its item has finished, so that it doesn't push out of memory the inputs of
+items that are running.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--control/--no-control",
+    default=False,
+    help="""
+Whether to take commands from each control while running, and to add or
+remove a process on SIGUSR1 or SIGUSR2.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option(
+    "--detach/--no-detach",
+    default=False,
+    help="""
+Run each item detached from each, so that it carries on if each is killed or
+loses its terminal. Running each again on the same destination, also with
+--detach, waits for the items that are still running and collects their
+results instead of starting them again.
+""".replace(
+        "\n", " "
+    ),
+)
+def run(
+    command,
+    source,
+    destination,
+    recreate,
+    processes,
+    stdin,
+    shell,
+    retries,
+    trace,
+    cache,
+    cache_size,
+    incremental,
+    buffer_size,
+    watch,
+    retry_delay,
+    max_retry_delay,
+    retry_policy,
+    pilot,
+    max_failure_rate,
+    max_predicted_time,
+    pin,
+    progress,
+    progress_interval,
+    size_model,
+    order,
+    speculate,
+    then,
+    stage_priorities,
+    reduce_command,
+    reduce_batch_size,
+    scratch,
+    keep_scratch,
+    scratch_quota,
+    max_output,
+    max_err,
+    slot_dir,
+    checkpoints,
+    prefetch,
+    prefetch_budget,
+    control,
+    detach,
+):
+    streaming = source == "-" or watch
+
+    if streaming and pilot:
+        raise click.UsageError(
+            "--pilot needs all the items up front, so can't be used with - or --watch"
+        )
+    if streaming and order != RANDOM:
+        raise click.UsageError("Items from - or --watch are always run in the order they arrive")
+
+    if scratch is None and (keep_scratch or scratch_quota is not None):
+        raise click.UsageError("--keep-scratch and --scratch-quota need --scratch")
+
     if not destination:
+        if source == "-":
+            raise click.UsageError("--destination is required when reading from stdin")
         destination = source.rstrip("/") + "-results"
 
     if stdin is None:
         stdin = "{}" not in command
 
-    with tqdm() as pb:
+    if stage_priorities:
+        try:
+            stage_priorities = [int(p) for p in stage_priorities.split(",")]
+        except ValueError:
+            raise click.BadParameter(
+                "should be a list of integers", param_hint="--stage-priorities"
+            )
+        if len(stage_priorities) != len(then) + 1:
+            raise click.BadParameter(
+                "there are %d commands but %d priorities" % (len(then) + 1, len(stage_priorities)),
+                param_hint="--stage-priorities",
+            )
+    else:
+        stage_priorities = None
 
-        def new_prediction(p):
-            now = datetime.now()
-            eta = now + timedelta(seconds=p.percentile(99))
+    tracer = Tracer(trace) if trace else NullTracer()
 
-            if (eta - now <= timedelta(days=1)) and eta.day == now.day:
-                pb.set_postfix(eta=eta.strftime("%H:%M:%S"))
-            else:
-                pb.set_postfix(eta=eta.strftime("%Y-%m-%d %H:%M"))
+    if progress is None:
+        progress = TTY if sys.stderr.isatty() else JSONL
+    if progress == TTY:
+        reporter = TqdmProgress()
+    elif progress == JSONL:
+        reporter = JsonlProgress(interval=progress_interval)
+    else:
+        reporter = NullProgress()
 
+    if cache:
+        from each.cache import ResultCache
+
+        cache = ResultCache(cache, max_size=cache_size)
+    else:
+        cache = None
+    if reduce_command:
+        from each.reduce import CommandReducer
+
+        reducer = CommandReducer(reduce_command, shell)
+    else:
+        reducer = None
+
+    if watch:
+        from each.watch import work_items_from_watched_directory
+
+        work_items = work_items_from_watched_directory(source)
+    elif streaming:
+        work_items = work_items_from_stream(sys.stdin)
+    else:
         work_items = work_items_from_path(source)
-        each = Each(
-            work_items=work_items,
-            shell=shell,
-            destination=destination,
-            command=command,
-            progress_callback=pb.update,
-            prediction_callback=new_prediction,
-            recreate=recreate,
-            processes=processes,
-            stdin=stdin,
+    each = Each(
+        work_items=work_items,
+        shell=shell,
+        destination=destination,
+        command=command,
+        progress_callback=reporter.update,
+        prediction_callback=reporter.new_prediction,
+        warning_callback=reporter.write,
+        recreate=recreate,
+        processes=processes,
+        stdin=stdin,
+        retries=retries,
+        tracer=tracer,
+        cache=cache,
+        incremental=incremental,
+        streaming=streaming,
+        buffer_size=buffer_size,
+        retry_delay=retry_delay,
+        max_retry_delay=max_retry_delay,
+        retry_policies=retry_policy,
+        pilot=pilot,
+        max_failure_rate=max_failure_rate,
+        max_predicted_time=max_predicted_time,
+        pilot_callback=lambda report: reporter.write(describe_pilot(report)),
+        pin=pin,
+        size_model=size_model,
+        order=order,
+        speculate=speculate,
+        then=list(then),
+        stage_priorities=stage_priorities,
+        reducer=reducer,
+        reduce_batch_size=reduce_batch_size,
+        scratch=scratch,
+        keep_scratch=list(keep_scratch),
+        scratch_quota=scratch_quota,
+        max_output=max_output,
+        max_err=max_err,
+        slot_dir=slot_dir,
+        checkpoints=checkpoints,
+        prefetch=prefetch,
+        prefetch_budget=prefetch_budget,
+        control=control,
+        detach=detach,
+    )
+
+    try:
+        with reporter.running(each):
+            each.clear_queue()
+            if each.draining:
+                reporter.write("Drained. Run each again to run the remaining items.")
+    except RunAborted as e:
+        raise click.ClickException(str(e))
+    finally:
+        tracer.close()
+
+
+@main.group("cache", help="Inspect and manage a result cache directory.")
+def cache_group():
+    pass
+
+
+@cache_group.command("stats", help="Show how many results the cache holds and their size.")
+@click.argument("path")
+def cache_stats(path):
+    from each.cache import ResultCache
+
+    stats = ResultCache(path).stats()
+    click.echo("entries: %d" % (stats.entries,))
+    click.echo("size: %d" % (stats.size,))
+
+
+@cache_group.command("prune", help="Evict least recently used results from the cache.")
+@click.argument("path")
+@click.option("--max-size", type=SIZE, required=True, help="How large the cache may be, e.g. 10G.")
+def cache_prune(path, max_size):
+    from each.cache import ResultCache
+
+    evicted = ResultCache(path).prune(max_size)
+    click.echo("evicted: %d" % (evicted,))
+
+
+@main.command("status", help="Summarise how the items in a destination went.")
+@click.argument("destination", type=click.Path(exists=True, file_okay=False))
+def status(destination):
+    from each.query import summarise
+
+    summary = summarise(destination)
+    click.echo("items: %d" % (summary.items,))
+    click.echo("succeeded: %d" % (summary.succeeded,))
+    click.echo("failed: %d" % (len(summary.failed),))
+    click.echo("unfinished: %d" % (summary.unfinished,))
+    for code in sorted(code for code in summary.statuses if code is not None):
+        click.echo("status %d: %d" % (code, summary.statuses[code]))
+    if summary.runtimes:
+        click.echo(
+            "runtimes: %s"
+            % ", ".join("p%d %.2fs" % (q, summary.runtime_percentile(q)) for q in (50, 90, 99, 100))
+        )
+
+
+@main.command("failures", help="List the items in a destination that failed, one per line.")
+@click.argument("destination", type=click.Path(exists=True, file_okay=False))
+def list_failures(destination):
+    from each.query import failures
+
+    for name in failures(destination):
+        click.echo(name)
+
+
+@main.command(
+    "simulate",
+    help="""
+Simulate how a run would be scheduled under each of several orders, without
+running anything, and report how long it would take, how busy the slots
+would be, and how far out the predictions of how long was left would be.
+Runtimes come from the results in --results, or are made up.
+""",
+)
+@click.option(
+    "--results",
+    default=None,
+    metavar="DEST",
+    type=click.Path(exists=True, file_okay=False),
+    help="A destination whose recorded runtimes to simulate. Items that failed there always fail.",
+)
+@click.option(
+    "--source",
+    default=None,
+    help="The source of --results, to get items' sizes from for --order=largest-first.",
+)
+@click.option("--items", default=1000, help="How many made up items to simulate.")
+@click.option(
+    "--distribution",
+    type=click.Choice(DISTRIBUTIONS),
+    default=LOGNORMAL,
+    help="How the runtimes of made up items vary, beyond what their size predicts.",
+)
+@click.option(
+    "--failure-rate",
+    default=0.0,
+    help="The fraction of made up items that fail once before succeeding.",
+)
+@click.option("--processes", "-j", default=max(1, (os.cpu_count() or 1) - 1))
+@click.option(
+    "--order",
+    "orders",
+    type=click.Choice(POLICIES),
+    multiple=True,
+    help="""
+An order to simulate. May be given more than once, and defaults to all of
+them. longest-first runs items in order of their actual runtime, which each
+can't know in advance, so is a lower bound for the others.
+""".replace(
+        "\n", " "
+    ),
+)
+@click.option("--retries", default=0)
+@click.option("--size-model/--no-size-model", default=False)
+@click.option(
+    "--prediction-interval",
+    type=float,
+    default=None,
+    help="Simulated seconds between predictions. Defaults to a twentieth of the run.",
+)
+@click.option("--seed", default=0)
+@click.option("--jsonl", is_flag=True, help="Print a JSON record for each order instead.")
+def simulate_command(
+    results,
+    source,
+    items,
+    distribution,
+    failure_rate,
+    processes,
+    orders,
+    retries,
+    size_model,
+    prediction_interval,
+    seed,
+    jsonl,
+):
+    from each.simulation import items_from_results, simulate, synthetic_items
+
+    if results is not None:
+        sizes = None
+        if source is not None:
+            sizes = {item.name: item.size() for item in work_items_from_path(source)}
+        simulated = items_from_results(results, sizes)
+    else:
+        simulated = synthetic_items(items, distribution, failure_rate, seed=seed)
+
+    for order in orders or POLICIES:
+        interval = prediction_interval
+        if interval is None:
+            baseline = simulate(simulated, processes, order, retries=retries, seed=seed)
+            interval = baseline.makespan / 20
+        result = simulate(
+            simulated,
+            processes,
+            order,
             retries=retries,
+            size_model=size_model,
+            prediction_interval=interval,
+            seed=seed,
         )
-        pb.total = pb.n + len(each.work_queue)
-        pb.refresh()
+        if jsonl:
+            record = attr.asdict(result)
+            record["median_eta_error"] = result.median_eta_error
+            click.echo(json.dumps(record, sort_keys=True))
+        else:
+            error = result.median_eta_error
+            click.echo(
+                "%s: makespan %.2fs, utilisation %.1f%%, failed %d, median ETA error %s"
+                % (
+                    order,
+                    result.makespan,
+                    result.utilisation * 100,
+                    result.failed,
+                    "n/a" if error is None else "%.1f%%" % (error * 100,),
+                )
+            )
+
 
-        each.clear_queue()
+@main.command(
+    "control",
+    help="""
+Send a command to the run of each writing to DEST: processes N, pause,
+resume, drain or status. Prints what the run is doing afterwards.
+""",
+)
+@click.argument("destination")
+@click.argument("command")
+@click.argument("args", nargs=-1)
+def control_command(destination, command, args):
+    from each.control import COMMANDS, SOCKET_NAME, ControlError, send_command
+
+    if command not in COMMANDS:
+        raise click.BadParameter(
+            "%r is not one of %s" % (command, ", ".join(COMMANDS)), param_hint="COMMAND"
+        )
+    try:
+        reply = send_command(
+            os.path.join(destination, METADATA_DIR, SOCKET_NAME), " ".join((command,) + args)
+        )
+    except ControlError as e:
+        raise click.ClickException(str(e))
+    for key, value in sorted(reply.items()):
+        click.echo("%s: %s" % (key, json.dumps(value)))
 
 
 if __name__ == "__main__":
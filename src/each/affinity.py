@@ -0,0 +1,81 @@
+"""Pinning the processes ``Each`` runs to particular CPUs.
+
+With ``CORES`` each slot gets a single CPU, and with ``NUMA`` each slot gets
+all the CPUs of one NUMA node. Either way a slot keeps its CPUs for the whole
+run, so whichever item runs in a slot next finds the caches and local memory
+that the previous one warmed up. Consecutive slots are spread across NUMA
+nodes, so that a run using only some of the machine still uses the memory
+bandwidth of all of it.
+"""
+
+import os
+
+CORES = "cores"
+NUMA = "numa"
+PIN_MODES = (CORES, NUMA)
+
+NODE_ROOT = "/sys/devices/system/node"
+
+
+def parse_cpu_list(text):
+    """Parse a list of CPUs in the kernel's format, e.g. ``0-3,8,10-11``."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """The inverse of ``parse_cpu_list``."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else "%d-%d" % (first, last) for first, last in ranges
+    )
+
+
+def numa_nodes(root=NODE_ROOT):
+    """Return a list of the CPUs in each NUMA node that we're allowed to run on.
+
+    On machines without NUMA, or where we can't tell, all our CPUs are
+    treated as a single node.
+    """
+    available = os.sched_getaffinity(0)
+    nodes = []
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        names = []
+    for name in sorted(names):
+        if not (name.startswith("node") and name[4:].isdigit()):
+            continue
+        with open(os.path.join(root, name, "cpulist")) as i:
+            cpus = [cpu for cpu in parse_cpu_list(i.read()) if cpu in available]
+        if cpus:
+            nodes.append((int(name[4:]), cpus))
+    if not nodes:
+        return [sorted(available)]
+    return [cpus for _, cpus in sorted(nodes)]
+
+
+def slot_cpu_sets(processes, mode, nodes):
+    """Return the set of CPUs that each of 'processes' slots should run on.
+
+    Slot ``i`` is on node ``i % len(nodes)``. If there are more slots than
+    CPUs, slots share CPUs rather than going unpinned.
+    """
+    if mode == NUMA:
+        return [set(nodes[slot % len(nodes)]) for slot in range(processes)]
+    assert mode == CORES, mode
+    # Interleave the nodes' CPUs, so consecutive slots land on different nodes.
+    order = [
+        cpus[i] for i in range(max(len(cpus) for cpus in nodes)) for cpus in nodes if i < len(cpus)
+    ]
+    return [{order[slot % len(order)]} for slot in range(processes)]
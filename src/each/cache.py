@@ -0,0 +1,183 @@
+"""A content-addressed cache of results, shared between runs and destinations.
+
+Entries are keyed by everything that determines what running a command on a
+work item does: the command, the shell that interprets it, whether the item is
+passed on stdin, a hash of the item's contents, and, if it isn't passed on
+stdin, the argument substituted into the command for it. Only successful
+results are cached.
+
+Each entry is a directory holding the ``out``, ``err`` and ``status`` files of
+a result, along with any other files the run left in it, e.g. ones kept from
+its scratch directory. They are materialised into a destination by hard link
+where possible, falling back to a reflink and then a plain copy. An entry's
+modification time is bumped whenever it is used, so that eviction can remove
+the least recently used entries first.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import attr
+
+"""Files in a result that describe how it was run rather than what the
+command produced, so aren't cached. Every run writes its own."""
+RUN_FILES = ("in", "fingerprint", "affinity")
+
+"""The ``FICLONE`` ioctl on Linux, for copy-on-write clones of a file."""
+FICLONE = 0x40049409
+
+
+def reflink(source, destination):
+    import fcntl
+
+    with open(source, "rb") as i, open(destination, "wb") as o:
+        fcntl.ioctl(o.fileno(), FICLONE, i.fileno())
+
+
+def materialise(source, destination):
+    """Make 'destination' have the same contents as 'source', as cheaply as
+    possible."""
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    try:
+        reflink(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def result_files(base_dir):
+    """The paths, relative to 'base_dir', of the files in the result there
+    that are worth caching, other than its status."""
+    for root, _, names in os.walk(base_dir):
+        for name in names:
+            path = os.path.relpath(os.path.join(root, name), base_dir)
+            if path not in RUN_FILES + ("status",):
+                yield path
+
+
+def materialise_result(source, destination):
+    """Materialise the result in 'source' into 'destination'. The status file
+    is written last, as with a normal run, so that an interrupted copy is
+    treated as never having happened."""
+    for path in sorted(result_files(source)):
+        os.makedirs(os.path.dirname(os.path.join(destination, path)), exist_ok=True)
+        materialise(os.path.join(source, path), os.path.join(destination, path))
+    materialise(os.path.join(source, "status"), os.path.join(destination, "status"))
+
+
+@attr.s(slots=True)
+class CacheStats(object):
+    entries = attr.ib()
+    size = attr.ib()
+
+
+@attr.s()
+class ResultCache(object):
+    """A result cache stored in the directory at 'path'.
+
+    If 'max_size' is set, the cache evicts its least recently used entries
+    whenever storing a result takes it over that many bytes.
+    """
+
+    path = attr.ib()
+    max_size = attr.ib(default=None)
+    size = attr.ib(default=None, init=False)
+
+    def key(self, command, shell, stdin, work_item):
+        description = [command, shell, stdin, work_item.content_hash()]
+        if not stdin:
+            # The command sees where the item is as well as what's in it.
+            description.append(work_item.as_argument())
+        description = json.dumps(description)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, "entries", key[:2], key)
+
+    def fetch(self, key, base_dir):
+        """Materialise the cached result for 'key' into 'base_dir', if there is
+        one, returning whether there was."""
+        entry = self.entry(key)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        materialise_result(entry, base_dir)
+        return True
+
+    def store(self, key, base_dir):
+        """Add the successful result in 'base_dir' to the cache under 'key'."""
+        entry = self.entry(key)
+        # Entries are assembled elsewhere and renamed into place, so that a
+        # concurrent reader never sees a partial entry. If someone else got
+        # there first, we just throw our copy away.
+        tmp = os.path.join(self.path, "tmp", uuid.uuid4().hex)
+        os.makedirs(tmp)
+        materialise_result(base_dir, tmp)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            shutil.rmtree(tmp)
+            return
+
+        if self.max_size is not None:
+            if self.size is None:
+                self.size = self.stats().size
+            else:
+                self.size += entry_size(entry)
+            if self.size > self.max_size:
+                self.prune(self.max_size)
+
+    def entries(self):
+        """Yield the path of every entry in the cache."""
+        root = os.path.join(self.path, "entries")
+        try:
+            prefixes = os.listdir(root)
+        except FileNotFoundError:
+            return
+        for prefix in prefixes:
+            for key in os.listdir(os.path.join(root, prefix)):
+                yield os.path.join(root, prefix, key)
+
+    def stats(self):
+        entries = 0
+        size = 0
+        for entry in self.entries():
+            entries += 1
+            size += entry_size(entry)
+        return CacheStats(entries=entries, size=size)
+
+    def prune(self, max_size):
+        """Evict least recently used entries until the cache takes up no more
+        than 'max_size' bytes, returning how many entries were evicted."""
+        entries = sorted(
+            (os.stat(entry).st_mtime, entry_size(entry), entry) for entry in self.entries()
+        )
+        size = sum(s for _, s, _ in entries)
+        evicted = 0
+        for _, entry_bytes, entry in entries:
+            if size <= max_size:
+                break
+            shutil.rmtree(entry)
+            size -= entry_bytes
+            evicted += 1
+        self.size = size
+        return evicted
+
+
+def entry_size(entry):
+    return sum(
+        os.stat(os.path.join(root, name)).st_size
+        for root, _, names in os.walk(entry)
+        for name in names
+    )
@@ -0,0 +1,174 @@
+"""Changing how a run behaves while it's running.
+
+A running ``Each`` with ``control`` set listens on a Unix socket,
+``.each/control.sock`` in its destination, for one-line commands:
+
+* ``processes N`` sets how many items may run at once. Lowering it doesn't
+  stop anything that's running, it just waits for items to finish.
+* ``pause`` stops new items starting, and ``resume`` starts them again.
+* ``drain`` stops new items starting, and ends the run once the running
+  ones have finished. Anything left is run by the next run, as usual.
+* ``status`` changes nothing.
+
+Every command is answered with a JSON object describing the run, or with
+one with an ``error`` if the command wasn't understood. ``each control``
+sends commands from the command line.
+
+SIGUSR1 and SIGUSR2 raise and lower the number of processes by one, for
+when the socket isn't reachable.
+"""
+
+import json
+import os
+import signal
+import socket
+
+import attr
+
+SOCKET_NAME = "control.sock"
+
+COMMANDS = ("processes", "pause", "resume", "drain", "status")
+
+
+class ControlError(Exception):
+    """Raised when a command can't be sent to a run, or the run rejects it."""
+
+
+def socket_address(path):
+    """Unix socket paths are limited to about a hundred bytes, so use a
+    relative path if it's shorter."""
+    relative = os.path.relpath(path)
+    return relative if len(relative) < len(path) else path
+
+
+def is_listening(path):
+    """Whether anything is listening on the socket at 'path'. Connecting is
+    enough to tell, and unlike sending a command doesn't wait for the run to
+    get round to answering."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        try:
+            client.connect(socket_address(path))
+        except OSError:
+            return False
+    return True
+
+
+@attr.s()
+class Controller(object):
+    """Applies commands from the socket at 'path', and from signals, to the
+    ``Each`` 'each'."""
+
+    each = attr.ib()
+    path = attr.ib()
+    server = attr.ib(default=None, init=False)
+    """How many processes signals have asked us to add, less how many they've
+    asked us to remove, since we last looked."""
+    signalled = attr.ib(default=0, init=False)
+    previous_handlers = attr.ib(default=attr.Factory(dict), init=False)
+
+    def open(self):
+        """Start listening for commands, raising ``ControlError`` if we can't,
+        e.g. because another run on the same destination already is."""
+        if is_listening(self.path):
+            raise ControlError("Another run is already listening on %s" % (self.path,))
+        # Anything there is left over from a run that didn't get to clean up.
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(socket_address(self.path))
+        except OSError as e:
+            server.close()
+            raise ControlError("Can't listen on %s: %s" % (self.path, e))
+        self.server = server
+        self.server.listen()
+        self.server.setblocking(False)
+        for signum, change in ((signal.SIGUSR1, 1), (signal.SIGUSR2, -1)):
+            self.previous_handlers[signum] = signal.signal(
+                signum, lambda signum, frame, change=change: self.on_signal(change)
+            )
+
+    def close(self):
+        for signum, handler in self.previous_handlers.items():
+            signal.signal(signum, handler)
+        self.previous_handlers.clear()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def on_signal(self, change):
+        # Only note the signal here, as it may arrive at any point in the
+        # scheduling loop.
+        self.signalled += change
+
+    def poll(self):
+        """Apply any commands that have arrived since we last looked."""
+        if self.signalled:
+            change, self.signalled = self.signalled, 0
+            self.each.set_processes(max(1, self.each.processes + change))
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except BlockingIOError:
+                return
+            with connection:
+                connection.settimeout(1.0)
+                try:
+                    request = connection.makefile().readline()
+                    connection.sendall((json.dumps(self.handle(request)) + "\n").encode())
+                except OSError:
+                    # The client went away, which is its problem.
+                    pass
+
+    def handle(self, request):
+        command, *args = request.split() or [""]
+        if command not in COMMANDS:
+            return {
+                "error": "unknown command %r, expected one of %s" % (command, ", ".join(COMMANDS))
+            }
+        if command == "processes":
+            if len(args) != 1 or not args[0].isdigit() or int(args[0]) < 1:
+                return {"error": "processes needs a number of processes of at least 1"}
+            self.each.set_processes(int(args[0]))
+        elif command == "pause":
+            self.each.paused = True
+        elif command == "resume":
+            self.each.paused = False
+        elif command == "drain":
+            self.each.draining = True
+        return self.status()
+
+    def status(self):
+        each = self.each
+        return {
+            "processes": each.processes,
+            "paused": each.paused,
+            "draining": each.draining,
+            "running": len(each.work_in_progress),
+            "completed": each.completed,
+            "failed": each.failed,
+        }
+
+
+def send_command(path, command, timeout=10.0):
+    """Send 'command' to the run listening on the socket at 'path', and
+    return its reply."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        client.settimeout(timeout)
+        try:
+            client.connect(socket_address(path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise ControlError("Nothing is listening on %s" % (path,))
+        client.sendall((command + "\n").encode())
+        reply = json.loads(client.makefile().readline())
+    if "error" in reply:
+        raise ControlError(reply["error"])
+    return reply
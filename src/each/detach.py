@@ -0,0 +1,85 @@
+"""Keeping track of items that run detached from the ``Each`` running them.
+
+A detached item is run by a small supervisor process of its own, forked from
+``Each`` into a new session, so it survives ``Each`` dying, whether from a
+lost SSH connection, an OOM kill or a restart. The supervisor waits for the
+command and records how it exited. The next ``Each`` to run on the same
+destination picks up where the last one left off: it waits for any items
+still running and collects the results of any that finished in between.
+
+Everything about an item is kept in a directory of its own under
+``.each/running``:
+
+* ``record`` says which item it is and where its results are going.
+* ``lock`` is locked for as long as the supervisor is alive. We use this
+  rather than the process ID to tell whether it's still running, as
+  process IDs get reused.
+* ``result`` is the item's exit status as given by ``os.waitpid``, written
+  once it has exited.
+"""
+
+import fcntl
+import json
+import os
+
+RUNNING_DIR = "running"
+
+
+def hold_lock(running_dir):
+    """Create and lock the lock file in 'running_dir', and return its file
+    descriptor. Processes forked after this share the lock, so it stays held
+    until all of them have closed it or exited."""
+    fd = os.open(os.path.join(running_dir, "lock"), os.O_CREAT | os.O_WRONLY)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def lock_is_held(running_dir):
+    """Whether the supervisor for 'running_dir' is still alive."""
+    try:
+        fd = os.open(os.path.join(running_dir, "lock"), os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def write_atomically(path, text):
+    with open(path + ".tmp", "w") as o:
+        o.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def write_record(running_dir, record):
+    write_atomically(os.path.join(running_dir, "record"), json.dumps(record, sort_keys=True))
+
+
+def read_record(running_dir):
+    try:
+        with open(os.path.join(running_dir, "record")) as i:
+            return json.load(i)
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def read_result(running_dir):
+    """The exit status the item recorded, as given by ``os.waitpid``, or None
+    if it hasn't recorded one."""
+    try:
+        with open(os.path.join(running_dir, "result")) as i:
+            return int(i.read())
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def supervise(pid, running_dir):
+    """Wait for the command with process ID 'pid' to exit, record how it did,
+    and exit. Runs in the supervisor process."""
+    _, result = os.waitpid(pid, 0)
+    write_atomically(os.path.join(running_dir, "result"), str(result))
+    os._exit(0)
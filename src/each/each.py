@@ -1,18 +1,37 @@
+import errno
+import glob
 import hashlib
+import heapq
+import json
 import os
 import re
 import shlex
 import shutil
+import signal
+import sys
+import tempfile
 import time
 import traceback
 from abc import ABC, abstractmethod
-from collections import Counter
+from collections import Counter, OrderedDict
+from itertools import count
 from random import Random
 
 import attr
 
-from each.junkdrawer import Timeout, timeout
-from each.prediction import predict_timing
+from each.affinity import format_cpu_list, numa_nodes, slot_cpu_sets
+from each.detach import (
+    RUNNING_DIR,
+    hold_lock,
+    lock_is_held,
+    read_record,
+    read_result,
+    supervise,
+    write_record,
+)
+from each.junkdrawer import Timeout, disk_usage, file_size, percentile, timeout
+from each.prefetch import Prefetcher
+from each.tracing import NullTracer, slot_track
 
 # We can't use the normal sys ones within pytest if we want to actually operate
 # on the underlying unix file descriptors.
@@ -22,15 +41,219 @@ STDERR = 2
 
 SHELL = os.environ.get("SHELL") or shutil.which("bash") or shutil.which("sh")
 
+"""The directory inside a destination where each keeps its own files.
+
+Work items must not use this as a name.
+"""
+METADATA_DIR = ".each"
+
+"""A file in the metadata directory with a JSON line of [name, status,
+runtime] for each item as it finishes, which ``each.query`` reads rather than
+every ``status`` file. The runtime is null for results taken from the cache,
+as they say nothing about how long the item takes to run."""
+INDEX = "index"
+
+"""A directory in the metadata directory with a checkpoint directory for
+each item that has started but not yet succeeded, when using checkpoints."""
+CHECKPOINTS_DIR = "checkpoints"
+
+
+def publish(staging_dir, base_dir, trash):
+    """Move the completed results in 'staging_dir' to 'base_dir'.
+
+    If there are previous results at 'base_dir' they are moved to 'trash' and
+    deleted, so at no point is there anything but a complete set of results
+    at 'base_dir'.
+    """
+    try:
+        os.rename(staging_dir, base_dir)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+    os.rename(base_dir, trash)
+    os.rename(staging_dir, base_dir)
+    shutil.rmtree(trash)
+
+
+"""The status recorded for an item that was killed for using more than
+``scratch_quota`` bytes of scratch space. Items killed by any other signal
+get 128 plus the signal number, as they would in a shell."""
+SCRATCH_QUOTA_EXCEEDED = 250
+
+"""The status recorded for an item that was killed for writing more than
+``max_output`` bytes to its stdout or ``max_err`` bytes to its stderr."""
+OUTPUT_LIMIT_EXCEEDED = 251
+
+
+def exit_status(result):
+    """The status to record for a child that exited with 'result', as given
+    by ``os.waitpid``."""
+    if os.WIFSIGNALED(result):
+        return 128 + os.WTERMSIG(result)
+    return os.WEXITSTATUS(result)
+
+
+"""Retry policies for failed items, chosen per exit status.
+
+``RETRY`` runs the item again as soon as a slot is free, ``BACKOFF`` runs it
+again after an exponentially growing delay, and ``NEVER`` doesn't retry it.
+"""
+RETRY = "retry"
+BACKOFF = "backoff"
+NEVER = "never"
+RETRY_POLICIES = (RETRY, BACKOFF, NEVER)
+
+
+def backoff_delay(failures, base, maximum, random):
+    """How long to wait before retrying something that has failed 'failures'
+    times.
+
+    The delay doubles with each failure up to 'maximum', and is jittered
+    between half and all of that so that items which failed together don't
+    all come back together.
+    """
+    delay = min(maximum, base * 2 ** (failures - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def next_retry_delay(failures, retries, policy, base, maximum, random):
+    """How long to wait before retrying something that has just failed,
+    having failed 'failures' times before, under retry 'policy': 0 to retry
+    it as soon as possible, or None if it has had all its 'retries' or
+    shouldn't be retried at all."""
+    if failures >= retries or policy == NEVER:
+        return None
+    if policy == RETRY:
+        return 0
+    return backoff_delay(failures + 1, base, maximum, random)
+
+
+def release_due(deferred, now):
+    """Pop the things in 'deferred', a heap of (when, ..., thing) tuples,
+    that are due by 'now', in the order they fell due."""
+    while deferred and deferred[0][0] <= now:
+        yield heapq.heappop(deferred)[-1]
+
+
+"""Orders in which ``Each`` can run its work items.
+
+``RANDOM`` gives the most reliable predictions early on, as the items run so
+far are a fair sample of the rest. ``LARGEST_FIRST`` leaves only small items
+to run at the end, so the run isn't held up waiting for one big item to
+finish. It's best combined with ``size_model``.
+"""
+RANDOM = "random"
+LARGEST_FIRST = "largest-first"
+ORDERS = (RANDOM, LARGEST_FIRST)
+
+
+def order_queue(queue, order, random, size):
+    """Put 'queue' in the order 'order' says, in place. The queue is run from
+    the end, and 'size' gives the size of an item in it."""
+    # By iterating in random order, we can paradoxically get much better predictability
+    # about the final run time! This allows us to conclude the times we've seen so far
+    # are reasonably representative of the times we will see in future.
+    random.shuffle(queue)
+    if order == LARGEST_FIRST:
+        # The sort is stable, so items of the same size stay shuffled.
+        queue.sort(key=size)
+    else:
+        assert order == RANDOM, order
+
+
+"""How many items must finish before we know enough about how long items
+take to decide one is taking too long."""
+MIN_RUNTIMES_TO_SPECULATE = 10
+
+
+class RunAborted(Exception):
+    """Raised when a run stops early because too many items are failing, or
+    a pilot predicts it would take too long."""
+
+
+@attr.s()
+class PilotReport(object):
+    """What we learned from running a sample of the items first."""
+
+    items = attr.ib()
+    failures = attr.ib()
+    """The sorted runtimes of the sample, in seconds."""
+    runtimes = attr.ib()
+    remaining = attr.ib()
+    """A ``PredictedRuntime`` for the remaining items, or None if there are none."""
+    prediction = attr.ib()
+
+    @property
+    def failure_rate(self):
+        return self.failures / self.items if self.items else 0.0
+
+    def runtime_percentile(self, q):
+        return percentile(self.runtimes, q)
+
+
+def stage_destination(destination, index):
+    """Where the results of stage 'index' of a pipeline writing to
+    'destination' go: 'destination' itself for the first stage, then
+    'destination-2', 'destination-3' and so on."""
+    if index == 0:
+        return destination
+    return "%s-%d" % (str(destination).rstrip("/"), index + 1)
+
+
+@attr.s()
+class Stage(object):
+    """One of the commands in a pipeline run by ``Each``.
+
+    Every item runs through the stages in order. Each stage after the first
+    takes the ``out`` file of the stage before as its input.
+    """
+
+    index = attr.ib()
+    command = attr.ib()
+    stdin = attr.ib()
+    destination = attr.ib()
+    """When items from more than one stage are waiting, the stage with the
+    highest priority goes first."""
+    priority = attr.ib()
+    """A hash of everything about the command that affects its results."""
+    command_hash = attr.ib()
+    staging_root = attr.ib()
+    """Items waiting to run this stage. The first stage uses ``Each.work_queue``
+    instead."""
+    queue = attr.ib(default=attr.Factory(list))
+
 
 @attr.s()
 class WorkInProgress:
     pid = attr.ib()
     started = attr.ib()
     work_item = attr.ib()
+    slot = attr.ib()
+    """Where the results are written while the item is running."""
+    staging_dir = attr.ib()
+    """Where the results are moved to once the item has finished."""
+    base_dir = attr.ib()
     out_file = attr.ib()
     err_file = attr.ib()
     status_file = attr.ib()
+    cache_key = attr.ib(default=None)
+    """Whether this is a second copy of an item that was taking too long."""
+    speculative = attr.ib(default=False)
+    """Whether another copy of the item has failed while this one carried
+    on, so it's had its second chance."""
+    copy_failed = attr.ib(default=False)
+    """The item's private scratch directory, if it has one."""
+    scratch_dir = attr.ib(default=None)
+    """If we killed the item for going over one of our limits, the status to
+    record for it, e.g. ``SCRATCH_QUOTA_EXCEEDED``."""
+    killed_status = attr.ib(default=None)
+    """Where we keep track of the item if it's running detached."""
+    running_dir = attr.ib(default=None)
+    """Whether the item was started by an earlier run, so isn't our child."""
+    reattached = attr.ib(default=False)
+    """The item's checkpoint directory, if it has one."""
+    checkpoint_dir = attr.ib(default=None)
 
 
 class WorkItem(ABC):
@@ -39,6 +262,9 @@ class WorkItem(ABC):
     """A name for this work item that can be used as a filename."""
     name = NotImplemented
 
+    """Which of ``Each``'s stages this work item is the input to."""
+    stage = 0
+
     @abstractmethod
     def exists(self):
         """Whether or not this work item still exists."""
@@ -58,6 +284,22 @@ class WorkItem(ABC):
     def write_in_file(self, path):
         """Create a file at 'path' that contains the input data for this work item."""
 
+    @abstractmethod
+    def content_hash(self):
+        """A hash of the input data for this work item, as a hex string."""
+
+    @abstractmethod
+    def fingerprint(self):
+        """A cheap string that changes whenever the input data does."""
+
+    @abstractmethod
+    def size(self):
+        """How big this work item is, in bytes. Used to predict how long it will take."""
+
+    def prefetch(self):
+        """Ask the OS to start reading the input data for this work item into
+        memory, so that it's already there when we run it."""
+
 
 @attr.s()
 class FileWorkItem(WorkItem):
@@ -69,6 +311,8 @@ class FileWorkItem(WorkItem):
     """The location of the file on disk."""
     path = attr.ib()
 
+    stage = attr.ib(default=0)
+
     def exists(self):
         """A file work item exists only if the file exists."""
         return os.path.exists(self.path)
@@ -83,6 +327,42 @@ class FileWorkItem(WorkItem):
         """The ``in`` file is a symlink to the original file."""
         os.symlink(os.path.abspath(self.path), path)
 
+    def content_hash(self):
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as i:
+            for block in iter(lambda: i.read(1 << 16), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def fingerprint(self):
+        """Files are assumed unchanged if their size and mtime are, as make does."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Deleted since it was listed. It counts as changed, and is then
+            # skipped as it no longer exists.
+            return None
+        return "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+
+    def size(self):
+        try:
+            return os.stat(self.path).st_size
+        except FileNotFoundError:
+            # It won't be run, so won't take any time.
+            return 0
+
+    def prefetch(self):
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
 
 @attr.s()
 class LineWorkItem(WorkItem):
@@ -115,6 +395,15 @@ class LineWorkItem(WorkItem):
         with open(path, "w") as in_file:
             in_file.write(self.line)
 
+    def content_hash(self):
+        return hashlib.sha256(self.line.encode("utf-8")).hexdigest()
+
+    def fingerprint(self):
+        return self.content_hash()
+
+    def size(self):
+        return len(self.line.encode("utf-8"))
+
 
 def work_items_from_path(path):
     """Load work items from a user-supplied path.
@@ -148,6 +437,11 @@ simple_name_re = re.compile("^[A-Za-z0-9_-]+$")
 """The longest simple name we allow as a suffix to the generated filename."""
 MAX_SIMPLE_NAME_SUFFIX_LENGTH = 100
 
+"""How many of the most recently seen lines ``work_items_from_stream``
+remembers to skip repeats of. A stream can go on for ever, so it can't
+remember them all."""
+STREAM_DEDUPE_WINDOW = 100000
+
 
 def work_items_from_lines(stream):
     """Yield a series of work items derived from an iterator of lines.
@@ -158,13 +452,40 @@ def work_items_from_lines(stream):
     """
     items = {}
     for line in stream:
-        name = hashlib.sha256(line.encode("utf-8")).hexdigest()[-8:]
-        if simple_name_re.match(line.strip()):
-            name += "-" + line.strip()[:MAX_SIMPLE_NAME_SUFFIX_LENGTH]
-        items[name] = LineWorkItem(name, line)
+        item = line_work_item(line)
+        items[item.name] = item
     return items.values()
 
 
+def work_items_from_stream(stream, window=STREAM_DEDUPE_WINDOW):
+    """Lazily yield a work item for each distinct line of 'stream'.
+
+    Unlike ``work_items_from_lines`` this doesn't need to see the whole stream
+    first, so is suitable for e.g. a pipe that is still being written to.
+
+    Only repeats of the last 'window' distinct lines are skipped here. A line
+    repeated after longer than that has usually finished by then, and ``Each``
+    skips items that already have results.
+    """
+    seen = OrderedDict()
+    for line in stream:
+        item = line_work_item(line)
+        if item.name in seen:
+            seen.move_to_end(item.name)
+            continue
+        seen[item.name] = None
+        if len(seen) > window:
+            seen.popitem(last=False)
+        yield item
+
+
+def line_work_item(line):
+    name = hashlib.sha256(line.encode("utf-8")).hexdigest()[-8:]
+    if simple_name_re.match(line.strip()):
+        name += "-" + line.strip()[:MAX_SIMPLE_NAME_SUFFIX_LENGTH]
+    return LineWorkItem(name, line)
+
+
 @attr.s()
 class Each(object):
     """Run a single command over many things.
@@ -196,153 +517,1227 @@ class Each(object):
     wait_timeout = attr.ib(default=1.0)
     retries = attr.ib(default=0)
     failure_counts = attr.ib(default=attr.Factory(Counter))
+    tracer = attr.ib(default=attr.Factory(NullTracer))
+    """A ``ResultCache`` to reuse the results of previous runs from, if any."""
+    cache = attr.ib(default=None)
+    """Whether to rerun items whose input or command has changed since their
+    result was recorded, even if it was a success."""
+    incremental = attr.ib(default=False)
+    """Whether to start running work items as 'work_items' produces them,
+    rather than reading them all up front."""
+    streaming = attr.ib(default=False)
+    """How many items to read ahead of what we're running when streaming."""
+    buffer_size = attr.ib(default=1000)
+    """The delay in seconds before the first ``BACKOFF`` retry of an item."""
+    retry_delay = attr.ib(default=1.0)
+    """The longest we will ever wait before retrying an item."""
+    max_retry_delay = attr.ib(default=60.0)
+    """A mapping of exit statuses to retry policies. Failures with statuses not
+    in here are retried with ``BACKOFF``."""
+    retry_policies = attr.ib(default=attr.Factory(dict))
+    """How many randomly chosen items to run before the rest, to check that
+    the command works and how long it takes."""
+    pilot = attr.ib(default=0)
+    """Abort if the pilot predicts the remaining items will take longer than
+    this many seconds."""
+    max_predicted_time = attr.ib(default=None)
+    """Abort, in the pilot or the main run, if more than this fraction of
+    items fail."""
+    max_failure_rate = attr.ib(default=None)
+    """The main run's failure rate is only checked after this many items."""
+    min_items_for_failure_rate = attr.ib(default=10)
+    pilot_callback = attr.ib(default=lambda report: None)
+    """If set, ``CORES`` or ``NUMA``: how to pin each slot to a fixed set of
+    CPUs. The CPUs an item ran on are recorded in its ``affinity`` file."""
+    pin = attr.ib(default=None)
+    """Whether to predict runtimes from the sizes of items, rather than
+    assuming every item is like any other. Ignored for pipelines."""
+    size_model = attr.ib(default=False)
+    """The order to run items in: ``RANDOM`` or ``LARGEST_FIRST``."""
+    order = attr.ib(default=RANDOM)
+    """If set, once nothing is left to start, run a second copy of any item
+    that has been running for more than this many times the p99 runtime so
+    far. Only suitable for commands that give the same result every time."""
+    speculate = attr.ib(default=None)
+    """Further commands to run as a pipeline. Each is run on the ``out`` of
+    the stage before as soon as an item succeeds there, and writes its results
+    to its own destination, as given by ``stage_destination``."""
+    then = attr.ib(default=attr.Factory(list))
+    """The priority of each stage, including the first. By default later
+    stages go first, so that items get through the pipeline as soon as they
+    can rather than piling up between stages."""
+    stage_priorities = attr.ib(default=None)
+    """A ``Reducer`` to fold the ``out`` of each item that succeeds into a
+    running aggregate, which is kept in ``.each/reduce`` in the destination of
+    the last stage."""
+    reducer = attr.ib(default=None)
+    """How many outputs to fold into the aggregate at a time."""
+    reduce_batch_size = attr.ib(default=100)
+    """A directory, ideally on fast local storage such as ``/dev/shm``, in
+    which to give each running item a private scratch directory. Its path is
+    passed to the command as ``EACH_SCRATCH_DIR``, and also as ``TMPDIR``.
+    The scratch directory is deleted when the item finishes."""
+    scratch = attr.ib(default=None)
+    """Glob patterns, relative to an item's scratch directory, of files to
+    move into its results when it succeeds."""
+    keep_scratch = attr.ib(default=attr.Factory(list))
+    """If set, kill any item using more than this many bytes of scratch space,
+    and record its status as ``SCRATCH_QUOTA_EXCEEDED``. Usage is checked
+    about every 'wait_timeout' seconds, so an item can briefly go over."""
+    scratch_quota = attr.ib(default=None)
+    """If set, kill any item that writes more than these many bytes to its
+    stdout or stderr respectively, cut what it wrote down to that, and record
+    its status as ``OUTPUT_LIMIT_EXCEEDED``. Like 'scratch_quota', these are
+    checked about every 'wait_timeout' seconds."""
+    max_output = attr.ib(default=None)
+    max_err = attr.ib(default=None)
+    """A directory holding a directory for each slot, which is kept between
+    items and runs for commands to keep caches in. Each item is told its slot
+    number as ``EACH_SLOT`` and the slot's directory as ``EACH_SLOT_DIR``.
+    Defaults to ``.each/slots`` in the destination."""
+    slot_dir = attr.ib(default=None)
+    """How many of the items next in line to prefetch the inputs of, so that
+    commands don't wait on cold reads from slow storage."""
+    prefetch = attr.ib(default=0)
+    """The most bytes of input to have prefetched or in use at once. See
+    ``Prefetcher``."""
+    prefetch_budget = attr.ib(default=256 * 1024 * 1024)
+    """Whether to take commands while running, from signals and a socket in
+    the destination. See ``each.control``."""
+    control = attr.ib(default=False)
+    """Whether to run items detached from us, so that if we die they carry
+    on, and the next run on this destination collects them rather than
+    starting them again. See ``each.detach``."""
+    detach = attr.ib(default=False)
+    """Whether to give each item a checkpoint directory, passed to the
+    command as ``EACH_CHECKPOINT_DIR``, in which it can save its progress.
+    Unlike everything else about a failed run of an item, it's kept for the
+    item's retries, in this run or later ones, so they can carry on from
+    where it got to. It's deleted once the item succeeds. Speculative copies
+    of an item get one of their own, so as not to get in the way of the copy
+    they're racing, which is thrown away once they finish."""
+    checkpoints = attr.ib(default=False)
 
     def __attrs_post_init__(self):
         self.work_queue = []
+        # Slots are numbered and always handed out lowest first, so a trace
+        # shows which of the ``processes`` slots were idle and when.
+        self.free_slots = list(range(self.processes))
+        self.slot_count = self.processes
+
+        self.running_root = os.path.join(
+            stage_destination(self.destination, 0), METADATA_DIR, RUNNING_DIR
+        )
+        self.detached = self.find_detached()
+        if self.pin is not None:
+            self.slot_cpus = slot_cpu_sets(self.processes, self.pin, numa_nodes())
+
+        commands = [self.command] + list(self.then)
+        priorities = self.stage_priorities or range(len(commands))
+        assert len(priorities) == len(commands), (priorities, commands)
+        self.stages = [
+            self.make_stage(index, command, priority)
+            for index, (command, priority) in enumerate(zip(commands, priorities))
+        ]
+        self.stage_order = sorted(self.stages, key=lambda stage: -stage.priority)
+
+        if self.slot_dir is None:
+            self.slot_dir = os.path.join(self.stages[0].destination, METADATA_DIR, "slots")
+        for slot in range(self.processes):
+            os.makedirs(os.path.join(self.slot_dir, str(slot)), exist_ok=True)
+
+        if self.prefetch > 0:
+            self.prefetcher = Prefetcher(
+                depth=self.prefetch, budget=self.prefetch_budget, size=self.item_size
+            )
 
-        try:
-            os.makedirs(self.destination)
-        except FileExistsError:
-            pass
-
-        for work_item in self.work_items:
-            status_file = os.path.join(self.destination, work_item.name, "status")
-
-            previous_status = None
+        if self.reducer is not None:
+            # Imported here, like the other things only some runs need, as
+            # the thread pool it uses is slow to import.
+            from each.reduce import Aggregate
 
-            try:
-                with open(status_file) as i:
-                    previous_status = int(i.read().strip())
-            except (ValueError, FileNotFoundError):
-                pass
+            self.aggregate = Aggregate(
+                path=os.path.join(self.stages[-1].destination, METADATA_DIR, "reduce"),
+                reducer=self.reducer,
+                batch_size=self.reduce_batch_size,
+                workers=self.processes,
+            )
+            if self.recreate or self.incremental:
+                # Items we rerun may already be in the aggregate, and there's
+                # no taking them back out.
+                self.aggregate.reset()
 
-            if previous_status is not None:
-                discard = not self.recreate
+        if self.streaming:
+            from each.streaming import StreamingWorkSource
 
-                if previous_status != 0 and self.retries > 0:
-                    self.failure_counts[work_item.name] += 1
-                    discard = False
-            else:
-                discard = False
+            self.work_source = StreamingWorkSource(self.work_items, self.buffer_size)
+            return
 
-            if discard:
-                self.progress_callback()
-            else:
-                self.work_queue.append(work_item)
-        # By iterating in random order, we can paradoxically get much better predictability
-        # about the final run time! This allows us to conclude the times we've seen so far
-        # are reasonably representative of the times we will see in future.
-        self.random.shuffle(self.work_queue)
+        for work_item in self.work_items:
+            work_item = self.first_unfinished_stage(work_item)
+            if work_item is not None:
+                self.stage_queue(work_item.stage).append(work_item)
+        order_queue(self.work_queue, self.order, self.random, self.item_size)
 
     progress_callback = attr.ib(default=lambda: None)
     prediction_callback = attr.ib(default=lambda p: None)
+    """Called with a message about anything that went wrong that we could
+    carry on without."""
+    warning_callback = attr.ib(default=lambda message: print(message, file=sys.stderr))
 
     work_in_progress = attr.ib(default=attr.Factory(dict), init=False)
     work_queue = attr.ib(default=None, init=False)
+    free_slots = attr.ib(default=None, init=False)
+    """The CPUs each slot is pinned to, if we're pinning."""
+    slot_cpus = attr.ib(default=None, init=False)
+    """The ``Stage`` for our command, followed by those for 'then'."""
+    stages = attr.ib(default=None, init=False)
+    """The stages in the order we take waiting items from them."""
+    stage_order = attr.ib(default=None, init=False)
+    work_source = attr.ib(default=None, init=False)
+    """The ``Aggregate`` that 'reducer' folds outputs into."""
+    aggregate = attr.ib(default=None, init=False)
+    """The ``Prefetcher`` for the inputs of upcoming items, if we prefetch."""
+    prefetcher = attr.ib(default=None, init=False)
+    """How many slots there are, which is the most 'processes' has been."""
+    slot_count = attr.ib(default=None, init=False)
+    """Whether to hold off starting items for now, and whether to stop the
+    run once the running items have finished."""
+    paused = attr.ib(default=False, init=False)
+    draining = attr.ib(default=False, init=False)
+    controller = attr.ib(default=None, init=False)
+    """Where detached items are kept track of, and the records of those left
+    running by an earlier run, keyed by stage and name, until we come
+    across them."""
+    running_root = attr.ib(default=None, init=False)
+    detached = attr.ib(default=attr.Factory(dict), init=False)
+    staging_sequence = attr.ib(default=attr.Factory(count), init=False)
+    """The sizes of the items we've seen, by name, and of each item whose
+    runtime has been recorded, in the same order as 'runtimes'."""
+    item_sizes = attr.ib(default=attr.Factory(dict), init=False)
+    observed_sizes = attr.ib(default=attr.Factory(list), init=False)
+    """The directory in 'scratch' that this run's scratch directories are
+    made in, once there are any."""
+    scratch_root = attr.ib(default=None, init=False)
+    """When we last checked whether any item had gone over our limits."""
+    limits_checked = attr.ib(default=0.0, init=False)
+    """Items waiting to be retried, as a heap of (when, sequence, item). They
+    don't take up a slot until they're due."""
+    deferred = attr.ib(default=attr.Factory(list), init=False)
+    deferred_sequence = attr.ib(default=attr.Factory(count), init=False)
+    """How many items have finished in this run, and how many of them failed.
+    Items that are retried only count once they've finished retrying."""
+    completed = attr.ib(default=0, init=False)
+    failed = attr.ib(default=0, init=False)
+    """A sorted copy of 'runtimes', as of when we last needed one."""
+    sorted_runtimes = attr.ib(default=attr.Factory(list), init=False)
+
+    def make_stage(self, index, command, priority):
+        # Only the first command has its use of stdin set explicitly.
+        stdin = self.stdin if index == 0 else "{}" not in command
+        destination = stage_destination(self.destination, index)
+        try:
+            os.makedirs(destination)
+        except FileExistsError:
+            pass
 
-    def fill_work_in_progress(self):
-        while self.work_queue and len(self.work_in_progress) < self.processes:
-            work_item = self.work_queue.pop()
-            if not work_item.exists():
-                self.progress_callback()
+        # Every run of an item is written to its own staging directory and
+        # only moved into place once it's complete. Anything left in here is
+        # from a run that was interrupted, so is thrown away, unless it's
+        # still being written to by a detached item.
+        staging_root = os.path.join(destination, METADATA_DIR, "staging")
+        keep = set()
+        for record in self.detached.values():
+            if record["stage"] == index:
+                name = os.path.basename(record["staging_dir"])
+                keep.update((name, name + ".checkpoints"))
+        os.makedirs(staging_root, exist_ok=True)
+        for name in os.listdir(staging_root):
+            if name not in keep:
+                shutil.rmtree(os.path.join(staging_root, name), ignore_errors=True)
+
+        return Stage(
+            index=index,
+            command=command,
+            stdin=stdin,
+            destination=destination,
+            priority=priority,
+            command_hash=hashlib.sha256(
+                json.dumps([command, self.shell, stdin]).encode("utf-8")
+            ).hexdigest(),
+            staging_root=staging_root,
+        )
+
+    def stage_queue(self, index):
+        """The queue of items waiting for stage 'index'."""
+        if index == 0:
+            return self.work_queue
+        return self.stages[index].queue
+
+    def next_queue(self):
+        """The queue to start the next item from, if any are waiting."""
+        for stage in self.stage_order:
+            queue = self.stage_queue(stage.index)
+            if queue:
+                return queue
+        return None
+
+    def next_stage(self, work_item):
+        """The work item for the stage after the one 'work_item' has just
+        succeeded at, or None if that was the last."""
+        if work_item.stage + 1 >= len(self.stages):
+            return None
+        return FileWorkItem(
+            name=work_item.name,
+            path=os.path.join(self.stages[work_item.stage].destination, work_item.name, "out"),
+            stage=work_item.stage + 1,
+        )
+
+    def first_unfinished_stage(self, work_item):
+        """Return the work item for the first stage that 'work_item' has no
+        result to keep for, or None, reporting progress, if it has been all the
+        way through the pipeline or failed somewhere along it."""
+        while self.already_done(work_item):
+            next_item = None
+            if self.previous_status(work_item) == 0:
+                next_item = self.next_stage(work_item)
+                if next_item is None:
+                    self.reduce(work_item)
+            if next_item is None:
+                self.report_progress()
+                return None
+            work_item = next_item
+        record = self.detached.pop((work_item.stage, work_item.name), None)
+        if record is not None:
+            self.reattach(work_item, record)
+            return None
+        return work_item
+
+    def find_detached(self):
+        """Return the records of the detached items that an earlier run left
+        behind, and clean up after any that were lost. If we aren't running
+        detached ourselves, all of them are lost, as we throw away their
+        staging directories."""
+        detached = {}
+        if not os.path.isdir(self.running_root):
+            return detached
+        for name in sorted(os.listdir(self.running_root)):
+            running_dir = os.path.join(self.running_root, name)
+            record = read_record(running_dir)
+            alive = lock_is_held(running_dir)
+            if record is None or "pid" not in record:
+                # We died before it got going. If it's running, we can't
+                # tell what, so leave it to finish and tidy up next time,
+                # unless its results would be thrown away regardless.
+                if not alive or not self.detach:
+                    shutil.rmtree(running_dir)
+                continue
+            if not self.detach or not os.path.isdir(record["staging_dir"]):
+                # Its results are gone, or about to be, e.g. because a run
+                # that wasn't detached came in between, so it has to start
+                # again, and there's no point letting it carry on.
+                if alive:
+                    try:
+                        os.killpg(record["pid"], signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                self.abandon_detached(running_dir, record)
+                continue
+            if not alive and read_result(running_dir) is None:
+                # Killed along with its supervisor, so it has to start again.
+                self.abandon_detached(running_dir, record)
                 continue
+            detached[(record["stage"], record["name"])] = record
+        return detached
+
+    def abandon_detached(self, running_dir, record):
+        shutil.rmtree(running_dir)
+        if record.get("scratch_dir") is not None:
+            self.remove_scratch_dir(record["scratch_dir"])
+
+    def reattach(self, work_item, record):
+        """Take over waiting for a detached item an earlier run started."""
+        slot = record["slot"]
+        if slot in self.free_slots:
+            self.free_slots.remove(slot)
+            heapq.heapify(self.free_slots)
+        else:
+            slot = self.slot_count
+            self.slot_count += 1
+            os.makedirs(os.path.join(self.slot_dir, str(slot)), exist_ok=True)
+        staging_dir = record["staging_dir"]
+        self.work_in_progress[("reattached", record["pid"])] = WorkInProgress(
+            pid=record["pid"],
+            work_item=work_item,
+            slot=slot,
+            staging_dir=staging_dir,
+            base_dir=self.result_dir(work_item),
+            out_file=os.path.join(staging_dir, "out"),
+            err_file=os.path.join(staging_dir, "err"),
+            status_file=os.path.join(staging_dir, "status"),
+            started=time.monotonic() - (time.time() - record["started"]),
+            cache_key=record["cache_key"],
+            scratch_dir=record["scratch_dir"],
+            running_dir=self.running_dir(work_item, staging_dir),
+            speculative=record["speculative"],
+            checkpoint_dir=record["checkpoint_dir"],
+            reattached=True,
+        )
+
+    def running_dir(self, work_item, staging_dir):
+        """Where to keep track of 'work_item' running detached in 'staging_dir'."""
+        return os.path.join(
+            self.running_root, "%d-%s" % (work_item.stage, os.path.basename(staging_dir))
+        )
+
+    def checkpoint_dir(self, work_item):
+        """Where 'work_item' keeps its checkpoints, which every run of it
+        shares, other than speculative copies."""
+        return os.path.join(
+            self.stages[work_item.stage].destination, METADATA_DIR, CHECKPOINTS_DIR, work_item.name
+        )
+
+    def reduce(self, work_item):
+        """Fold the output of 'work_item', which has made it successfully
+        through every stage, into the aggregate."""
+        if self.aggregate is not None:
+            self.aggregate.add(work_item.name, os.path.join(self.result_dir(work_item), "out"))
+
+    def failure_key(self, work_item):
+        """Failures are counted separately for each stage an item goes through."""
+        if work_item.stage == 0:
+            return work_item.name
+        return (work_item.stage, work_item.name)
+
+    def retry_policy(self, status):
+        return self.retry_policies.get(status, BACKOFF)
+
+    def retry_delay_for(self, work_item, status):
+        """How long to wait before retrying 'work_item', which has just exited
+        with 'status', or None if it shouldn't be retried."""
+        if status == 0:
+            return None
+        return next_retry_delay(
+            self.failure_counts[self.failure_key(work_item)],
+            self.retries,
+            self.retry_policy(status),
+            self.retry_delay,
+            self.max_retry_delay,
+            self.random,
+        )
+
+    def retry(self, work_item, delay):
+        self.release_prefetched(work_item)
+        self.failure_counts[self.failure_key(work_item)] += 1
+        if delay == 0:
+            self.stage_queue(work_item.stage).append(work_item)
+        else:
+            heapq.heappush(
+                self.deferred, (time.monotonic() + delay, next(self.deferred_sequence), work_item)
+            )
 
-            base_dir = os.path.join(self.destination, work_item.name)
+    def release_deferred_work(self):
+        """Move retries that are now due onto the front of the queue."""
+        for work_item in release_due(self.deferred, time.monotonic()):
+            self.stage_queue(work_item.stage).append(work_item)
 
-            in_file = os.path.join(base_dir, "in")
-            out_file = os.path.join(base_dir, "out")
-            err_file = os.path.join(base_dir, "err")
-            status_file = os.path.join(base_dir, "status")
+    def result_dir(self, work_item):
+        return os.path.join(self.stages[work_item.stage].destination, work_item.name)
 
-            if os.path.exists(base_dir):
-                for f in [in_file, out_file, err_file, status_file]:
-                    if os.path.exists(f):
-                        os.unlink(f)
+    def previous_status(self, work_item):
+        """The exit status recorded for 'work_item' by a previous run, if any."""
+        try:
+            with open(os.path.join(self.result_dir(work_item), "status")) as i:
+                return int(i.read().strip())
+        except (ValueError, FileNotFoundError):
+            return None
+
+    def already_done(self, work_item):
+        """Whether a previous run has left a result for 'work_item' that we
+        should keep."""
+        previous_status = self.previous_status(work_item)
+
+        if previous_status is None:
+            return False
+
+        discard = not self.recreate
+
+        if discard and self.incremental:
+            discard = self.recorded_fingerprint(work_item) == self.fingerprint(work_item)
+
+        if (
+            previous_status != 0
+            and self.retries > 0
+            and self.retry_policy(previous_status) != NEVER
+        ):
+            self.failure_counts[self.failure_key(work_item)] += 1
+            discard = False
+        return discard
+
+    def pull_streamed_work(self):
+        """Move items that have arrived from our work source into the queue,
+        taking only as many as we have free slots for."""
+        while len(self.work_queue) < self.processes - len(self.work_in_progress):
+            idle = not (self.work_in_progress or self.has_queued_work() or self.deferred)
+            work_item = self.work_source.get(timeout=self.wait_timeout if idle else 0)
+            if work_item is None:
+                return
+            work_item = self.first_unfinished_stage(work_item)
+            if work_item is not None:
+                # Streamed items are run in the order they arrive.
+                self.stage_queue(work_item.stage).insert(0, work_item)
+
+    def item_size(self, work_item):
+        try:
+            return self.item_sizes[work_item.name]
+        except KeyError:
+            size = self.item_sizes[work_item.name] = work_item.size()
+            return size
+
+    def has_queued_work(self):
+        return bool(self.work_queue) or any(stage.queue for stage in self.stages)
+
+    def queued_count(self):
+        """How many items are waiting to run, whichever stage they're at."""
+        return len(self.work_queue) + sum(len(stage.queue) for stage in self.stages)
+
+    def has_pending_work(self):
+        if self.draining:
+            return bool(self.work_in_progress)
+        return bool(
+            self.work_in_progress
+            or self.has_queued_work()
+            or self.deferred
+            or (self.work_source is not None and not self.work_source.exhausted)
+        )
+
+    def fingerprint(self, work_item):
+        """What determines whether the result for 'work_item' is up to date."""
+        return {
+            "input": work_item.fingerprint(),
+            "command": self.stages[work_item.stage].command_hash,
+        }
+
+    def recorded_fingerprint(self, work_item):
+        try:
+            with open(os.path.join(self.result_dir(work_item), "fingerprint")) as i:
+                return json.load(i)
+        except (ValueError, FileNotFoundError):
+            return None
+
+    def report_progress(self):
+        with self.tracer.span("progress_callback"):
+            self.progress_callback()
+
+    def fill_work_in_progress(self):
+        self.tracer.counter("tasks", queued=self.queued_count(), running=len(self.work_in_progress))
+        if self.deferred:
+            self.release_deferred_work()
+        if self.work_source is not None:
+            self.pull_streamed_work()
+        while len(self.work_in_progress) < self.processes and not (self.paused or self.draining):
+            queue = self.next_queue()
+            if queue is None:
+                break
+            work_item = queue.pop()
+            if not work_item.exists():
+                self.release_prefetched(work_item)
+                self.report_progress()
+                continue
 
+            slot = heapq.heappop(self.free_slots)
+            staging_dir = self.prepare(work_item, slot)
+
+            cache_key = None
+            if self.cache is not None:
+                with self.tracer.span("cache lookup", slot_track(slot), item=work_item.name):
+                    stage = self.stages[work_item.stage]
+                    cache_key = self.cache.key(stage.command, self.shell, stage.stdin, work_item)
+                    hit = self.cache.fetch(cache_key, staging_dir)
+                if hit:
+                    publish(staging_dir, self.result_dir(work_item), staging_dir + ".old")
+                    self.record(work_item, 0, None)
+                    heapq.heappush(self.free_slots, slot)
+                    self.finish(work_item, 0)
+                    continue
+
+            self.launch(work_item, slot, staging_dir, cache_key=cache_key)
+
+        if self.prefetcher is not None:
+            with self.tracer.span("prefetch"):
+                self.prefetcher.prefetch(self.upcoming())
+        if self.speculate is not None:
+            self.speculate_on_stragglers()
+
+    def upcoming(self):
+        """Iterate over the queued items in the order they'll be started in,
+        as far as we can tell yet."""
+        for stage in self.stage_order:
+            yield from reversed(self.stage_queue(stage.index))
+
+    def release_prefetched(self, work_item):
+        if self.prefetcher is not None:
+            self.prefetcher.release(work_item)
+
+    def prepare(self, work_item, slot):
+        """Create a new staging directory to run 'work_item' in, and return it."""
+        prepare_started = self.tracer.now()
+        while True:
+            staging_dir = os.path.join(
+                self.stages[work_item.stage].staging_root,
+                "%d-%s" % (next(self.staging_sequence), work_item.name),
+            )
             try:
-                os.makedirs(base_dir)
+                os.mkdir(staging_dir)
+                break
             except FileExistsError:
-                pass
-
-            work_item.write_in_file(in_file)
-
-            pid = None
-            pid = os.fork()
-            if pid != 0:
-                self.work_in_progress[pid] = WorkInProgress(
-                    pid=pid,
-                    work_item=work_item,
-                    out_file=out_file,
-                    err_file=err_file,
-                    status_file=status_file,
-                    started=time.monotonic(),
+                # Kept for a detached item from an earlier run.
+                continue
+        work_item.write_in_file(os.path.join(staging_dir, "in"))
+        if self.incremental:
+            with open(os.path.join(staging_dir, "fingerprint"), "w") as o:
+                json.dump(self.fingerprint(work_item), o)
+        self.tracer.complete("prepare", slot_track(slot), prepare_started, item=work_item.name)
+        return staging_dir
+
+    def launch(self, work_item, slot, staging_dir, cache_key=None, speculative=False):
+        """Start running the command on 'work_item' in a child process."""
+        track = slot_track(slot)
+        stage = self.stages[work_item.stage]
+        out_file = os.path.join(staging_dir, "out")
+        err_file = os.path.join(staging_dir, "err")
+        status_file = os.path.join(staging_dir, "status")
+
+        if self.slot_cpus is not None:
+            with open(os.path.join(staging_dir, "affinity"), "w") as o:
+                print(format_cpu_list(self.slot_cpus[slot]), file=o)
+
+        scratch_dir = None
+        if self.scratch is not None:
+            if self.scratch_root is None:
+                self.scratch_root = tempfile.mkdtemp(
+                    prefix="each-", dir=os.path.abspath(self.scratch)
                 )
+            scratch_dir = os.path.join(self.scratch_root, os.path.basename(staging_dir))
+            os.mkdir(scratch_dir)
+
+        # Built here rather than in the child, so the child has as little to
+        # do as possible before it execs.
+        env = dict(
+            os.environ,
+            EACH_SLOT=str(slot),
+            EACH_SLOT_DIR=os.path.abspath(os.path.join(self.slot_dir, str(slot))),
+        )
+        if scratch_dir is not None:
+            env["EACH_SCRATCH_DIR"] = env["TMPDIR"] = scratch_dir
+        checkpoint_dir = None
+        if self.checkpoints:
+            if speculative:
+                # Next to its staging directory, so it's cleared away with
+                # the rest of the staging directories if we're interrupted.
+                checkpoint_dir = staging_dir + ".checkpoints"
             else:
+                checkpoint_dir = self.checkpoint_dir(work_item)
+            checkpoint_dir = os.path.abspath(checkpoint_dir)
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            env["EACH_CHECKPOINT_DIR"] = checkpoint_dir
+
+        running_dir = lock = None
+        if self.detach:
+            running_dir = self.running_dir(work_item, staging_dir)
+            os.makedirs(running_dir)
+            # Taken before forking, so there's no moment when the item is
+            # running but looks as if it isn't.
+            lock = hold_lock(running_dir)
+
+        fork_started = self.tracer.now()
+        pid = None
+        pid = os.fork()
+        if pid != 0:
+            self.tracer.complete("fork", track, fork_started, item=work_item.name, pid=pid)
+            if running_dir is None:
+                # The child does this too, but we don't know when, and
+                # until it has been done the item can't be killed as one.
                 try:
-                    original_err = os.dup(STDERR)
-                    original_out = os.dup(STDOUT)
-                    if self.stdin:
-                        filein = work_item.as_input_file()
-                        os.dup2(filein, STDIN)
-                    else:
-                        os.close(STDIN)
-                    flags = os.O_EXCL | os.O_CREAT | os.O_WRONLY
-                    err = os.open(err_file, flags)
-                    out = os.open(out_file, flags)
-                    os.dup2(err, STDERR)
-                    os.dup2(out, STDOUT)
-                    argv = [os.path.basename(self.shell), "-c", self.command]
-                    if not self.stdin:
-                        argv[-1] = argv[-1].replace("{}", shlex.quote(work_item.as_argument()))
-                    os.execv(self.shell, argv)
-                except:  # noqa
-                    os.dup2(original_out, STDOUT)
-                    os.dup2(original_err, STDERR)
-                    traceback.print_exc()
-                    os._exit(1)
+                    os.setpgid(pid, pid)
+                except PermissionError:
+                    # It has already exec'd, so had already done it.
+                    pass
+            else:
+                os.close(lock)
+                write_record(
+                    running_dir,
+                    {
+                        "name": work_item.name,
+                        "stage": work_item.stage,
+                        "slot": slot,
+                        "staging_dir": os.path.abspath(staging_dir),
+                        "scratch_dir": scratch_dir,
+                        "checkpoint_dir": checkpoint_dir,
+                        "speculative": speculative,
+                        "cache_key": cache_key,
+                        "started": time.time(),
+                        "pid": pid,
+                    },
+                )
+            self.work_in_progress[pid] = WorkInProgress(
+                pid=pid,
+                work_item=work_item,
+                slot=slot,
+                staging_dir=staging_dir,
+                base_dir=self.result_dir(work_item),
+                out_file=out_file,
+                err_file=err_file,
+                status_file=status_file,
+                started=time.monotonic(),
+                cache_key=cache_key,
+                speculative=speculative,
+                scratch_dir=scratch_dir,
+                running_dir=running_dir,
+                checkpoint_dir=checkpoint_dir,
+            )
+        else:
+            try:
+                original_err = os.dup(STDERR)
+                original_out = os.dup(STDOUT)
+                if stage.stdin:
+                    filein = work_item.as_input_file()
+                    os.dup2(filein, STDIN)
+                else:
+                    os.close(STDIN)
+                flags = os.O_EXCL | os.O_CREAT | os.O_WRONLY
+                err = os.open(err_file, flags)
+                out = os.open(out_file, flags)
+                os.dup2(err, STDERR)
+                os.dup2(out, STDOUT)
+                if self.slot_cpus is not None:
+                    os.sched_setaffinity(0, self.slot_cpus[slot])
+                argv = [os.path.basename(self.shell), "-c", stage.command]
+                if not stage.stdin:
+                    argv[-1] = argv[-1].replace("{}", shlex.quote(work_item.as_argument()))
+                if running_dir is not None:
+                    # A session of our own, so nothing sent to our parent's
+                    # terminal or process group reaches the item. We stay to
+                    # supervise, and the command runs in a child of ours.
+                    os.setsid()
+                    command_pid = os.fork()
+                    if command_pid != 0:
+                        supervise(command_pid, running_dir)
+                else:
+                    # A process group of our own, so that killing the item
+                    # kills everything it started too.
+                    os.setpgid(0, 0)
+                os.execve(self.shell, argv, env)
+            except:  # noqa
+                os.dup2(original_out, STDOUT)
+                os.dup2(original_err, STDERR)
+                traceback.print_exc()
+                os._exit(1)
+
+    def speculate_on_stragglers(self):
+        """Once there's nothing else left to start, run a second copy of any
+        item that has been running far longer than items usually take, in
+        case it's stuck on something particular to that attempt, e.g. a slow
+        machine or a lost network connection. The first copy to succeed is
+        kept and the other is killed. If one copy fails, the other is left to
+        finish, and only counts as a failure if it fails too."""
+        spare = self.processes - len(self.work_in_progress)
+        if (
+            self.has_queued_work()
+            or self.deferred
+            or spare <= 0
+            or self.paused
+            or self.draining
+            or len(self.runtimes) < MIN_RUNTIMES_TO_SPECULATE
+            or (self.work_source is not None and not self.work_source.exhausted)
+        ):
+            return
+        threshold = self.speculate * self.p99_runtime()
+        now = time.monotonic()
+        copies = Counter(w.work_item.name for w in self.work_in_progress.values())
+        stragglers = sorted(
+            (
+                w
+                for w in self.work_in_progress.values()
+                if copies[w.work_item.name] == 1
+                and not w.copy_failed
+                and now - w.started > threshold
+            ),
+            key=lambda w: w.started,
+        )
+        for straggler in stragglers[:spare]:
+            slot = heapq.heappop(self.free_slots)
+            staging_dir = self.prepare(straggler.work_item, slot)
+            self.launch(
+                straggler.work_item,
+                slot,
+                staging_dir,
+                cache_key=straggler.cache_key,
+                speculative=True,
+            )
+
+    def p99_runtime(self):
+        """The 99th percentile of the runtimes so far. This is only sorted
+        again once more have been recorded, as it's asked for every time
+        round the scheduling loop once the queue is empty."""
+        if len(self.sorted_runtimes) != len(self.runtimes):
+            self.sorted_runtimes = sorted(self.runtimes)
+        return percentile(self.sorted_runtimes, 99)
+
+    def kill(self, item_in_progress):
+        """Kill an item, along with anything it started. The process we
+        started it in, or its supervisor if it's detached, leads a process
+        group with everything else in it."""
+        try:
+            os.killpg(item_in_progress.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # Only possible for an item an earlier run started, which has
+            # exited, as our own children are kept around until we reap them.
+            assert item_in_progress.reattached
+
+    def cancel(self, key):
+        """Kill the running copy of an item, keyed by 'key' in
+        'work_in_progress', and throw away its results."""
+        item_in_progress = self.work_in_progress.pop(key)
+        with self.tracer.span(
+            "cancel", slot_track(item_in_progress.slot), item=item_in_progress.work_item.name
+        ):
+            self.kill(item_in_progress)
+            if not item_in_progress.reattached:
+                os.waitpid(item_in_progress.pid, 0)
+            self.discard(item_in_progress)
+
+    def discard(self, item_in_progress):
+        """Free the slot of a copy of an item that has stopped, and throw
+        away its results."""
+        heapq.heappush(self.free_slots, item_in_progress.slot)
+        shutil.rmtree(item_in_progress.staging_dir)
+        if item_in_progress.scratch_dir is not None:
+            self.remove_scratch_dir(item_in_progress.scratch_dir)
+        if item_in_progress.running_dir is not None:
+            shutil.rmtree(item_in_progress.running_dir)
+        self.clean_up_speculative_checkpoints(item_in_progress)
+
+    def clean_up_speculative_checkpoints(self, item_in_progress):
+        if item_in_progress.speculative and item_in_progress.checkpoint_dir is not None:
+            shutil.rmtree(item_in_progress.checkpoint_dir, ignore_errors=True)
+
+    def enforce_limits(self):
+        """Kill any item using more than 'scratch_quota' bytes of scratch
+        space, or writing more than 'max_output' or 'max_err' bytes. It's
+        collected as usual, with a status saying why it died."""
+        now = time.monotonic()
+        if (
+            self.scratch_quota is None and self.max_output is None and self.max_err is None
+        ) or now - self.limits_checked < self.wait_timeout:
+            return
+        self.limits_checked = now
+        for item_in_progress in self.work_in_progress.values():
+            if item_in_progress.killed_status is None:
+                item_in_progress.killed_status = self.broken_limit(item_in_progress)
+                if item_in_progress.killed_status is not None:
+                    # Even if it has just exited this is safe, as it isn't
+                    # reaped until we collect it.
+                    self.kill(item_in_progress)
+
+    def broken_limit(self, item_in_progress):
+        """The status to record for 'item_in_progress' if it's over one of our
+        limits, otherwise None."""
+        if (
+            self.scratch_quota is not None
+            and disk_usage(item_in_progress.scratch_dir) > self.scratch_quota
+        ):
+            return SCRATCH_QUOTA_EXCEEDED
+        if self.over_output_limits(item_in_progress):
+            return OUTPUT_LIMIT_EXCEEDED
+        return None
+
+    def output_limits(self, item_in_progress):
+        return [
+            (item_in_progress.out_file, self.max_output),
+            (item_in_progress.err_file, self.max_err),
+        ]
+
+    def over_output_limits(self, item_in_progress):
+        return any(
+            limit is not None and file_size(path) > limit
+            for path, limit in self.output_limits(item_in_progress)
+        )
+
+    def truncate_output(self, item_in_progress):
+        """Cut the output of an item killed for writing too much down to the
+        limits, keeping the start, where whatever went wrong began."""
+        for path, limit in self.output_limits(item_in_progress):
+            if limit is not None and file_size(path) > limit:
+                os.truncate(path, limit)
+
+    def clean_up_scratch(self, item_in_progress, status):
+        """Move the files to keep from the scratch directory of an item that
+        finished with 'status' into its results, and delete the rest."""
+        if item_in_progress.scratch_dir is None:
+            return
+        if status == 0:
+            for pattern in self.keep_scratch:
+                for path in sorted(
+                    glob.glob(os.path.join(glob.escape(item_in_progress.scratch_dir), pattern))
+                ):
+                    target = os.path.join(
+                        item_in_progress.staging_dir,
+                        os.path.relpath(path, item_in_progress.scratch_dir),
+                    )
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+        self.remove_scratch_dir(item_in_progress.scratch_dir)
+
+    def remove_scratch_dir(self, scratch_dir):
+        """Delete the scratch directory 'scratch_dir', and the directory it's
+        in too if an earlier run left that for its detached items, and this
+        was the last of them."""
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        scratch_root = os.path.dirname(scratch_dir)
+        if scratch_root != self.scratch_root:
+            try:
+                os.rmdir(scratch_root)
+            except OSError:
+                # Other detached items are still using it.
+                pass
 
     def collect_completed_work(self):
         best_timeout = self.wait_timeout
-
+        if len(self.work_in_progress) < self.processes:
+            if self.work_source is not None:
+                # We have free slots, so don't wait long before checking
+                # whether any new work has arrived for them.
+                best_timeout *= 0.05
+            if self.deferred:
+                # Nor past the point where a retry is due to take one.
+                best_timeout = min(best_timeout, self.deferred[0][0] - time.monotonic())
+                # A zero timeout would mean waiting forever.
+                best_timeout = max(best_timeout, 0.001)
+                if not self.work_in_progress:
+                    time.sleep(best_timeout)
+        if self.paused and not self.work_in_progress:
+            # Nothing can happen until we're resumed.
+            time.sleep(self.wait_timeout)
+
+        if self.detach:
+            self.collect_reattached_work()
         while self.work_in_progress:
+            if all(w.reattached for w in self.work_in_progress.values()):
+                # None of them are our children, so there's nothing to wait on.
+                time.sleep(best_timeout)
+                return
             try:
                 with timeout(best_timeout):
-                    pid, result = os.wait()
+                    # Only wait for a child to exit here, and reap it once the
+                    # timeout is cancelled. Otherwise the timeout can fire
+                    # just after a child is reaped, and we lose track of it.
+                    os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
             except Timeout:
                 return
+            pid, result = os.waitpid(-1, 0)
             # Once we've collected one task we want to time out very
             # quickly on the others so we don't delay rescheduling
             # work.
             best_timeout = 0.05 * self.wait_timeout
             item_in_progress = self.work_in_progress.pop(pid)
-            self.runtimes.append(time.monotonic() - item_in_progress.started)
+            if item_in_progress.running_dir is not None:
+                # We've collected the supervisor, which recorded how the
+                # command itself exited, unless it was killed too.
+                recorded = read_result(item_in_progress.running_dir)
+                if recorded is not None:
+                    result = recorded
+            self.complete(item_in_progress, exit_status(result))
+
+    def collect_reattached_work(self):
+        """Collect any items started by an earlier run that have finished."""
+        for key, item_in_progress in list(self.work_in_progress.items()):
+            if (
+                not item_in_progress.reattached
+                or key not in self.work_in_progress
+                or lock_is_held(item_in_progress.running_dir)
+            ):
+                continue
+            del self.work_in_progress[key]
+            result = read_result(item_in_progress.running_dir)
+            if result is None and item_in_progress.killed_status is None:
+                # It died with its supervisor, leaving nothing worth keeping,
+                # so it has to start again.
+                heapq.heappush(self.free_slots, item_in_progress.slot)
+                shutil.rmtree(item_in_progress.staging_dir, ignore_errors=True)
+                shutil.rmtree(item_in_progress.running_dir, ignore_errors=True)
+                if item_in_progress.scratch_dir is not None:
+                    self.remove_scratch_dir(item_in_progress.scratch_dir)
+                self.stage_queue(item_in_progress.work_item.stage).append(
+                    item_in_progress.work_item
+                )
+                continue
+            # If there's no result, it was us that killed it, and complete
+            # records why.
+            self.complete(item_in_progress, None if result is None else exit_status(result))
+
+    def complete(self, item_in_progress, status):
+        """Record the results of an item that has finished with 'status'."""
+        if item_in_progress.killed_status is not None:
+            status = item_in_progress.killed_status
+        elif self.over_output_limits(item_in_progress):
+            # It finished before we caught it.
+            status = OUTPUT_LIMIT_EXCEEDED
+        if status == OUTPUT_LIMIT_EXCEEDED:
+            self.truncate_output(item_in_progress)
+        if self.speculate is not None:
+            others = [
+                other
+                for other, w in self.work_in_progress.items()
+                if w.work_item.name == item_in_progress.work_item.name
+            ]
+            if status == 0:
+                # The first copy of an item to succeed wins.
+                for other in others:
+                    self.cancel(other)
+            elif others:
+                # The other copy may yet succeed, so only the last copy to
+                # fail counts.
+                for other in others:
+                    self.work_in_progress[other].copy_failed = True
+                with self.tracer.span(
+                    "discard",
+                    slot_track(item_in_progress.slot),
+                    item=item_in_progress.work_item.name,
+                    status=status,
+                ):
+                    self.discard(item_in_progress)
+                return
+        runtime = time.monotonic() - item_in_progress.started
+        self.runtimes.append(runtime)
+        if self.size_model:
+            self.observed_sizes.append(self.item_size(item_in_progress.work_item))
+        heapq.heappush(self.free_slots, item_in_progress.slot)
+        track = slot_track(item_in_progress.slot)
+        self.tracer.complete(
+            "run",
+            track,
+            self.tracer.now() - runtime * 1e6,
+            item=item_in_progress.work_item.name,
+            pid=item_in_progress.pid,
+            status=status,
+            speculative=item_in_progress.speculative,
+        )
+        with self.tracer.span("clean up scratch", track, item=item_in_progress.work_item.name):
+            self.clean_up_scratch(item_in_progress, status)
+        with self.tracer.span("write status", track, item=item_in_progress.work_item.name):
             with open(item_in_progress.status_file, "w") as o:
-                print(result >> 8, file=o)
-            if result != 0 and self.failure_counts[item_in_progress.work_item.name] < self.retries:
-                self.work_queue.append(item_in_progress.work_item)
-                self.failure_counts[item_in_progress.work_item.name] += 1
-            else:
-                self.progress_callback()
+                print(status, file=o)
+        if status == 0 and item_in_progress.cache_key is not None:
+            with self.tracer.span("cache store", track, item=item_in_progress.work_item.name):
+                self.cache.store(item_in_progress.cache_key, item_in_progress.staging_dir)
+        with self.tracer.span("publish", track, item=item_in_progress.work_item.name):
+            publish(
+                item_in_progress.staging_dir,
+                item_in_progress.base_dir,
+                item_in_progress.staging_dir + ".old",
+            )
+        if item_in_progress.running_dir is not None:
+            shutil.rmtree(item_in_progress.running_dir)
+        self.clean_up_speculative_checkpoints(item_in_progress)
+        if status == 0 and self.checkpoints:
+            # Only now that its results are safely in place.
+            shutil.rmtree(self.checkpoint_dir(item_in_progress.work_item), ignore_errors=True)
+        self.record(item_in_progress.work_item, status, runtime)
+        delay = self.retry_delay_for(item_in_progress.work_item, status)
+        if delay is not None:
+            self.retry(item_in_progress.work_item, delay)
+        else:
+            self.finish(item_in_progress.work_item, status)
+
+    def record(self, work_item, status, runtime):
+        """Add the result of 'work_item' to the index. 'runtime' is None if
+        the result came from the cache."""
+        if runtime is not None:
+            runtime = round(runtime, 6)
+        index = os.path.join(self.stages[work_item.stage].destination, METADATA_DIR, INDEX)
+        with open(index, "a") as o:
+            o.write(json.dumps([work_item.name, status, runtime]) + "\n")
+
+    def finish(self, work_item, status):
+        """Pass 'work_item' on to the next stage if it succeeded and there is
+        one, and otherwise count it as done."""
+        self.release_prefetched(work_item)
+        if status == 0:
+            next_item = self.next_stage(work_item)
+            if next_item is not None:
+                self.stage_queue(next_item.stage).insert(0, next_item)
+                return
+            self.reduce(work_item)
+        self.completed += 1
+        if status != 0:
+            self.failed += 1
+        self.report_progress()
 
     def update_predicted_timing(self):
-        assert (len(self.work_in_progress) == self.processes) or (len(self.work_queue) == 0)
+        assert (
+            len(self.work_in_progress) >= self.processes
+            or self.paused
+            or self.draining
+            or not self.has_queued_work()
+        )
         if not self.work_in_progress:
             return
         now = time.monotonic()
         if self.prediction is None or self.prediction[0] <= now - 2:
-            self.prediction = (
-                now,
-                predict_timing(
-                    historical_times=self.runtimes,
-                    current_queue=[now - w.started for w in self.work_in_progress.values()],
-                    remaining_tasks=len(self.work_queue),
-                    seed=self.random.getrandbits(32),
-                ),
+            self.prediction = (now, self.predict(list(self.work_in_progress.values())))
+            with self.tracer.span("prediction_callback"):
+                self.prediction_callback(self.prediction[1])
+
+    def predict(self, in_progress, parallelism=None):
+        """Predict how long it will take to finish the items 'in_progress'
+        and everything still to be run."""
+        # Imported here because it pulls in numpy, which dominates our
+        # startup time and isn't needed until the first prediction.
+        from each.prediction import predict_sized_timing, predict_timing
+
+        now = time.monotonic()
+        current_queue = [now - w.started for w in in_progress]
+        # Items' sizes are those of their input to the first stage, so say
+        # nothing about how long later stages will take.
+        if not (self.size_model and self.observed_sizes) or len(self.stages) > 1:
+            return predict_timing(
+                historical_times=self.runtimes,
+                current_queue=current_queue,
+                remaining_tasks=self.remaining_tasks(in_progress),
+                seed=self.random.getrandbits(32),
+                parallelism=parallelism,
+            )
+        remaining = list(reversed(self.work_queue)) + [item for _, _, item in sorted(self.deferred)]
+        # Only runtimes recorded in this run have sizes to go with them.
+        sized = len(self.runtimes) - len(self.observed_sizes)
+        return predict_sized_timing(
+            historical_times=self.runtimes[sized:],
+            historical_sizes=self.observed_sizes,
+            current_queue=current_queue,
+            current_sizes=[self.item_size(w.work_item) for w in in_progress],
+            remaining_sizes=[self.item_size(item) for item in remaining],
+            seed=self.random.getrandbits(32),
+            parallelism=parallelism,
+        )
+
+    def remaining_tasks(self, in_progress):
+        """How many more times we expect to run a command, counting each stage
+        still ahead of every item, other than those 'in_progress'."""
+        stages = len(self.stages)
+        return (
+            sum(len(self.stage_queue(s.index)) * (stages - s.index) for s in self.stages)
+            + sum(stages - item.stage for _, _, item in self.deferred)
+            + sum(stages - 1 - w.work_item.stage for w in in_progress)
+        )
+
+    def set_processes(self, processes):
+        """Change how many items may run at once. If that's fewer than are
+        running, we let them finish rather than stopping any."""
+        for slot in range(self.slot_count, processes):
+            heapq.heappush(self.free_slots, slot)
+            os.makedirs(os.path.join(self.slot_dir, str(slot)), exist_ok=True)
+        if processes > self.slot_count and self.pin is not None:
+            self.slot_cpus = slot_cpu_sets(processes, self.pin, numa_nodes())
+        self.slot_count = max(self.slot_count, processes)
+        self.processes = processes
+
+    def run_until_empty(self):
+        while self.has_pending_work():
+            if self.controller is not None:
+                self.controller.poll()
+            with self.tracer.span("fill_work_in_progress"):
+                self.fill_work_in_progress()
+            with self.tracer.span("update_predicted_timing"):
+                self.update_predicted_timing()
+            with self.tracer.span("collect_completed_work"):
+                self.collect_completed_work()
+            self.enforce_limits()
+            self.check_failure_rate(self.min_items_for_failure_rate)
+
+    def check_failure_rate(self, min_items):
+        if self.max_failure_rate is None or self.completed < max(min_items, 1):
+            return
+        if self.failed / self.completed > self.max_failure_rate:
+            # Let anything already running finish, but start nothing new.
+            while self.work_in_progress:
+                self.collect_completed_work()
+            raise RunAborted(
+                "%d of %d items failed, more than the maximum failure rate of %g"
+                % (self.failed, self.completed, self.max_failure_rate)
+            )
+
+    def run_pilot(self):
+        """Run a sample of 'pilot' items on their own, and report on them."""
+        # A random sample, even if the queue isn't in random order.
+        chosen = set(
+            self.random.sample(range(len(self.work_queue)), min(self.pilot, len(self.work_queue)))
+        )
+        rest = [item for i, item in enumerate(self.work_queue) if i not in chosen]
+        self.work_queue = [item for i, item in enumerate(self.work_queue) if i in chosen]
+        runtimes_before = len(self.runtimes)
+        with self.tracer.span("pilot"):
+            self.run_until_empty()
+        self.work_queue = rest
+
+        report = PilotReport(
+            items=self.completed,
+            failures=self.failed,
+            runtimes=sorted(self.runtimes[runtimes_before:]),
+            remaining=len(rest),
+            prediction=(
+                self.predict([], parallelism=self.processes) if rest and self.runtimes else None
+            ),
+        )
+        self.pilot_callback(report)
+
+        self.check_failure_rate(min_items=0)
+        if (
+            self.max_predicted_time is not None
+            and report.prediction is not None
+            and report.prediction.percentile(50) > self.max_predicted_time
+        ):
+            raise RunAborted(
+                "The remaining %d items are predicted to take %.0fs, more than the maximum of %gs"
+                % (report.remaining, report.prediction.percentile(50), self.max_predicted_time)
             )
-            self.prediction_callback(self.prediction[1])
 
     def clear_queue(self):
-        while self.work_in_progress or self.work_queue:
-            self.fill_work_in_progress()
-            self.update_predicted_timing()
-            self.collect_completed_work()
+        if self.control:
+            from each.control import SOCKET_NAME, ControlError, Controller
+
+            self.controller = Controller(
+                self, os.path.join(self.stages[0].destination, METADATA_DIR, SOCKET_NAME)
+            )
+            try:
+                self.controller.open()
+            except ControlError as e:
+                self.warning_callback("%s. Carrying on without taking commands." % (e,))
+                self.controller = None
+        try:
+            if self.pilot > 0:
+                self.run_pilot()
+            self.run_until_empty()
+        finally:
+            # Anything of ours that's still running is only because we were
+            # interrupted. Nothing else will stop it, as its process group
+            # isn't the terminal's, so we do.
+            for item_in_progress in self.work_in_progress.values():
+                if item_in_progress.running_dir is None:
+                    self.kill(item_in_progress)
+                    os.waitpid(item_in_progress.pid, 0)
+            if self.scratch_root is not None:
+                # Unless detached items we started are still using it, in
+                # which case the last of them to be collected by a later run
+                # removes it.
+                if not any(
+                    w.running_dir is not None and not w.reattached
+                    for w in self.work_in_progress.values()
+                ):
+                    shutil.rmtree(self.scratch_root, ignore_errors=True)
+                self.scratch_root = None
+            if self.controller is not None:
+                self.controller.close()
+                self.controller = None
+        if self.aggregate is not None:
+            self.aggregate.flush()
@@ -1,3 +1,5 @@
+import math
+import os
 import signal
 from contextlib import contextmanager
 
@@ -26,3 +28,51 @@ def timeout(seconds):
                 break
             except Timeout:
                 pass
+
+
+SIZE_SUFFIXES = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """Parse a human readable size like '10G' into a number of bytes."""
+    size = size.strip().upper()
+    if size.endswith("B"):
+        size = size[:-1]
+    suffix = size[-1:] if size[-1:] in SIZE_SUFFIXES else ""
+    return int(float(size[: len(size) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+
+
+def percentile(values, q):
+    """The 'q'th percentile of the sorted list 'values', by nearest rank."""
+    if not values:
+        return None
+    index = max(0, math.ceil(q / 100 * len(values)) - 1)
+    return values[index]
+
+
+def disk_usage(path):
+    """The space used by the files in the directory 'path', in bytes, counting
+    the blocks they take up rather than their apparent size."""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += disk_usage(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_blocks * 512
+        except FileNotFoundError:
+            # Deleted while we were looking.
+            pass
+    return total
+
+
+def file_size(path):
+    """The size of the file at 'path', or 0 if there isn't one yet."""
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
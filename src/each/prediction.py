@@ -17,8 +17,15 @@ class PredictedRuntime:
         return np.percentile(self.simulations, q)
 
 
-def predict_timing(historical_times, current_queue, remaining_tasks, seed=0):
-    parallelism = len(current_queue)
+def predict_timing(historical_times, current_queue, remaining_tasks, seed=0, parallelism=None):
+    """Simulate how long it will take to finish 'current_queue' (the elapsed
+    times of the tasks in progress) and 'remaining_tasks' more tasks.
+
+    'parallelism' defaults to the number of tasks in progress, but can be set
+    higher to predict for slots that are currently free.
+    """
+    if parallelism is None:
+        parallelism = len(current_queue)
     current_queue = np.array(current_queue)
     current_predictions = npr.exponential(current_queue)
     task_times = np.concatenate((current_predictions, np.array(historical_times)))
@@ -28,18 +35,96 @@ def predict_timing(historical_times, current_queue, remaining_tasks, seed=0):
     def simulate():
         runtimes = npr.choice(task_times, size=remaining_tasks)
         runtimes = np.concatenate((current_predictions, npr.exponential(runtimes)))
+        return simulate_schedule(runtimes, parallelism)
+
+    simulations = np.array([simulate() for _ in range(200)])
+
+    return PredictedRuntime(simulations)
 
-        schedules = []
-        for t in runtimes[:parallelism]:
-            heapq.heappush(schedules, t)
 
-        clock = 0.0
+def simulate_schedule(runtimes, parallelism):
+    """How long it takes 'parallelism' slots to run tasks taking 'runtimes',
+    started in that order, each as soon as a slot is free."""
+    schedules = []
+    for t in runtimes[:parallelism]:
+        heapq.heappush(schedules, t)
 
-        for t in runtimes[parallelism:]:
-            clock = heapq.heappop(schedules)
-            heapq.heappush(schedules, t + clock)
+    clock = 0.0
+
+    for t in runtimes[parallelism:]:
+        clock = heapq.heappop(schedules)
+        heapq.heappush(schedules, t + clock)
+
+    return max(schedules)
+
+
+@attr.s(slots=True)
+class SizeModel:
+    """Runtimes as a linear function of item size, times a noise ratio
+    resampled from the ratios of observed to fitted runtimes."""
 
-        return max(schedules)
+    intercept = attr.ib()
+    slope = attr.ib()
+    """The shortest runtime we predict, so that a negative intercept doesn't
+    have us believe small items take no time at all."""
+    floor = attr.ib()
+    ratios = attr.ib(default=None)
+
+    @classmethod
+    def fit(cls, sizes, times):
+        sizes = np.asarray(sizes, dtype=float)
+        times = np.asarray(times, dtype=float)
+        intercept = times.mean()
+        slope = 0.0
+        if len(np.unique(sizes)) >= 2:
+            fitted_slope, fitted_intercept = np.polyfit(sizes, times, 1)
+            # Runtimes that fall with size are almost certainly noise, so
+            # we're better off ignoring size altogether.
+            if fitted_slope > 0:
+                slope, intercept = fitted_slope, fitted_intercept
+        model = cls(intercept=intercept, slope=slope, floor=max(times.mean() * 0.01, 1e-9))
+        model.ratios = times / model.expected(sizes)
+        return model
+
+    def expected(self, sizes):
+        return np.maximum(self.intercept + self.slope * np.asarray(sizes, dtype=float), self.floor)
+
+    def sample(self, sizes):
+        return self.expected(sizes) * npr.choice(self.ratios, size=len(sizes))
+
+
+def predict_sized_timing(
+    historical_times,
+    historical_sizes,
+    current_queue,
+    current_sizes,
+    remaining_sizes,
+    seed=0,
+    parallelism=None,
+):
+    """Like ``predict_timing``, but for tasks whose runtime depends on their
+    size.
+
+    Runtimes are predicted from a ``SizeModel`` fitted to the sizes and
+    times of the tasks seen so far, so a sample of unusually small tasks
+    doesn't make us expect the rest to be small too. 'remaining_sizes' are in
+    the order the tasks will be started.
+    """
+    if parallelism is None:
+        parallelism = len(current_queue)
+    npr.seed(seed)
+    model = SizeModel.fit(historical_sizes, historical_times)
+    current_queue = np.array(current_queue, dtype=float)
+
+    def simulate():
+        current = model.sample(current_sizes) - current_queue
+        # Tasks that have already run longer than we'd expect could finish
+        # any moment or take much longer, so we fall back to the same guess
+        # as ``predict_timing``.
+        overdue = current <= 0
+        current[overdue] = npr.exponential(current_queue[overdue])
+        runtimes = np.concatenate((current, model.sample(remaining_sizes)))
+        return simulate_schedule(runtimes, parallelism)
 
     simulations = np.array([simulate() for _ in range(200)])
 
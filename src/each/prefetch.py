@@ -0,0 +1,52 @@
+"""Reading the inputs of upcoming items before they're needed.
+
+When the source is on slow storage, e.g. spinning disks or a network
+filesystem, every command can spend much of its time waiting for its input
+to be read. We know which items will be started next, so we can ask the OS
+to start reading their inputs while the current ones run.
+
+Prefetching too far ahead would push inputs out of memory before their
+commands get to them, or while they're still reading them, so how much we
+prefetch is bounded by a byte budget, which counts each prefetched input
+until the item it belongs to has finished running.
+"""
+
+from itertools import islice
+
+import attr
+
+
+@attr.s()
+class Prefetcher(object):
+    """Prefetches the inputs of up to 'depth' upcoming items, so long as
+    those and the inputs of items prefetched earlier that haven't finished
+    yet come to at most 'budget' bytes."""
+
+    depth = attr.ib()
+    budget = attr.ib()
+    size = attr.ib(default=lambda work_item: work_item.size())
+    """The sizes of the items we've prefetched and not yet released, keyed
+    by stage and name."""
+    held = attr.ib(default=attr.Factory(dict), init=False)
+    held_bytes = attr.ib(default=0, init=False)
+
+    def prefetch(self, upcoming):
+        """Prefetch what we can of the items 'upcoming', which are in the
+        order they'll be started."""
+        for work_item in islice(upcoming, self.depth):
+            key = (work_item.stage, work_item.name)
+            if key in self.held:
+                continue
+            size = self.size(work_item)
+            if self.held_bytes + size > self.budget:
+                # Skipping this one for a smaller one after it would only
+                # fetch something we need later ahead of what we need sooner.
+                break
+            work_item.prefetch()
+            self.held[key] = size
+            self.held_bytes += size
+
+    def release(self, work_item):
+        """Stop counting the input of 'work_item' against our budget, as
+        whatever was running it is done with it."""
+        self.held_bytes -= self.held.pop((work_item.stage, work_item.name), 0)
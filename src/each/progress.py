@@ -0,0 +1,157 @@
+"""Reporting how far through its work ``Each`` is.
+
+A reporter is called once per finished item and once per new prediction, so
+these calls need to be cheap: anything expensive happens at most once per
+display refresh, or on a timer of its own.
+"""
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import attr
+
+TTY = "tty"
+JSONL = "jsonl"
+NONE = "none"
+PROGRESS_MODES = (TTY, JSONL, NONE)
+
+
+@attr.s()
+class NullProgress(object):
+    """Reports nothing, except messages to stderr."""
+
+    def update(self):
+        pass
+
+    def new_prediction(self, prediction):
+        pass
+
+    def write(self, message):
+        print(message, file=sys.stderr)
+
+    @contextmanager
+    def running(self, each):
+        yield
+
+
+@attr.s()
+class TqdmProgress(object):
+    """A progress bar with an ETA, for humans watching a terminal."""
+
+    bar = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        # Imported here because it's slow to import, and not needed when
+        # running headless.
+        from tqdm import tqdm
+
+        self.bar = tqdm()
+
+    def update(self):
+        self.bar.update()
+
+    def new_prediction(self, prediction):
+        now = datetime.now()
+        eta = now + timedelta(seconds=prediction.percentile(99))
+
+        if (eta - now <= timedelta(days=1)) and eta.day == now.day:
+            self.bar.set_postfix(eta=eta.strftime("%H:%M:%S"))
+        else:
+            self.bar.set_postfix(eta=eta.strftime("%Y-%m-%d %H:%M"))
+
+    def write(self, message):
+        self.bar.write(message, file=sys.stderr)
+
+    @contextmanager
+    def running(self, each):
+        self.bar.total = None if each.streaming else self.bar.n + each.queued_count()
+        self.bar.refresh()
+        try:
+            yield
+        finally:
+            self.bar.close()
+
+
+@attr.s()
+class JsonlProgress(object):
+    """Writes a JSON record of progress so far to 'stream' every 'interval'
+    seconds, however fast or slowly items are finishing, and once more at the
+    end.
+
+    Each record has the number of items ``done`` (including ones skipped
+    because they were done in an earlier run), how many of those ``failed``
+    in this run, how many are ``in_flight`` and ``queued``, the ``rate`` in
+    items per second since the previous record, and the p50 and p99 of the
+    predicted seconds until we're finished.
+    """
+
+    stream = attr.ib(default=sys.stderr)
+    interval = attr.ib(default=10.0)
+    clock = attr.ib(default=time.monotonic)
+    done = attr.ib(default=0, init=False)
+    prediction = attr.ib(default=None, init=False)
+    predicted_at = attr.ib(default=None, init=False)
+
+    def __attrs_post_init__(self):
+        self.started = self.last_time = self.clock()
+        self.last_done = 0
+        # Records come from a thread of our own, other messages from the main
+        # one, and we don't want them interleaved.
+        self.lock = threading.Lock()
+
+    def update(self):
+        self.done += 1
+
+    def new_prediction(self, prediction):
+        self.prediction = prediction
+        self.predicted_at = self.clock()
+
+    def write(self, message):
+        with self.lock:
+            print(message, file=self.stream, flush=True)
+
+    def record(self, each):
+        now = self.clock()
+        done = self.done
+        elapsed = now - self.last_time
+        record = {
+            "elapsed": round(now - self.started, 3),
+            "done": done,
+            "failed": each.failed,
+            "in_flight": len(each.work_in_progress),
+            "queued": each.queued_count() + len(each.deferred),
+            "rate": round((done - self.last_done) / elapsed, 3) if elapsed > 0 else None,
+            "eta_p50": None,
+            "eta_p99": None,
+        }
+        if self.prediction is not None:
+            since = now - self.predicted_at
+            for q in (50, 99):
+                record["eta_p%d" % (q,)] = round(max(0.0, self.prediction.percentile(q) - since), 3)
+        self.last_time = now
+        self.last_done = done
+        return record
+
+    def report(self, each):
+        self.write(json.dumps(self.record(each), sort_keys=True))
+
+    @contextmanager
+    def running(self, each):
+        stop = threading.Event()
+
+        def report_periodically():
+            while not stop.wait(self.interval):
+                self.report(each)
+
+        reporter = threading.Thread(target=report_periodically, daemon=True)
+        reporter.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            reporter.join()
+            self.report(each)
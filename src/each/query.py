@@ -0,0 +1,113 @@
+"""Summarising the results in a destination directory.
+
+``Each`` appends a line to ``.each/index`` in the destination for every item
+it finishes, so most of what we need to know can be read from that one file.
+Only items the index doesn't cover, e.g. ones written by an older version of
+each or by a run that was interrupted, have their ``status`` files read, and
+those are read in parallel.
+"""
+
+import json
+import os
+from collections import Counter
+
+import attr
+
+from each.each import INDEX, METADATA_DIR
+from each.junkdrawer import percentile
+
+
+@attr.s()
+class ResultSummary(object):
+    """How the items in a destination went."""
+
+    """The number of items with each exit status. Items with no status yet,
+    e.g. because they were interrupted, are counted under None."""
+    statuses = attr.ib(default=attr.Factory(Counter))
+    """The sorted names of items that exited with a non-zero status."""
+    failed = attr.ib(default=attr.Factory(list))
+    """The runtimes of the items recorded in the index, in seconds, other
+    than those whose results came from the cache."""
+    runtimes = attr.ib(default=attr.Factory(list))
+
+    @property
+    def items(self):
+        return sum(self.statuses.values())
+
+    @property
+    def succeeded(self):
+        return self.statuses[0]
+
+    @property
+    def unfinished(self):
+        return self.statuses[None]
+
+    def runtime_percentile(self, q):
+        return percentile(self.runtimes, q)
+
+
+def read_index(destination):
+    """Return the (status, runtime) the index in 'destination' records for
+    each item by name. Later lines replace earlier ones, as they come from
+    later runs of the item. The runtime is None if the result came from the
+    cache."""
+    index = {}
+    try:
+        with open(os.path.join(destination, METADATA_DIR, INDEX)) as i:
+            for line in i:
+                try:
+                    name, status, runtime = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interruption.
+                    continue
+                index[name] = (status, runtime)
+    except FileNotFoundError:
+        pass
+    return index
+
+
+def read_status(path):
+    try:
+        with open(os.path.join(path, "status")) as i:
+            return int(i.read().strip())
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def summarise(destination, workers=32):
+    """Summarise the results in 'destination' as a ``ResultSummary``."""
+    index = read_index(destination)
+    summary = ResultSummary()
+    unindexed = []
+    with os.scandir(destination) as entries:
+        for entry in entries:
+            if entry.name == METADATA_DIR or not entry.is_dir():
+                continue
+            try:
+                status, runtime = index[entry.name]
+            except KeyError:
+                unindexed.append(entry)
+                continue
+            summary.statuses[status] += 1
+            if runtime is not None:
+                summary.runtimes.append(runtime)
+            if status != 0:
+                summary.failed.append(entry.name)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(workers) as pool:
+        statuses = pool.map(read_status, [entry.path for entry in unindexed])
+        for entry, status in zip(unindexed, statuses):
+            summary.statuses[status] += 1
+            if status not in (0, None):
+                summary.failed.append(entry.name)
+
+    summary.failed.sort()
+    summary.runtimes.sort()
+    return summary
+
+
+def failures(destination, workers=32):
+    """The sorted names of the items in 'destination' that failed."""
+    return summarise(destination, workers).failed
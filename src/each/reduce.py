@@ -0,0 +1,196 @@
+"""Folding the outputs of items into a running aggregate as they finish.
+
+The aggregate is checkpointed under ``.each/reduce`` in the destination:
+
+* ``aggregate-N`` is the Nth version of the aggregate.
+* ``aggregate`` is a symlink to the latest complete version.
+* ``log`` records which items went into which version, one ``N<TAB>name``
+  line per item.
+
+A new version is written in full and added to the log before the symlink is
+moved to it, so after an interruption we resume from whatever the symlink
+points to and ignore anything in the log from a later version.
+"""
+
+import os
+import shutil
+import subprocess
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+import attr
+
+
+class Reducer(ABC):
+    """Combines the outputs of many items into one.
+
+    Combining must be associative: combining some files and then combining
+    the result with others must give the same as combining them all at
+    once. The order of the inputs is always kept, so it needn't be
+    commutative.
+    """
+
+    @abstractmethod
+    def combine(self, inputs, output):
+        """Combine the files at the paths 'inputs' into a new file at 'output'."""
+
+
+@attr.s()
+class CommandReducer(Reducer):
+    """Combines files by running a shell command with their paths as its
+    arguments, i.e. as ``"$@"``, and keeping what it writes to stdout."""
+
+    command = attr.ib()
+    shell = attr.ib()
+
+    def combine(self, inputs, output):
+        with open(output, "wb") as o:
+            subprocess.run(
+                [self.shell, "-c", self.command, "reduce"] + list(inputs), stdout=o, check=True
+            )
+
+
+@attr.s()
+class Aggregate(object):
+    """A running aggregate of item outputs, checkpointed in 'path'.
+
+    Outputs are folded in batches of 'batch_size', or whatever has arrived
+    after 'interval' seconds. Batches bigger than 'fan_in' are first combined
+    in groups of 'fan_in' by up to 'workers' combines at once.
+
+    Folding happens in the calling thread, as ``Each`` reaps any child
+    process that exits, so mustn't be waiting for children while a reducer
+    runs commands of its own.
+    """
+
+    path = attr.ib()
+    reducer = attr.ib()
+    batch_size = attr.ib(default=100)
+    interval = attr.ib(default=10.0)
+    fan_in = attr.ib(default=64)
+    workers = attr.ib(default=1)
+    clock = attr.ib(default=time.monotonic)
+    """The version of the aggregate that the ``aggregate`` symlink points to,
+    or 0 if there isn't one yet."""
+    generation = attr.ib(default=0, init=False)
+    """The names of the items in that version."""
+    included = attr.ib(default=attr.Factory(set), init=False)
+    """Items waiting to be folded in, as (name, path) pairs."""
+    pending = attr.ib(default=attr.Factory(list), init=False)
+    pending_names = attr.ib(default=attr.Factory(set), init=False)
+
+    def __attrs_post_init__(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.last_fold = self.clock()
+        self.load()
+
+    @property
+    def link(self):
+        return os.path.join(self.path, "aggregate")
+
+    @property
+    def log(self):
+        return os.path.join(self.path, "log")
+
+    @property
+    def scratch(self):
+        return os.path.join(self.path, "tmp")
+
+    def version(self, generation):
+        return os.path.join(self.path, "aggregate-%d" % (generation,))
+
+    @property
+    def current(self):
+        """The path of the latest complete aggregate, if there is one."""
+        return self.version(self.generation) if self.generation else None
+
+    def load(self):
+        try:
+            self.generation = int(os.readlink(self.link).rsplit("-", 1)[1])
+        except FileNotFoundError:
+            self.generation = 0
+
+        entries = []
+        try:
+            with open(self.log) as i:
+                for line in i:
+                    generation, name = line.rstrip("\n").split("\t", 1)
+                    entries.append((int(generation), name))
+        except FileNotFoundError:
+            pass
+        kept = [(g, name) for g, name in entries if g <= self.generation]
+        if len(kept) < len(entries):
+            # We were interrupted while writing a newer version.
+            with open(self.log + ".tmp", "w") as o:
+                o.writelines("%d\t%s\n" % entry for entry in kept)
+            os.replace(self.log + ".tmp", self.log)
+        self.included = {name for _, name in kept}
+
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if path == self.link + ".tmp" or (
+                name.startswith("aggregate-") and path != self.current
+            ):
+                os.unlink(path)
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def reset(self):
+        """Throw away the aggregate and start again from nothing."""
+        self.pending = []
+        self.pending_names.clear()
+        shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.load()
+
+    def add(self, name, path):
+        """Fold the output at 'path' of the item 'name' into the aggregate,
+        unless it's in there already."""
+        if name in self.included or name in self.pending_names:
+            return
+        self.pending.append((name, path))
+        self.pending_names.add(name)
+        if len(self.pending) >= self.batch_size or self.clock() - self.last_fold >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Fold in everything added so far."""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.last_fold = self.clock()
+        names = [name for name, _ in batch]
+        os.makedirs(self.scratch, exist_ok=True)
+        paths = self.combine_in_groups([path for _, path in batch])
+
+        generation = self.generation + 1
+        output = self.version(generation)
+        self.reducer.combine(([self.current] if self.current else []) + paths, output)
+        with open(self.log, "a") as o:
+            o.writelines("%d\t%s\n" % (generation, name) for name in names)
+        os.symlink(os.path.basename(output), self.link + ".tmp")
+        os.replace(self.link + ".tmp", self.link)
+
+        previous = self.current
+        self.generation = generation
+        self.included.update(names)
+        self.pending_names.clear()
+        if previous is not None:
+            os.unlink(previous)
+        shutil.rmtree(self.scratch)
+
+    def combine_in_groups(self, paths):
+        """Combine 'paths' in groups until there are at most 'fan_in' left,
+        and return the paths of what's left."""
+        partials = count()
+        with ThreadPoolExecutor(self.workers) as pool:
+            while len(paths) > self.fan_in:
+                groups = []
+                for start in range(0, len(paths), self.fan_in):
+                    end = start + self.fan_in
+                    groups.append(paths[start:end])
+                outputs = [os.path.join(self.scratch, str(next(partials))) for _ in groups]
+                list(pool.map(self.reducer.combine, groups, outputs))
+                paths = outputs
+        return paths
@@ -0,0 +1,253 @@
+"""Simulating how ``Each`` would schedule a run, on a virtual clock.
+
+``simulate`` follows the same rules as ``Each``, and shares the code that
+makes its decisions: items are shuffled and then ordered by the chosen
+policy, started as soon as a slot is free, and failed items are retried
+immediately or after a backoff, according to the retry policy. Nothing is
+actually run, so a long run can be simulated in moments with the runtimes of
+a real one, or made up ones, to see how each ordering would fare and how good
+the predictions made along the way would have been.
+"""
+
+import heapq
+import math
+from collections import Counter
+from itertools import count
+from random import Random
+
+import attr
+
+from each.each import (
+    BACKOFF,
+    LARGEST_FIRST,
+    ORDERS,
+    RANDOM,
+    next_retry_delay,
+    order_queue,
+    release_due,
+)
+from each.junkdrawer import percentile
+from each.query import read_index
+
+"""Longest processing time first: run items in order of how long they
+actually take. ``Each`` can't do this, as it doesn't know runtimes in
+advance, but it's the yardstick the other orders are measured against."""
+LONGEST_FIRST = "longest-first"
+POLICIES = ORDERS + (LONGEST_FIRST,)
+
+"""Distributions that ``synthetic_items`` can draw the ratio of an item's
+runtime to its size from."""
+LOGNORMAL = "lognormal"
+EXPONENTIAL = "exponential"
+PARETO = "pareto"
+DISTRIBUTIONS = (LOGNORMAL, EXPONENTIAL, PARETO)
+
+
+@attr.s()
+class SimulatedItem(object):
+    name = attr.ib()
+    """How long every attempt at the item takes, in seconds."""
+    runtime = attr.ib()
+    size = attr.ib(default=0)
+    """How many attempts at the item fail before one succeeds."""
+    failures = attr.ib(default=0)
+
+
+@attr.s()
+class SimulationResult(object):
+    """How a simulated run went."""
+
+    policy = attr.ib()
+    """How long the whole run took, in seconds."""
+    makespan = attr.ib()
+    """The fraction of the time slots spent running items, between 0 and 1."""
+    utilisation = attr.ib()
+    """How many items still failed after all their retries."""
+    failed = attr.ib()
+    """The predictions made during the run, as (when, predicted p50 of the
+    time left, actual time left) triples."""
+    predictions = attr.ib(default=attr.Factory(list))
+
+    @property
+    def eta_errors(self):
+        """How far out each prediction was, as (when, error) pairs. An error
+        of 0.5 means we predicted 50% longer than it took."""
+        return [
+            (when, (predicted - actual) / actual)
+            for when, predicted, actual in self.predictions
+            if actual > 0
+        ]
+
+    @property
+    def median_eta_error(self):
+        """The median size of the errors in 'eta_errors', or None if there
+        were no predictions."""
+        return percentile(sorted(abs(error) for _, error in self.eta_errors), 50)
+
+
+def order_items(items, policy, random):
+    """Put 'items' in a queue in the order 'policy' says, as ``Each`` would.
+    Like ``Each.work_queue``, the queue is run from the end."""
+    queue = list(items)
+    if policy == LONGEST_FIRST:
+        order_queue(queue, LARGEST_FIRST, random, lambda item: item.runtime)
+    else:
+        order_queue(queue, policy, random, lambda item: item.size)
+    return queue
+
+
+def simulate(
+    items,
+    processes,
+    policy=RANDOM,
+    retries=0,
+    retry_policy=BACKOFF,
+    retry_delay=1.0,
+    max_retry_delay=60.0,
+    size_model=False,
+    prediction_interval=None,
+    seed=0,
+):
+    """Simulate running 'items' with 'processes' slots, and return a
+    ``SimulationResult``.
+
+    If 'prediction_interval' is set, we predict the time left as ``Each``
+    would, with or without its 'size_model', once an item has finished and
+    then at most every 'prediction_interval' seconds. This is by far the
+    slowest part of the simulation.
+    """
+    random = Random(seed)
+    queue = order_items(items, policy, random)
+    free_slots = list(range(processes))
+    sequence = count()
+    # Items in progress, as a heap of (finish, sequence, slot, item, started).
+    running = []
+    # Items waiting to be retried, as a heap of (when, sequence, item).
+    deferred = []
+    failure_counts = Counter()
+    runtimes = []
+    sizes = []
+    busy = 0.0
+    failed = 0
+    predictions = []
+    last_prediction = None
+    clock = 0.0
+
+    while queue or running or deferred:
+        queue.extend(release_due(deferred, clock))
+        while queue and free_slots:
+            item = queue.pop()
+            slot = heapq.heappop(free_slots)
+            heapq.heappush(running, (clock + item.runtime, next(sequence), slot, item, clock))
+
+        if (
+            prediction_interval is not None
+            and running
+            and runtimes
+            and (last_prediction is None or clock - last_prediction >= prediction_interval)
+        ):
+            last_prediction = clock
+            prediction = predict(runtimes, sizes, clock, running, queue, deferred, size_model, seed)
+            predictions.append((clock, prediction.percentile(50)))
+
+        clock = min(([running[0][0]] if running else []) + ([deferred[0][0]] if deferred else []))
+        while running and running[0][0] <= clock:
+            finish, _, slot, item, started = heapq.heappop(running)
+            heapq.heappush(free_slots, slot)
+            busy += finish - started
+            runtimes.append(finish - started)
+            sizes.append(item.size)
+            if failure_counts[item.name] >= item.failures:
+                continue
+            delay = next_retry_delay(
+                failure_counts[item.name],
+                retries,
+                retry_policy,
+                retry_delay,
+                max_retry_delay,
+                random,
+            )
+            if delay is None:
+                failed += 1
+                continue
+            failure_counts[item.name] += 1
+            if delay == 0:
+                queue.append(item)
+            else:
+                heapq.heappush(deferred, (clock + delay, next(sequence), item))
+
+    return SimulationResult(
+        policy=policy,
+        makespan=clock,
+        utilisation=busy / (clock * processes) if clock > 0 else 1.0,
+        failed=failed,
+        predictions=[(when, predicted, clock - when) for when, predicted in predictions],
+    )
+
+
+def predict(runtimes, sizes, clock, running, queue, deferred, size_model, seed):
+    # Imported here for the same reason as in ``Each.predict``.
+    from each.prediction import predict_sized_timing, predict_timing
+
+    current_queue = [clock - started for _, _, _, _, started in running]
+    if size_model:
+        return predict_sized_timing(
+            historical_times=runtimes,
+            historical_sizes=sizes,
+            current_queue=current_queue,
+            current_sizes=[item.size for _, _, _, item, _ in running],
+            remaining_sizes=[item.size for _, _, item in deferred]
+            + [item.size for item in reversed(queue)],
+            seed=seed,
+        )
+    return predict_timing(
+        historical_times=runtimes,
+        current_queue=current_queue,
+        remaining_tasks=len(queue) + len(deferred),
+        seed=seed,
+    )
+
+
+def synthetic_items(n, distribution=LOGNORMAL, failure_rate=0.0, seed=0):
+    """Make up 'n' items with lognormally distributed sizes, and runtimes of
+    about a second per thousand bytes times noise from 'distribution'. A
+    'failure_rate' fraction of them fail once before succeeding."""
+    random = Random(seed)
+    noise = {
+        LOGNORMAL: lambda: random.lognormvariate(0, 0.5),
+        EXPONENTIAL: lambda: random.expovariate(1),
+        # Heavy tailed, but with a finite mean of 1.
+        PARETO: lambda: random.paretovariate(2) / 2,
+    }[distribution]
+    items = []
+    for i in range(n):
+        size = max(1, int(random.lognormvariate(math.log(1000), 1)))
+        items.append(
+            SimulatedItem(
+                name=str(i),
+                runtime=size / 1000 * noise(),
+                size=size,
+                failures=int(random.random() < failure_rate),
+            )
+        )
+    return items
+
+
+def items_from_results(destination, sizes=None):
+    """Make items with the runtimes recorded in the index of 'destination'.
+
+    Items that failed there fail every time here, and items whose results
+    came from the cache are left out, as how long they take is unknown.
+    'sizes' maps item names to their sizes, which are otherwise unknown.
+    """
+    sizes = sizes or {}
+    return [
+        SimulatedItem(
+            name=name,
+            runtime=runtime,
+            size=sizes.get(name, 0),
+            failures=0 if status == 0 else math.inf,
+        )
+        for name, (status, runtime) in sorted(read_index(destination).items())
+        if runtime is not None
+    ]
@@ -0,0 +1,56 @@
+"""Work sources that produce items while ``Each`` is already running them."""
+
+import queue
+import threading
+
+import attr
+
+"""Put on the queue after the last item."""
+END = object()
+
+
+@attr.s()
+class StreamingWorkSource(object):
+    """Reads work items from an iterable in a background thread.
+
+    At most 'buffer_size' items are read ahead of what ``Each`` has taken. Once
+    the buffer is full the reading thread blocks, so e.g. a producer writing to
+    our stdin is held up until we catch up with it.
+    """
+
+    items = attr.ib()
+    buffer_size = attr.ib(default=1000)
+    exhausted = attr.ib(default=False, init=False)
+    error = attr.ib(default=None, init=False)
+
+    def __attrs_post_init__(self):
+        self.queue = queue.Queue(maxsize=self.buffer_size)
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        try:
+            for item in self.items:
+                self.queue.put(item)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.queue.put(END)
+
+    def get(self, timeout=0):
+        """Return the next item, waiting up to 'timeout' seconds for one.
+
+        Returns None if no item arrived in time or the source is exhausted.
+        """
+        if self.exhausted:
+            return None
+        try:
+            item = self.queue.get(block=timeout > 0, timeout=timeout if timeout > 0 else None)
+        except queue.Empty:
+            return None
+        if item is END:
+            self.exhausted = True
+            if self.error is not None:
+                raise self.error
+            return None
+        return item
@@ -0,0 +1,124 @@
+"""Task lifecycle tracing in the Chrome trace event format.
+
+The resulting files can be loaded into ``chrome://tracing`` or
+https://ui.perfetto.dev to see what the scheduler and each of its slots were
+doing over time.
+
+Children are only visible to us between ``fork`` and being reaped, so the
+``run`` span of a task covers its exec, its actual run and its exit. Tasks
+don't get a span for the time they spend queued, as most are queued at once
+when the run starts, so these would just be one span per task starting at
+zero. The ``tasks`` counter shows how many are waiting instead.
+
+Events are written as they happen, so that long runs don't hold them all in
+memory, in the trace format's JSON array form. Viewers accept the array
+without its closing ``]``, so a trace of a run that dies is still readable.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import attr
+
+"""The track that scheduler loop phases are recorded on.
+
+Slot ``n`` is recorded on track ``n + 1``.
+"""
+SCHEDULER_TRACK = 0
+
+
+def slot_track(slot):
+    return slot + 1
+
+
+def track_name(track):
+    return "scheduler" if track == SCHEDULER_TRACK else "slot %d" % (track - 1,)
+
+
+class NullTracer(object):
+    """A tracer that records nothing, used when tracing is off."""
+
+    def now(self):
+        return 0.0
+
+    def span(self, name, track=SCHEDULER_TRACK, **args):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def complete(self, name, track, start, **args):
+        pass
+
+    def counter(self, name, **values):
+        pass
+
+    def close(self):
+        pass
+
+
+@attr.s()
+class Tracer(object):
+    """Records timestamped spans, writing them to 'path' as trace JSON."""
+
+    path = attr.ib()
+    origin = attr.ib(default=attr.Factory(time.monotonic))
+    named_tracks = attr.ib(default=attr.Factory(set))
+    file = attr.ib(default=None, init=False)
+    separator = attr.ib(default="", init=False)
+
+    def __attrs_post_init__(self):
+        self.file = open(self.path, "w")
+        self.file.write("[")
+
+    def now(self):
+        """The current time in microseconds, as trace timestamps use."""
+        return (time.monotonic() - self.origin) * 1e6
+
+    def _event(self, name, phase, track, ts, args):
+        if track not in self.named_tracks:
+            self.named_tracks.add(track)
+            self._write(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": track,
+                    "args": {"name": track_name(track)},
+                }
+            )
+        event = {"name": name, "ph": phase, "ts": ts, "pid": os.getpid(), "tid": track}
+        if args:
+            event["args"] = args
+        return event
+
+    def _write(self, event):
+        self.file.write(self.separator + "\n" + json.dumps(event))
+        self.separator = ","
+
+    def complete(self, name, track, start, **args):
+        """Record a span on 'track' that started at 'start' and ends now."""
+        event = self._event(name, "X", track, start, args)
+        event["dur"] = self.now() - start
+        self._write(event)
+
+    def counter(self, name, **values):
+        self._write(self._event(name, "C", SCHEDULER_TRACK, self.now(), values))
+
+    @contextmanager
+    def span(self, name, track=SCHEDULER_TRACK, **args):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.complete(name, track, start, **args)
+
+    def close(self):
+        """Finish the trace, leaving it valid JSON."""
+        self.file.write("\n]\n")
+        self.file.close()
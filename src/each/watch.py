@@ -0,0 +1,120 @@
+"""Watching a source directory for new files to process.
+
+On Linux we use inotify, so that a file is picked up as soon as whoever is
+writing it closes it, or as soon as it is renamed into the directory.
+Elsewhere we fall back to polling the directory listing, which can pick up a
+file that is still being written.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from each.each import FileWorkItem
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+
+"""The fixed size part of an inotify event: wd, mask, cookie and name length."""
+INOTIFY_EVENT = struct.Struct("iIII")
+
+"""Returned by a watcher when it may have missed some files."""
+RESCAN = object()
+
+
+class InotifyWatcher(object):
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e), path)
+
+    def changes(self, timeout):
+        """Wait up to 'timeout' seconds and return the names of any files that
+        have finished being written since we last asked."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                return RESCAN
+            end = offset + length
+            names.append(os.fsdecode(data[offset:end].rstrip(b"\0")))
+            offset = end
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    def __init__(self, path):
+        self.path = path
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        return RESCAN
+
+    def close(self):
+        pass
+
+
+def watcher_for(path):
+    try:
+        return InotifyWatcher(path)
+    except AttributeError:
+        # No inotify in this libc.
+        return PollingWatcher(path)
+    except OSError as e:
+        if e.errno not in (errno.ENOSYS, errno.EMFILE, errno.ENOSPC):
+            raise
+        return PollingWatcher(path)
+
+
+def work_items_from_watched_directory(path, stop=lambda: False, poll_interval=1.0, watcher=None):
+    """Yield a work item for each file in the directory at 'path', then one
+    for every file that appears in it afterwards, until 'stop()' returns True.
+
+    Files whose names start with a dot are left alone, so that files written
+    under a temporary name and then renamed into place are only run once they
+    are complete.
+    """
+    if watcher is None:
+        watcher = watcher_for(path)
+    seen = set()
+
+    def new_items(names):
+        for name in names:
+            if name in seen or name.startswith("."):
+                continue
+            item_path = os.path.join(path, name)
+            if os.path.isfile(item_path):
+                seen.add(name)
+                yield FileWorkItem(name=name, path=item_path)
+
+    try:
+        # We start watching before listing the directory so that nothing
+        # created in between is missed.
+        yield from new_items(sorted(os.listdir(path)))
+        while not stop():
+            names = watcher.changes(poll_interval)
+            if names is RESCAN:
+                names = sorted(os.listdir(path))
+            yield from new_items(names)
+    finally:
+        watcher.close()
@@ -1,5 +1,9 @@
 """Test helpers."""
 
+import time
+
+from each.each import METADATA_DIR
+
 
 def get_contents(path):
     """Get the contents of 'path' if it exists.
@@ -14,10 +18,15 @@ def get_directory_contents(path):
     return {child.basename: get_contents(child) for child in path.listdir()}
 
 
+def result_directories(path):
+    """The result directories under 'path', without each's own metadata."""
+    return sorted(child for child in path.listdir() if child.basename != METADATA_DIR)
+
+
 def gather_output(path):
     """Get all the output, grouped by input contents."""
     output = {}
-    for f in path.listdir():
+    for f in result_directories(path):
         contents = get_directory_contents(f)
         input_data = contents["in"]
         if input_data in output:
@@ -25,3 +34,34 @@ def gather_output(path):
         else:
             output[input_data] = [contents]
     return output
+
+
+def is_running(pid):
+    """Whether the process 'pid' is alive, counting one that has exited but
+    not been reaped as dead."""
+    try:
+        with open("/proc/%d/stat" % (pid,)) as i:
+            # The state follows the command name, which is in parentheses.
+            return i.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def wait_until_dead(pid_file, timeout=5):
+    """Wait for the process whose ID is in 'pid_file' to die, if it was
+    started at all."""
+    if not pid_file.check() or not pid_file.read():
+        return
+    pid = int(pid_file.read())
+    deadline = time.monotonic() + timeout
+    while is_running(pid):
+        assert time.monotonic() < deadline, "%d is still running" % (pid,)
+        time.sleep(0.01)
+
+
+def wait_for(condition, timeout=30):
+    """Wait for 'condition' to return something true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
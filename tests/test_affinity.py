@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from each import Each
+from each.affinity import (
+    CORES,
+    NUMA,
+    format_cpu_list,
+    numa_nodes,
+    parse_cpu_list,
+    slot_cpu_sets,
+)
+from each.each import LineWorkItem
+
+
+@pytest.mark.parametrize(
+    "text, cpus",
+    [("0", [0]), ("0-3", [0, 1, 2, 3]), ("0-1,4,6-7\n", [0, 1, 4, 6, 7]), ("", [])],
+)
+def test_parses_cpu_lists(text, cpus):
+    assert parse_cpu_list(text) == cpus
+    assert format_cpu_list(cpus) == text.strip()
+
+
+@pytest.fixture
+def two_nodes(tmpdir, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(7)))
+    tmpdir.mkdir("node1").join("cpulist").write("4-7\n")
+    tmpdir.mkdir("node0").join("cpulist").write("0-3\n")
+    # A node whose only CPU we aren't allowed to use.
+    tmpdir.mkdir("node2").join("cpulist").write("8\n")
+    tmpdir.mkdir("power")
+    tmpdir.join("online").write("0-1\n")
+    return str(tmpdir)
+
+
+def test_reads_numa_nodes(two_nodes):
+    assert numa_nodes(two_nodes) == [[0, 1, 2, 3], [4, 5, 6]]
+
+
+def test_treats_a_machine_without_numa_as_one_node(tmpdir, monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {2, 0, 1})
+    assert numa_nodes(str(tmpdir.join("missing"))) == [[0, 1, 2]]
+
+
+def test_spreads_cores_across_nodes():
+    nodes = [[0, 1, 2, 3], [4, 5, 6]]
+    assert slot_cpu_sets(3, CORES, nodes) == [{0}, {4}, {1}]
+    assert slot_cpu_sets(9, CORES, nodes)[6:] == [{3}, {0}, {4}]
+
+
+def test_gives_each_slot_a_whole_node():
+    nodes = [[0, 1], [2, 3]]
+    assert slot_cpu_sets(3, NUMA, nodes) == [{0, 1}, {2, 3}, {0, 1}]
+
+
+AFFINITY_COMMAND = "%s -c 'import os; print(sorted(os.sched_getaffinity(0)))'" % (sys.executable,)
+
+
+@pytest.mark.parametrize("pin", [CORES, NUMA])
+def test_runs_pinned_commands(tmpdir, pin):
+    output_path = tmpdir.mkdir("output")
+    each = Each(
+        command=AFFINITY_COMMAND,
+        work_items=[LineWorkItem(str(i), "") for i in range(3)],
+        destination=output_path,
+        processes=2,
+        pin=pin,
+    )
+    each.clear_queue()
+
+    for i in range(3):
+        result = output_path.join(str(i))
+        assert result.join("status").read() == "0\n"
+        cpus = parse_cpu_list(result.join("affinity").read())
+        assert cpus in [sorted(s) for s in each.slot_cpus]
+        assert result.join("out").read() == "%r\n" % (cpus,)
+
+
+def test_does_not_record_affinity_unless_pinned(tmpdir):
+    output_path = tmpdir.mkdir("output")
+    Each(command="true", work_items=[LineWorkItem("a", "")], destination=output_path).clear_queue()
+    assert not output_path.join("a").join("affinity").check()
+
+
+def test_pins_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("")
+    output_path = tmpdir.join("output")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "true",
+            "--pin=cores",
+            "--destination=%s" % (output_path,),
+        ],
+        check=True,
+    )
+    assert output_path.join("hello").join("affinity").check()
@@ -0,0 +1,197 @@
+import os
+import subprocess
+import sys
+
+import py
+import pytest
+
+from common import get_directory_contents
+from each import Each
+from each.cache import ResultCache, materialise
+from each.each import LineWorkItem, work_items_from_directory
+from each.junkdrawer import parse_size
+
+
+def run_with_cache(tmpdir, cache, destination, command="cat", lines=("hello",), stdin=True):
+    each = Each(
+        command=command,
+        work_items=[LineWorkItem(line, line) for line in lines],
+        destination=tmpdir.join(destination),
+        stdin=stdin,
+        cache=cache,
+    )
+    each.clear_queue()
+    return each
+
+
+def test_reuses_results_in_a_new_destination(tmpdir):
+    marker = tmpdir.join("marker")
+    marker.write("stuff")
+    cache = ResultCache(str(tmpdir.join("cache")))
+
+    for destination in ["first", "second"]:
+        run_with_cache(tmpdir, cache, destination, command="cat %s" % (marker,), stdin=False)
+        marker.write("things")
+
+    assert get_directory_contents(tmpdir.join("second").join("hello")) == {
+        "in": "hello",
+        "out": "stuff",
+        "err": "",
+        "status": "0",
+    }
+    assert cache.stats().entries == 1
+
+
+@pytest.mark.parametrize(
+    "change", [{"command": "cat -"}, {"stdin": False, "command": "echo {}"}, {"lines": ["bye"]}]
+)
+def test_does_not_reuse_results_if_anything_relevant_changes(tmpdir, change):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    run_with_cache(tmpdir, cache, "first")
+    run_with_cache(tmpdir, cache, "second", **change)
+    assert cache.stats().entries == 2
+
+
+def test_caches_files_kept_from_scratch(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    runs = tmpdir.join("runs")
+    for destination in ["first", "second"]:
+        Each(
+            command='echo x >> %s; echo r > "$TMPDIR/r.txt"; mkdir "$TMPDIR/sub"; '
+            'echo s > "$TMPDIR/sub/s.txt"' % (runs,),
+            work_items=[LineWorkItem("a", "")],
+            destination=tmpdir.join(destination),
+            cache=cache,
+            scratch=str(tmpdir.ensure_dir("scratch")),
+            keep_scratch=["r.txt", "sub"],
+        ).clear_queue()
+
+    assert runs.read() == "x\n"
+    second = tmpdir.join("second").join("a")
+    assert second.join("r.txt").read() == "r\n"
+    assert second.join("sub").join("s.txt").read() == "s\n"
+    # Only what the command produced is cached.
+    (entry,) = cache.entries()
+    assert sorted(os.listdir(entry)) == ["err", "out", "r.txt", "status", "sub"]
+
+
+def test_does_not_cache_failures(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    run_with_cache(tmpdir, cache, "first", command="false")
+    assert cache.stats().entries == 0
+
+
+def test_only_gives_way_to_entries_stored_by_someone_else(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    result = tmpdir.mkdir("result")
+    for name in ["out", "err", "status"]:
+        result.join(name).write("")
+    # Something that isn't an entry is in the way.
+    py.path.local(cache.entry("key")).ensure()
+    with pytest.raises(NotADirectoryError):
+        cache.store("key", str(result))
+
+
+def test_file_items_are_keyed_by_content(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    for name in ["a", "b"]:
+        source = tmpdir.mkdir("source-" + name)
+        source.join(name).write("same contents")
+        Each(
+            command="cat",
+            work_items=work_items_from_directory(str(source)),
+            destination=tmpdir.join("output-" + name),
+            cache=cache,
+        ).clear_queue()
+    assert cache.stats().entries == 1
+    assert tmpdir.join("output-b").join("b").join("out").read() == "same contents"
+
+    # Unless the command is given their paths, when those count too.
+    for name in ["a", "b"]:
+        Each(
+            command="echo {}",
+            work_items=work_items_from_directory(str(tmpdir.join("source-" + name))),
+            destination=tmpdir.join("paths-" + name),
+            cache=cache,
+            stdin=False,
+        ).clear_queue()
+    assert cache.stats().entries == 3
+    for name in ["a", "b"]:
+        out = tmpdir.join("paths-" + name).join(name).join("out").read()
+        assert out == str(tmpdir.join("source-" + name).join(name)) + "\n"
+
+
+def test_identical_items_in_the_same_run(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    source = tmpdir.mkdir("source")
+    for name in ["a", "b"]:
+        source.join(name).write("same contents")
+    Each(
+        command="cat",
+        work_items=work_items_from_directory(str(source)),
+        destination=tmpdir.join("output"),
+        cache=cache,
+        processes=2,
+    ).clear_queue()
+    assert cache.stats().entries == 1
+    assert os.listdir(os.path.join(cache.path, "tmp")) == []
+
+
+def test_evicts_least_recently_used_entries(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    run_with_cache(tmpdir, cache, "first", lines=["one", "two", "three"])
+    for entry in cache.entries():
+        os.utime(entry, (0, 0))
+    run_with_cache(tmpdir, cache, "second", lines=["two"])
+
+    assert cache.prune(len("two\n0\n")) == 2
+    [entry] = cache.entries()
+    assert get_directory_contents(py.path.local(entry))["out"] == "two"
+
+
+def test_can_evict_everything(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    run_with_cache(tmpdir, cache, "first", lines=["one", "two"])
+    assert cache.prune(0) == 2
+    assert cache.stats().entries == 0
+
+
+def test_stays_within_max_size(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")), max_size=10)
+    run_with_cache(tmpdir, cache, "first", lines=["one", "two", "three", "four", "five"])
+    assert cache.stats().size <= 10
+    assert cache.size == cache.stats().size
+
+
+def test_falls_back_to_copying(tmpdir, monkeypatch):
+    def fail(*args):
+        raise OSError()
+
+    monkeypatch.setattr(os, "link", fail)
+    source = tmpdir.join("source")
+    source.write("hello")
+    materialise(str(source), str(tmpdir.join("copy")))
+    assert tmpdir.join("copy").read() == "hello"
+
+
+@pytest.mark.parametrize(
+    "size, expected", [("100", 100), ("2k", 2048), ("1.5M", 3 << 19), ("10GB", 10 << 30)]
+)
+def test_parses_sizes(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_stats_of_an_empty_cache(tmpdir):
+    assert ResultCache(str(tmpdir.join("cache"))).stats().entries == 0
+
+
+def test_cache_subcommands(tmpdir):
+    cache = tmpdir.join("cache")
+    run_with_cache(tmpdir, ResultCache(str(cache)), "first", lines=["one", "two"])
+
+    def each(*args):
+        return subprocess.check_output([sys.executable, "-m", "each"] + list(args)).decode()
+
+    assert "entries: 2" in each("cache", "stats", str(cache))
+    assert "evicted: 2" in each("cache", "prune", str(cache), "--max-size=0")
+    assert "entries: 0" in each("cache", "stats", str(cache))
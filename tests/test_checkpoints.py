@@ -0,0 +1,95 @@
+import subprocess
+import sys
+
+from each import Each
+from each.each import CHECKPOINTS_DIR, METADATA_DIR, RETRY, LineWorkItem
+
+# Counts its attempts in its checkpoint directory, as a command saving its
+# progress would, and only succeeds on the second.
+RESUMING_COMMAND = (
+    'echo x >> "$EACH_CHECKPOINT_DIR/attempts"; '
+    'n=$(wc -l < "$EACH_CHECKPOINT_DIR/attempts"); echo $n; [ $n -ge 2 ]'
+)
+
+
+def checkpoints(output_path):
+    return output_path.join(METADATA_DIR).join(CHECKPOINTS_DIR)
+
+
+def run(output_path, **kwargs):
+    each = Each(
+        command=RESUMING_COMMAND,
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+        checkpoints=True,
+        retry_policies={1: RETRY},
+        **kwargs
+    )
+    each.clear_queue()
+    return each
+
+
+def test_retries_carry_on_from_their_checkpoints(tmpdir):
+    output_path = tmpdir.join("output")
+    run(output_path, retries=1)
+    assert output_path.join("a").join("out").read() == "2\n"
+    assert output_path.join("a").join("status").read() == "0\n"
+    assert checkpoints(output_path).listdir() == []
+
+
+def test_checkpoints_are_kept_between_runs(tmpdir):
+    output_path = tmpdir.join("output")
+    assert run(output_path).failed == 1
+    assert checkpoints(output_path).join("a").join("attempts").read() == "x\n"
+
+    assert run(output_path, retries=1).failed == 0
+    assert output_path.join("a").join("out").read() == "2\n"
+    assert not checkpoints(output_path).join("a").check()
+
+
+def test_each_stage_has_its_own_checkpoints(tmpdir):
+    output_path = tmpdir.join("output")
+    each = Each(
+        command='echo "$EACH_CHECKPOINT_DIR"',
+        then=['cat; echo "$EACH_CHECKPOINT_DIR"; false'],
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+        checkpoints=True,
+    )
+    each.clear_queue()
+    second_stage = tmpdir.join("output-2")
+    first, second = second_stage.join("a").join("out").read().split()
+    assert first != second
+    # Only the failure has kept its checkpoints.
+    assert not checkpoints(output_path).join("a").check()
+    assert checkpoints(second_stage).join("a").check()
+
+
+def test_no_checkpoints_by_default(tmpdir):
+    output_path = tmpdir.join("output")
+    Each(
+        command='echo "${EACH_CHECKPOINT_DIR-none}"',
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+    ).clear_queue()
+    assert output_path.join("a").join("out").read() == "none\n"
+    assert not checkpoints(output_path).check()
+
+
+def test_uses_checkpoints_from_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("")
+    output_path = tmpdir.join("output")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            'touch "$EACH_CHECKPOINT_DIR/progress"; false',
+            "--checkpoints",
+            "--destination=%s" % (output_path,),
+        ],
+        check=True,
+    )
+    assert checkpoints(output_path).join("hello").join("progress").check()
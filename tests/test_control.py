@@ -0,0 +1,359 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from each import Each
+from each.control import SOCKET_NAME, ControlError, Controller, send_command
+from each.each import METADATA_DIR, LineWorkItem
+
+
+def line_items(n):
+    return [LineWorkItem(str(i), "%d\n" % (i,)) for i in range(n)]
+
+
+def control_path(destination):
+    return str(destination.join(METADATA_DIR).join(SOCKET_NAME))
+
+
+def test_can_add_processes(tmpdir):
+    output_path = tmpdir.join("output")
+    each = Each(
+        command='echo "$EACH_SLOT"',
+        work_items=line_items(6),
+        destination=output_path,
+        processes=1,
+    )
+    assert len(each.free_slots) == 1
+    each.set_processes(3)
+    assert each.processes == 3
+    assert sorted(each.free_slots) == [0, 1, 2]
+    each.clear_queue()
+
+    slots = {int(output_path.join(str(i)).join("out").read()) for i in range(6)}
+    assert slots <= {0, 1, 2}
+    assert sorted(output_path.join(METADATA_DIR).join("slots").listdir()) == [
+        output_path.join(METADATA_DIR).join("slots").join(str(i)) for i in range(3)
+    ]
+
+
+def test_lowering_processes_lets_running_items_finish(tmpdir):
+    each = Each(
+        command="sleep 0.1",
+        work_items=line_items(6),
+        destination=tmpdir.join("output"),
+        processes=3,
+    )
+    each.fill_work_in_progress()
+    assert len(each.work_in_progress) == 3
+    each.set_processes(1)
+    # Raising it again doesn't make new slots we already have.
+    each.set_processes(2)
+    each.set_processes(1)
+    assert each.slot_count == 3
+    each.fill_work_in_progress()
+    assert len(each.work_in_progress) == 3
+
+    while len(each.work_in_progress) > 0:
+        each.collect_completed_work()
+    each.fill_work_in_progress()
+    assert len(each.work_in_progress) == 1
+    assert [w.slot for w in each.work_in_progress.values()] == [0]
+    each.clear_queue()
+    assert each.completed == 6
+
+
+def test_repins_new_slots(tmpdir):
+    each = Each(
+        command="true",
+        work_items=line_items(1),
+        destination=tmpdir.join("output"),
+        processes=1,
+        pin="cores",
+    )
+    each.set_processes(2)
+    assert len(each.slot_cpus) == 2
+
+
+def test_starts_nothing_while_paused(tmpdir):
+    each = Each(
+        command="true",
+        work_items=line_items(3),
+        destination=tmpdir.join("output"),
+        wait_timeout=0.01,
+    )
+    each.paused = True
+    each.fill_work_in_progress()
+    assert not each.work_in_progress
+    each.update_predicted_timing()
+    start = time.monotonic()
+    each.collect_completed_work()
+    assert time.monotonic() - start >= 0.01
+    each.paused = False
+    each.clear_queue()
+    assert each.completed == 3
+
+
+def test_draining_leaves_the_rest_for_next_time(tmpdir):
+    output_path = tmpdir.join("output")
+    each = Each(
+        command="cat",
+        work_items=line_items(5),
+        destination=output_path,
+        processes=1,
+        speculate=1.0,
+    )
+    each.progress_callback = lambda: setattr(each, "draining", True)
+    each.clear_queue()
+    assert each.completed == 1
+    assert len(output_path.listdir(lambda p: p.basename != METADATA_DIR)) == 1
+
+    each = Each(command="cat", work_items=line_items(5), destination=output_path)
+    each.clear_queue()
+    assert each.completed == 4
+
+
+@pytest.fixture
+def controlled(tmpdir):
+    """A run that takes a little while, listening for commands."""
+    output_path = tmpdir.join("output")
+    each = Each(
+        command="sleep 0.05",
+        work_items=line_items(20),
+        destination=output_path,
+        processes=1,
+        control=True,
+        wait_timeout=0.05,
+    )
+    return each, output_path
+
+
+def run_in_background(target):
+    """Run 'target' in a thread, passing on anything it raises."""
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, errors
+
+
+def wait_for_socket(path):
+    for _ in range(200):
+        if os.path.exists(path):
+            return
+        time.sleep(0.01)
+    raise AssertionError("%s never appeared" % (path,))
+
+
+def test_takes_commands_from_the_socket(controlled):
+    each, output_path = controlled
+    path = control_path(output_path)
+    replies = []
+
+    def send_commands():
+        wait_for_socket(path)
+        replies.append(send_command(path, "processes 4"))
+        replies.append(send_command(path, "pause"))
+        time.sleep(0.2)
+        replies.append(send_command(path, "status"))
+        replies.append(send_command(path, "resume"))
+        replies.append(send_command(path, "drain"))
+
+    thread, errors = run_in_background(send_commands)
+    each.clear_queue()
+    thread.join()
+    assert errors == []
+
+    assert replies[0]["processes"] == 4
+    assert replies[1]["paused"]
+    paused = replies[2]
+    assert paused["paused"] and paused["running"] == 0
+    assert not replies[3]["paused"]
+    assert replies[4]["draining"]
+    # It stopped early, and cleaned up after itself.
+    assert each.completed < 20
+    assert not os.path.exists(path)
+
+
+def test_rejects_bad_commands(tmpdir):
+    each = Each(command="true", work_items=[], destination=tmpdir.join("output"))
+    controller = Controller(each, str(tmpdir.join("control.sock")))
+    for request in ["", "frobnicate", "processes", "processes 0", "processes two"]:
+        assert "error" in controller.handle(request)
+    assert controller.handle("status\n")["processes"] == 1
+
+
+def test_reports_errors_to_the_sender(controlled):
+    each, output_path = controlled
+    path = control_path(output_path)
+
+    def send_commands():
+        wait_for_socket(path)
+        with pytest.raises(ControlError):
+            send_command(path, "processes -1")
+        send_command(path, "drain")
+
+    thread, errors = run_in_background(send_commands)
+    each.clear_queue()
+    thread.join()
+    assert errors == []
+
+
+def test_carries_on_when_it_cannot_listen(tmpdir):
+    # Too long a path for a Unix socket, whether relative or absolute.
+    output_path = tmpdir.join("x" * 60).join("y" * 60)
+    warnings = []
+    each = Each(
+        command="true",
+        work_items=line_items(2),
+        destination=output_path,
+        control=True,
+        warning_callback=warnings.append,
+    )
+    each.clear_queue()
+    assert each.completed == 2
+    (warning,) = warnings
+    assert "Can't listen" in warning
+
+
+def test_leaves_another_runs_socket_alone(tmpdir):
+    each = Each(command="true", work_items=[], destination=tmpdir.join("output"))
+    path = str(tmpdir.join("control.sock"))
+    first = Controller(each, path)
+    first.open()
+    try:
+        with pytest.raises(ControlError):
+            Controller(each, path).open()
+
+        def reply():
+            replies.append(send_command(path, "status"))
+
+        replies = []
+        thread, errors = run_in_background(reply)
+        while thread.is_alive():
+            first.poll()
+            time.sleep(0.01)
+        assert errors == []
+        assert replies[0]["processes"] == 1
+    finally:
+        first.close()
+
+
+def test_closing_is_idempotent(tmpdir):
+    each = Each(command="true", work_items=[], destination=tmpdir.join("output"))
+    path = tmpdir.join("control.sock")
+    controller = Controller(each, str(path))
+    controller.open()
+    path.remove()
+    controller.close()
+    controller.close()
+    assert controller.server is None
+
+
+def test_complains_when_nothing_is_listening(tmpdir):
+    with pytest.raises(ControlError):
+        send_command(str(tmpdir.join("control.sock")), "status")
+
+
+def test_ignores_clients_that_go_away(controlled, monkeypatch):
+    each, output_path = controlled
+    path = control_path(output_path)
+
+    def handle(request):
+        raise BrokenPipeError()
+
+    def send_commands():
+        wait_for_socket(path)
+        monkeypatch.setattr(each.controller, "handle", handle)
+        with pytest.raises(ValueError):
+            send_command(path, "status")
+        monkeypatch.undo()
+        send_command(path, "drain")
+
+    thread, errors = run_in_background(send_commands)
+    each.clear_queue()
+    thread.join()
+    assert errors == []
+
+
+def test_signals_change_the_number_of_processes(controlled):
+    each, output_path = controlled
+    previous = signal.getsignal(signal.SIGUSR1)
+    sent = []
+
+    def progress():
+        if not sent:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR2)
+        elif len(sent) == 5:
+            for _ in range(5):
+                os.kill(os.getpid(), signal.SIGUSR2)
+        sent.append(each.processes)
+
+    each.progress_callback = progress
+    each.clear_queue()
+    assert 2 in sent
+    assert sent[-1] == 1
+    assert signal.getsignal(signal.SIGUSR1) is previous
+
+
+def each_command(*args, **kwargs):
+    return subprocess.run(
+        [sys.executable, "-m", "each"] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        **kwargs
+    )
+
+
+def test_controls_runs_from_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    for i in range(20):
+        input_path.join(str(i)).write("")
+    output_path = tmpdir.join("output")
+    run = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "sleep 0.1",
+            "-j",
+            "1",
+            "--control",
+            "--progress=none",
+            "--destination=%s" % (output_path,),
+        ],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    wait_for_socket(control_path(output_path))
+
+    status = each_command("control", str(output_path), "processes", "2", check=True)
+    assert "processes: 2" in status.stdout.splitlines()
+    each_command("control", str(output_path), "drain", check=True)
+    assert run.wait(timeout=30) == 0
+    assert "Drained" in run.stderr.read()
+    run.stderr.close()
+
+    failed = each_command("control", str(output_path), "status")
+    assert failed.returncode != 0
+    assert "Nothing is listening" in failed.stderr
+
+
+def test_rejects_unknown_commands_from_the_command_line(tmpdir):
+    rejected = each_command("control", str(tmpdir), "faster")
+    assert rejected.returncode == 2
+    assert "'faster' is not one of processes, pause" in rejected.stderr
@@ -0,0 +1,446 @@
+import heapq
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+import pytest
+
+from common import is_running, wait_for, wait_until_dead
+from each import Each, each as each_module, work_items_from_path
+from each.detach import (
+    RUNNING_DIR,
+    hold_lock,
+    lock_is_held,
+    read_record,
+    read_result,
+    supervise,
+    write_record,
+)
+from each.each import (
+    METADATA_DIR,
+    SCRATCH_QUOTA_EXCEEDED,
+    LineWorkItem,
+    WorkInProgress,
+    exit_status,
+)
+
+
+def running_root(output_path):
+    return output_path.join(METADATA_DIR).join(RUNNING_DIR)
+
+
+def test_runs_items_detached(tmpdir):
+    output_path = tmpdir.join("output")
+    each = Each(
+        command='read n; [ $n = killed ] && kill -TERM $$; echo "$n"; exit 3',
+        work_items=[LineWorkItem(name, name + "\n") for name in ("a", "killed")],
+        destination=output_path,
+        processes=2,
+        detach=True,
+    )
+    each.clear_queue()
+    assert output_path.join("a").join("out").read() == "a\n"
+    assert output_path.join("a").join("status").read() == "3\n"
+    # The status is that of the command, not of its supervisor.
+    assert output_path.join("killed").join("status").read() == "143\n"
+    assert running_root(output_path).listdir() == []
+
+
+def test_kills_the_whole_item(tmpdir):
+    output_path = tmpdir.join("output")
+    scratch = tmpdir.mkdir("scratch")
+    Each(
+        command='head -c 1000000 /dev/zero > "$TMPDIR/big"; sleep 10',
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+        detach=True,
+        scratch=str(scratch),
+        scratch_quota=1000,
+        wait_timeout=0.1,
+    ).clear_queue()
+    assert output_path.join("a").join("status").read() == "%d\n" % (SCRATCH_QUOTA_EXCEEDED,)
+
+
+def start_run(tmpdir, names, *args):
+    """Start each on 'names' in the background."""
+    tmpdir.join("input").write("".join(name + "\n" for name in names))
+    return subprocess.Popen(each_command(tmpdir) + list(args))
+
+
+def each_command(tmpdir):
+    """Run each with a command that records every time it's started on an
+    item, then waits for the file 'go' before finishing."""
+    starts = tmpdir.ensure_dir("starts")
+    go = tmpdir.join("go")
+    command = 'read n; echo x >> %s/$n; while [ ! -e %s ]; do sleep 0.01; done; echo "$n"' % (
+        starts,
+        go,
+    )
+    return [
+        sys.executable,
+        "-m",
+        "each",
+        str(tmpdir.join("input")),
+        command,
+        "--detach",
+        "--progress=none",
+        "--destination=%s" % (tmpdir.join("output"),),
+    ]
+
+
+def result(tmpdir, name):
+    """The results of the line 'name', whose directory is named after it."""
+    (path,) = tmpdir.join("output").listdir(lambda p: p.basename.endswith("-" + name))
+    return path
+
+
+def starts(tmpdir, name):
+    path = tmpdir.join("starts").join(name)
+    return len(path.readlines()) if path.check() else 0
+
+
+def finish_run(tmpdir, *args):
+    tmpdir.join("go").ensure()
+    subprocess.run(each_command(tmpdir) + list(args), check=True, timeout=60)
+
+
+def kill_once_started(tmpdir, run, names):
+    wait_for(lambda: all(starts(tmpdir, name) for name in names))
+    wait_for(lambda: len(running_root(tmpdir.join("output")).listdir()) == len(names))
+    wait_for(
+        lambda: all(read_record(str(d)) for d in running_root(tmpdir.join("output")).listdir())
+    )
+    run.send_signal(signal.SIGKILL)
+    run.wait()
+
+
+def test_reattaches_to_running_items(tmpdir):
+    run = start_run(tmpdir, ["a", "b"], "-j", "2")
+    kill_once_started(tmpdir, run, ["a", "b"])
+
+    # Fewer slots than there are items to reattach to.
+    finish_run(tmpdir, "-j", "1")
+    for name in ("a", "b"):
+        assert starts(tmpdir, name) == 1
+        assert result(tmpdir, name).join("out").read() == name + "\n"
+        assert result(tmpdir, name).join("status").read() == "0\n"
+    assert running_root(tmpdir.join("output")).listdir() == []
+
+
+def test_reattaches_to_more_items_than_it_has_slots_for(tmpdir):
+    run = start_run(tmpdir, ["a", "b"], "-j", "2")
+    kill_once_started(tmpdir, run, ["a", "b"])
+
+    each = Each(
+        command=each_command(tmpdir)[4],
+        work_items=work_items_from_path(tmpdir.join("input")),
+        destination=tmpdir.join("output"),
+        processes=1,
+        detach=True,
+        wait_timeout=0.01,
+    )
+    assert sorted(w.slot for w in each.work_in_progress.values()) == [0, 1]
+    tmpdir.join("go").ensure()
+    each.clear_queue()
+    for name in ("a", "b"):
+        assert starts(tmpdir, name) == 1
+        assert result(tmpdir, name).join("status").read() == "0\n"
+
+
+def test_collects_items_that_finished_in_between(tmpdir):
+    run = start_run(tmpdir, ["a"])
+    kill_once_started(tmpdir, run, ["a"])
+    tmpdir.join("go").ensure()
+    running_dir = running_root(tmpdir.join("output")).listdir()[0]
+    wait_for(lambda: running_dir.join("result").check())
+
+    finish_run(tmpdir)
+    assert starts(tmpdir, "a") == 1
+    assert result(tmpdir, "a").join("out").read() == "a\n"
+
+
+def test_restarts_items_that_were_killed(tmpdir):
+    run = start_run(tmpdir, ["a", "b"], "-j", "2")
+    kill_once_started(tmpdir, run, ["a", "b"])
+    for running_dir in running_root(tmpdir.join("output")).listdir():
+        record = read_record(str(running_dir))
+        if record["name"].endswith("-a"):
+            os.killpg(record["pid"], signal.SIGKILL)
+            wait_for(lambda: not lock_is_held(str(running_dir)))
+
+    finish_run(tmpdir)
+    assert starts(tmpdir, "a") == 2
+    assert starts(tmpdir, "b") == 1
+    for name in ("a", "b"):
+        assert result(tmpdir, name).join("status").read() == "0\n"
+
+
+@pytest.mark.parametrize("use_scratch", [False, True])
+def test_restarts_items_that_die_after_reattaching(tmpdir, use_scratch):
+    scratch = tmpdir.mkdir("scratch")
+    args = ["--scratch=%s" % (scratch,)] if use_scratch else []
+    run = start_run(tmpdir, ["a"], *args)
+    kill_once_started(tmpdir, run, ["a"])
+    (running_dir,) = running_root(tmpdir.join("output")).listdir()
+    record = read_record(str(running_dir))
+
+    output_path = tmpdir.join("output")
+    each = Each(
+        command="echo again",
+        work_items=[LineWorkItem(record["name"], "a\n")],
+        destination=output_path,
+        detach=True,
+        scratch=str(scratch) if use_scratch else None,
+        wait_timeout=0.01,
+    )
+    assert [w.reattached for w in each.work_in_progress.values()] == [True]
+    each.collect_completed_work()
+    assert each.work_in_progress
+    os.killpg(record["pid"], signal.SIGKILL)
+    wait_for(lambda: not lock_is_held(str(running_dir)))
+    each.clear_queue()
+    assert result(tmpdir, "a").join("out").read() == "again\n"
+    assert scratch.listdir() == []
+
+
+def test_tidies_up_after_items_it_knows_nothing_about(tmpdir):
+    output_path = tmpdir.join("output")
+    root = running_root(output_path)
+    # One we died before recording, which may still be running.
+    held = root.ensure_dir("0-0-held")
+    lock = hold_lock(str(held))
+    # One that's finished.
+    root.ensure_dir("0-1-done").join("lock").ensure()
+    # One that was killed before it could record how it went.
+    write_record(
+        str(root.ensure_dir("0-2-lost")),
+        {"name": "lost", "stage": 0, "pid": 1, "staging_dir": str(tmpdir.ensure_dir("lost"))},
+    )
+    # One whose results were thrown away since.
+    write_record(
+        str(root.ensure_dir("0-3-gone")),
+        {"name": "gone", "stage": 0, "pid": 1, "staging_dir": str(tmpdir.join("gone"))},
+    )
+    try:
+        each = Each(command="true", work_items=[], destination=output_path, detach=True)
+        assert each.detached == {}
+        assert root.listdir() == [held]
+    finally:
+        os.close(lock)
+    assert not lock_is_held(str(held))
+
+
+def test_keeps_staging_directories_of_items_in_later_stages(tmpdir):
+    output_path = tmpdir.join("output")
+    staging_dir = tmpdir.join("output-2").join(METADATA_DIR).join("staging").ensure_dir("0-a")
+    running_dir = running_root(output_path).ensure_dir("1-0-a")
+    write_record(
+        str(running_dir),
+        {"name": "a", "stage": 1, "pid": 1, "slot": 0, "staging_dir": str(staging_dir)},
+    )
+    # It finished while no one was watching.
+    running_dir.join("result").write("0")
+    each = Each(command="true", then=["cat"], work_items=[], destination=output_path, detach=True)
+    assert list(each.detached) == [(1, "a")]
+    assert staging_dir.check()
+
+
+def test_does_not_reuse_staging_directories_kept_for_detached_items(tmpdir):
+    each = Each(command="true", work_items=[], destination=tmpdir.join("output"), detach=True)
+    kept = tmpdir.join("output").join(METADATA_DIR).join("staging").ensure_dir("0-a")
+    staging_dir = each.prepare(LineWorkItem("a", ""), 0)
+    assert os.path.basename(staging_dir) == "1-a"
+    assert kept.listdir() == []
+
+
+def test_cancelling_a_reattached_item_tidies_up_after_it(tmpdir):
+    each = Each(command="true", work_items=[], destination=tmpdir.join("output"), detach=True)
+    gone = subprocess.Popen(["true"])
+    gone.wait()
+    item_in_progress = WorkInProgress(
+        pid=gone.pid,
+        work_item=LineWorkItem("a", ""),
+        slot=heapq.heappop(each.free_slots),
+        staging_dir=str(tmpdir.ensure_dir("staging")),
+        base_dir=None,
+        out_file=None,
+        err_file=None,
+        status_file=None,
+        started=0.0,
+        running_dir=str(tmpdir.ensure_dir("running")),
+        reattached=True,
+    )
+    each.work_in_progress["a"] = item_in_progress
+    each.cancel("a")
+    assert not tmpdir.join("staging").check()
+    assert not tmpdir.join("running").check()
+    assert each.free_slots == [0]
+
+
+def test_supervisor_records_how_the_command_exited(tmpdir, monkeypatch):
+    pid = os.fork()
+    if pid == 0:
+        os._exit(3)
+    monkeypatch.setattr(os, "_exit", lambda n: sys.exit(n))
+    with pytest.raises(SystemExit):
+        supervise(pid, str(tmpdir))
+    assert exit_status(read_result(str(tmpdir))) == 3
+
+
+def test_tidies_up_the_scratch_of_lost_items(tmpdir):
+    output_path = tmpdir.join("output")
+    scratch_root = tmpdir.mkdir("scratch").mkdir("each-earlier")
+    for name, staging_dir in [("lost", tmpdir.ensure_dir("lost")), ("gone", tmpdir.join("gone"))]:
+        write_record(
+            str(running_root(output_path).ensure_dir("0-0-" + name)),
+            {
+                "name": name,
+                "stage": 0,
+                "pid": 1,
+                "staging_dir": str(staging_dir),
+                "scratch_dir": str(scratch_root.ensure_dir(name)),
+            },
+        )
+    # One that finished, and will be collected later.
+    finished = running_root(output_path).ensure_dir("0-0-finished")
+    write_record(
+        str(finished),
+        {
+            "name": "finished",
+            "stage": 0,
+            "pid": 1,
+            "slot": 0,
+            "staging_dir": str(tmpdir.ensure_dir("finished")),
+            "scratch_dir": str(scratch_root.ensure_dir("finished")),
+        },
+    )
+    finished.join("result").write("0")
+
+    each = Each(command="true", work_items=[], destination=output_path, detach=True)
+    assert list(each.detached) == [(0, "finished")]
+    assert scratch_root.listdir() == [scratch_root.join("finished")]
+
+
+def test_killing_an_item_that_has_gone_is_harmless(tmpdir):
+    each = Each(command="true", work_items=[], destination=tmpdir.join("output"), detach=True)
+    gone = subprocess.Popen(["true"])
+    gone.wait()
+    item_in_progress = WorkInProgress(
+        pid=gone.pid,
+        work_item=LineWorkItem("a", ""),
+        slot=0,
+        staging_dir=None,
+        base_dir=None,
+        out_file=None,
+        err_file=None,
+        status_file=None,
+        started=0.0,
+        reattached=True,
+    )
+    each.kill(item_in_progress)
+
+
+def test_leaves_detached_items_running_when_interrupted(tmpdir):
+    pid_file = tmpdir.join("pid")
+    each = Each(
+        command="sh -c 'echo $$ > %s; exec sleep 10'" % (pid_file,),
+        work_items=[LineWorkItem("a", "")],
+        destination=tmpdir.join("output"),
+        detach=True,
+    )
+
+    def interrupt():
+        raise KeyboardInterrupt()
+
+    each.fill_work_in_progress()
+    wait_for(lambda: pid_file.check() and pid_file.read())
+    each.run_until_empty = interrupt
+    with pytest.raises(KeyboardInterrupt):
+        each.clear_queue()
+    (item_in_progress,) = each.work_in_progress.values()
+    assert is_running(int(pid_file.read()))
+    each.kill(item_in_progress)
+    os.waitpid(item_in_progress.pid, 0)
+    wait_until_dead(pid_file)
+
+
+def test_detached_items_keep_their_scratch_when_interrupted(tmpdir):
+    output_path = tmpdir.join("output")
+    scratch = tmpdir.mkdir("scratch")
+    go = tmpdir.join("go")
+
+    def make_each():
+        return Each(
+            command='echo hi > "$EACH_SCRATCH_DIR/x"; while [ ! -e %s ]; do sleep 0.01; done; '
+            'cat "$EACH_SCRATCH_DIR/x"' % (go,),
+            work_items=[LineWorkItem("a", "")],
+            destination=output_path,
+            detach=True,
+            scratch=str(scratch),
+            wait_timeout=0.01,
+        )
+
+    def interrupt():
+        raise KeyboardInterrupt()
+
+    each = make_each()
+    each.fill_work_in_progress()
+    (item_in_progress,) = each.work_in_progress.values()
+    wait_for(lambda: os.path.exists(os.path.join(item_in_progress.scratch_dir, "x")))
+    each.run_until_empty = interrupt
+    with pytest.raises(KeyboardInterrupt):
+        each.clear_queue()
+    assert os.path.exists(os.path.join(item_in_progress.scratch_dir, "x"))
+
+    each = make_each()
+    go.ensure()
+    each.clear_queue()
+    os.waitpid(item_in_progress.pid, 0)
+    assert output_path.join("a").join("status").read() == "0\n"
+    assert output_path.join("a").join("out").read() == "hi\n"
+    # The earlier run's scratch directory went with its last item.
+    assert scratch.listdir() == []
+
+
+def test_runs_that_are_not_detached_abandon_detached_items(tmpdir):
+    run = start_run(tmpdir, ["a"])
+    kill_once_started(tmpdir, run, ["a"])
+    (running_dir,) = running_root(tmpdir.join("output")).listdir()
+    record = read_record(str(running_dir))
+
+    # This clears out the staging directory the item is writing to.
+    Each(command="true", work_items=[], destination=tmpdir.join("output"))
+    assert running_root(tmpdir.join("output")).listdir() == []
+    wait_for(lambda: not is_running(record["pid"]))
+
+    finish_run(tmpdir)
+    assert starts(tmpdir, "a") == 2
+    assert result(tmpdir, "a").join("status").read() == "0\n"
+
+
+def test_reruns_items_whose_staging_directory_has_gone(tmpdir):
+    run = start_run(tmpdir, ["a"])
+    kill_once_started(tmpdir, run, ["a"])
+    (running_dir,) = running_root(tmpdir.join("output")).listdir()
+    shutil.rmtree(read_record(str(running_dir))["staging_dir"])
+
+    finish_run(tmpdir)
+    assert starts(tmpdir, "a") == 2
+    assert result(tmpdir, "a").join("out").read() == "a\n"
+    assert running_root(tmpdir.join("output")).listdir() == []
+
+
+def test_abandons_items_that_exit_as_it_looks(tmpdir, monkeypatch):
+    output_path = tmpdir.join("output")
+    gone = subprocess.Popen(["true"])
+    gone.wait()
+    write_record(
+        str(running_root(output_path).ensure_dir("0-0-a")),
+        {"name": "a", "stage": 0, "pid": gone.pid, "staging_dir": str(tmpdir.join("missing"))},
+    )
+    monkeypatch.setattr(each_module, "lock_is_held", lambda running_dir: True)
+    each = Each(command="true", work_items=[], destination=output_path, detach=True)
+    assert each.detached == {}
+    assert running_root(output_path).listdir() == []
@@ -1,8 +1,10 @@
+import os
+
 import pytest
 
-from common import get_directory_contents
+from common import get_directory_contents, result_directories
 from each import Each
-from each.each import LineWorkItem, work_items_from_directory
+from each.each import METADATA_DIR, LineWorkItem, publish, work_items_from_directory
 
 
 @pytest.mark.parametrize("processes", [1, 2, 4])
@@ -23,7 +25,7 @@ def test_processes_each_file(tmpdir, processes, stderr, stdin):
     )
     each.clear_queue()
 
-    for i, f in enumerate(sorted(output_files.listdir())):
+    for i, f in enumerate(result_directories(output_files)):
         contents = "hello %d" % (i,)
         expected = {"status": "0", "in": contents, "out": contents, "err": ""}
         if stderr:
@@ -107,7 +109,7 @@ def test_can_handle_disappearing_files(tmpdir):
 
     each.clear_queue()
 
-    assert len(output_files.listdir()) == 1
+    assert len(result_directories(output_files)) == 1
 
 
 def test_timeout_in_file_processing(tmpdir):
@@ -124,7 +126,7 @@ def test_timeout_in_file_processing(tmpdir):
 
     each.clear_queue()
 
-    assert len(output_files.listdir()) == 1
+    assert len(result_directories(output_files)) == 1
     assert output_files.join("hello").join("out").read() == "world"
 
 
@@ -158,3 +160,42 @@ def test_immediately_triggers_progress_on_initially_completed_work(tmpdir):
         each.clear_queue()
 
         assert progress == i + 1
+
+
+def test_results_only_appear_once_complete(tmpdir):
+    output_files = tmpdir.mkdir("output")
+    each = Each(
+        command="sleep 0.2 && cat",
+        work_items=[LineWorkItem("hello", "world")],
+        destination=output_files,
+    )
+    each.fill_work_in_progress()
+    [in_progress] = each.work_in_progress.values()
+
+    assert not output_files.join("hello").check()
+    assert os.path.isdir(in_progress.staging_dir)
+
+    each.clear_queue()
+
+    assert get_directory_contents(output_files.join("hello")) == {
+        "in": "world",
+        "out": "world",
+        "err": "",
+        "status": "0",
+    }
+    assert not os.path.exists(in_progress.staging_dir)
+
+
+def test_cleans_up_after_interrupted_runs(tmpdir):
+    output_files = tmpdir.mkdir("output")
+    stale = output_files.mkdir(METADATA_DIR).mkdir("staging").mkdir("0-hello")
+    stale.join("out").write("partial")
+
+    Each(command="cat", work_items=[], destination=output_files)
+
+    assert not stale.check()
+
+
+def test_publish_reports_unexpected_errors(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        publish(str(tmpdir.join("missing")), str(tmpdir.join("result")), str(tmpdir.join("trash")))
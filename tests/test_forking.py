@@ -4,6 +4,7 @@ import attr
 import pytest
 
 from each import Each, each as each_module
+from each.affinity import CORES
 
 
 def always_raises(exc):
@@ -25,6 +26,8 @@ APPROVED_NAMES = {
     "open",
     "getpid",
     "symlink",
+    "mkdir",
+    "environ",
 }
 
 
@@ -35,15 +38,32 @@ class FakeOS(object):
     execs = attr.ib(default=attr.Factory(list))
     exec_error = attr.ib(default=None)
     next_fd = attr.ib(default=5)
-
-    def execv(self, command, argv):
-        self.execs.append((command, argv))
+    affinity = attr.ib(default=None)
+    process_groups = attr.ib(default=attr.Factory(list))
+    sessions = attr.ib(default=0)
+    """What successive forks return, after which they return 0, as in the
+    child."""
+    fork_pids = attr.ib(default=attr.Factory(list))
+
+    def execve(self, command, argv, env):
+        self.execs.append((command, argv, env))
         if self.exec_error is not None:
             raise self.exec_error()
 
     def fork(self):
+        if self.fork_pids:
+            return self.fork_pids.pop(0)
         return 0
 
+    def setpgid(self, pid, pgid):
+        self.process_groups.append((pid, pgid))
+
+    def setsid(self):
+        self.sessions += 1
+
+    def sched_setaffinity(self, pid, cpus):
+        self.affinity = set(cpus)
+
     def _exit(self, n):
         raise SystemExit(n)
 
@@ -114,3 +134,66 @@ def test_will_show_exception_if_exec_fails(child_test, capsys, tmpdir, stdin, li
     else:
         assert child_test.process_table == {i: i for i in (1, 2)}
         assert 0 in child_test.closed
+
+
+@pytest.mark.parametrize("detach", [False, True])
+def test_sets_up_the_child(child_test, tmpdir, detach):
+    child_test.exec_error = PermissionError
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("")
+
+    with pytest.raises(SystemExit):
+        Each(
+            command="cat",
+            work_items=each_module.work_items_from_path(input_path),
+            destination=tmpdir.mkdir("output"),
+            detach=detach,
+        ).clear_queue()
+
+    assert len(child_test.execs) == 1
+    # Either way, it's in a process group of its own, so that killing the
+    # group kills everything the command started.
+    if detach:
+        assert child_test.sessions == 1
+    else:
+        assert child_test.process_groups == [(0, 0)]
+
+
+def test_detached_children_supervise_the_command(child_test, monkeypatch, tmpdir):
+    # The first fork is into the child, which then forks the command.
+    child_test.fork_pids = [0, 1234]
+    supervised = []
+
+    def supervise(pid, running_dir):
+        supervised.append(pid)
+        raise SystemExit(0)
+
+    monkeypatch.setattr(each_module, "supervise", supervise)
+    with pytest.raises(SystemExit):
+        Each(
+            command="cat",
+            work_items=[each_module.LineWorkItem("a", "")],
+            destination=tmpdir.mkdir("output"),
+            detach=True,
+        ).clear_queue()
+
+    assert supervised == [1234]
+    assert child_test.execs == []
+
+
+def test_pins_the_child(child_test, tmpdir):
+    child_test.exec_error = PermissionError
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("")
+
+    with pytest.raises(SystemExit):
+        each = Each(
+            command="cat",
+            work_items=each_module.work_items_from_path(input_path),
+            destination=tmpdir.mkdir("output"),
+            pin=CORES,
+        )
+        each.clear_queue()
+
+    assert len(child_test.execs) == 1
+    assert child_test.affinity == set(each.slot_cpus[0])
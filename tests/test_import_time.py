@@ -0,0 +1,64 @@
+import json
+import subprocess
+import sys
+
+"""Modules that ``import each`` shouldn't pull in, as only some runs need
+them. Checking which modules are imported, rather than how long importing
+takes, keeps this from depending on how busy the machine is."""
+DEFERRED_MODULES = [
+    "concurrent.futures",
+    "each.control",
+    "each.prediction",
+    "each.reduce",
+    "each.streaming",
+    "numpy",
+    "socket",
+    "subprocess",
+]
+
+
+def modules_imported_by(*args):
+    """Run each under ``-X importtime`` and return the names of every module
+    it imports."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "each"] + list(args),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return {
+        line.split("|")[-1].strip()
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:") and "cumulative" not in line
+    }
+
+
+def test_help_does_not_import_heavy_dependencies():
+    modules = modules_imported_by("--help")
+    assert "each" in modules
+    for module in DEFERRED_MODULES + ["tqdm"]:
+        assert module not in modules
+
+
+def imported_modules(statement):
+    """Run 'statement' in a fresh interpreter and return the names of every
+    module it leaves imported."""
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import json, sys; %s; print(json.dumps(sorted(sys.modules)))" % (statement,),
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return set(json.loads(process.stdout))
+
+
+def test_importing_each_defers_what_only_some_runs_need():
+    modules = imported_modules("import each")
+    assert "each.each" in modules
+    for module in DEFERRED_MODULES:
+        assert module not in modules
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from each import Each
+from each.each import LineWorkItem, work_items_from_directory
+
+
+def run(tmpdir, command="cat", **kwargs):
+    each = Each(
+        command=command,
+        work_items=work_items_from_directory(str(tmpdir.join("input"))),
+        destination=tmpdir.join("output"),
+        **kwargs
+    )
+    queued = sorted(item.name for item in each.work_queue)
+    each.clear_queue()
+    return queued
+
+
+@pytest.fixture
+def inputs(tmpdir):
+    input_files = tmpdir.mkdir("input")
+    for name in ["a", "b", "c"]:
+        input_files.join(name).write(name)
+    return input_files
+
+
+def test_only_reruns_changed_inputs(tmpdir, inputs):
+    assert run(tmpdir, incremental=True) == ["a", "b", "c"]
+    assert run(tmpdir, incremental=True) == []
+
+    inputs.join("b").write("something else")
+    assert run(tmpdir, incremental=True) == ["b"]
+    assert tmpdir.join("output").join("b").join("out").read() == "something else"
+
+
+def test_notices_touched_inputs(tmpdir, inputs):
+    run(tmpdir, incremental=True)
+    stat = os.stat(str(inputs.join("c")))
+    os.utime(str(inputs.join("c")), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert run(tmpdir, incremental=True) == ["c"]
+
+
+def test_skips_inputs_deleted_after_they_were_listed(tmpdir, inputs):
+    run(tmpdir, incremental=True)
+    work_items = list(work_items_from_directory(str(inputs)))
+    inputs.join("b").remove()
+    each = Each(
+        command="cat",
+        work_items=work_items,
+        destination=tmpdir.join("output"),
+        incremental=True,
+    )
+    each.clear_queue()
+
+    assert each.completed == 0
+    assert tmpdir.join("output").join("b").join("out").read() == "b"
+
+
+@pytest.mark.parametrize("change", [{"command": "cat -"}, {"stdin": False, "command": "cat {}"}])
+def test_reruns_everything_when_the_command_changes(tmpdir, inputs, change):
+    run(tmpdir, incremental=True)
+    assert run(tmpdir, incremental=True, **change) == ["a", "b", "c"]
+    assert run(tmpdir, incremental=True, **change) == []
+
+
+def test_reruns_results_from_non_incremental_runs(tmpdir, inputs):
+    run(tmpdir)
+    assert run(tmpdir, incremental=True) == ["a", "b", "c"]
+
+
+def test_ignores_changes_when_not_incremental(tmpdir, inputs):
+    run(tmpdir, incremental=True)
+    inputs.join("a").write("something else")
+    assert run(tmpdir, command="cat -") == []
+
+
+def test_a_non_incremental_run_forgets_fingerprints(tmpdir, inputs):
+    run(tmpdir, incremental=True)
+    run(tmpdir, command="cat -", recreate=True)
+    assert run(tmpdir, incremental=True) == ["a", "b", "c"]
+
+
+def test_lines_rerun_when_the_command_changes(tmpdir):
+    def run_lines(command):
+        each = Each(
+            command=command,
+            work_items=[LineWorkItem("hello", "hello")],
+            destination=tmpdir.join("output"),
+            incremental=True,
+        )
+        queued = len(each.work_queue)
+        each.clear_queue()
+        return queued
+
+    assert run_lines("cat") == 1
+    assert run_lines("cat") == 0
+    assert run_lines("cat -") == 1
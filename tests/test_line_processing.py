@@ -2,11 +2,12 @@ import hashlib
 import io
 import os
 import string
+import time
 
 import pytest
 from hypothesis import given, strategies as st
 
-from common import gather_output, get_directory_contents
+from common import gather_output, get_directory_contents, result_directories, wait_until_dead
 from each import Each, work_items_from_path
 from each.each import MAX_SIMPLE_NAME_SUFFIX_LENGTH, LineWorkItem, work_items_from_lines
 
@@ -63,7 +64,7 @@ def test_duplicate_lines(tmpdir):
     )
     each.clear_queue()
 
-    [output_file] = output_path.listdir()
+    [output_file] = result_directories(output_path)
     expected = {"status": "0", "in": line, "out": line, "err": ""}
     assert get_directory_contents(output_file) == expected
 
@@ -147,3 +148,23 @@ def test_creates_pipe(data):
     fd = item.as_input_file()
     output_line = os.read(fd, len(line.encode("utf-8"))).decode("utf-8")
     assert output_line.strip("\n") == line
+
+
+def test_kills_running_items_when_interrupted(tmpdir):
+    pid_file = tmpdir.join("pid")
+    each = Each(
+        command="read n; [ $n = slow ] && sh -c 'echo $$ > %s; exec sleep 10'; true" % (pid_file,),
+        work_items=[LineWorkItem(name, name + "\n") for name in ("slow", "fast")],
+        destination=tmpdir.join("output"),
+        processes=2,
+    )
+
+    def interrupt():
+        while not pid_file.check() or not pid_file.read():
+            time.sleep(0.01)
+        raise KeyboardInterrupt()
+
+    each.progress_callback = interrupt
+    with pytest.raises(KeyboardInterrupt):
+        each.clear_queue()
+    wait_until_dead(pid_file)
@@ -1,3 +1,4 @@
+import json
 import os
 import subprocess
 import sys
@@ -5,7 +6,7 @@ from shutil import which
 
 import pytest
 
-from common import gather_output, get_directory_contents
+from common import gather_output, get_directory_contents, result_directories
 
 
 @pytest.mark.parametrize("cat", ["cat", "cat {}"])
@@ -20,7 +21,7 @@ def test_processes_each_file(tmpdir, cat):
         [sys.executable, "-m", "each", str(input_path), cat, "--destination=%s" % (output_path,)]
     )
 
-    output_files = sorted(output_path.listdir())
+    output_files = result_directories(output_path)
     assert output_files == [output_path.join("%d.txt" % (i,)) for i in range(10)]
 
     for i, f in enumerate(output_files):
@@ -80,3 +81,49 @@ def test_respects_shell_argument(tmpdir, shell):
     written = output_files.join("sh").join("out").read().strip()
 
     assert os.path.basename(written) == os.path.basename(shell)
+
+
+def test_writes_a_trace(tmpdir):
+    input_files = tmpdir.mkdir("input")
+    input_files.join("hello").write("")
+    trace = tmpdir.join("trace.json")
+
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_files),
+            "cat",
+            "--destination=%s" % (tmpdir.join("output"),),
+            "--trace=%s" % (trace,),
+        ]
+    )
+
+    events = json.loads(trace.read())
+    assert [e["args"]["item"] for e in events if e["name"] == "run"] == ["hello"]
+
+
+def test_incremental_reruns_changed_files(tmpdir):
+    input_files = tmpdir.mkdir("input")
+    output_files = tmpdir.join("output")
+    for name in ["a", "b"]:
+        input_files.join(name).write(name)
+
+    def each():
+        subprocess.check_call(
+            [
+                sys.executable,
+                "-m",
+                "each",
+                str(input_files),
+                "cat",
+                "--destination=%s" % (output_files,),
+                "--incremental",
+            ]
+        )
+
+    each()
+    input_files.join("a").write("changed")
+    each()
+    assert output_files.join("a").join("out").read() == "changed"
@@ -0,0 +1,166 @@
+import subprocess
+import sys
+import time
+
+from common import wait_until_dead
+from each import Each
+from each.each import METADATA_DIR, OUTPUT_LIMIT_EXCEEDED, LineWorkItem
+from each.junkdrawer import file_size
+
+# Writes to stdout, or to stderr, forever if it's given "runaway".
+RUNAWAY_COMMAND = 'read n; if [ $n = runaway ]; then exec yes %s; fi; echo "$n"'
+
+
+def run(tmpdir, command, items=("a",), **kwargs):
+    output_path = tmpdir.join("output")
+    kwargs.setdefault("wait_timeout", 0.1)
+    each = Each(
+        command=command,
+        work_items=[LineWorkItem(name, name + "\n") for name in items],
+        destination=output_path,
+        **kwargs
+    )
+    each.clear_queue()
+    return output_path
+
+
+def test_kills_items_that_write_too_much(tmpdir):
+    output_path = run(
+        tmpdir,
+        RUNAWAY_COMMAND % ("",),
+        items=("runaway", "fine"),
+        processes=2,
+        max_output=100000,
+    )
+    runaway = output_path.join("runaway")
+    assert runaway.join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+    # What it wrote is cut down to the limit, keeping the start.
+    assert runaway.join("out").size() == 100000
+    assert runaway.join("out").read().startswith("y\ny\n")
+    assert output_path.join("fine").join("status").read() == "0\n"
+    assert output_path.join("fine").join("out").read() == "fine\n"
+
+
+def test_kills_items_that_write_too_many_errors(tmpdir):
+    output_path = run(
+        tmpdir, RUNAWAY_COMMAND % (">&2",), items=("runaway",), max_output=10, max_err=100000
+    )
+    runaway = output_path.join("runaway")
+    assert runaway.join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+    assert runaway.join("err").size() == 100000
+    assert runaway.join("out").size() == 0
+
+
+def test_kills_everything_the_item_started(tmpdir):
+    # Neither the shell nor the sleep writes anything, so only the process
+    # group being killed stops the sleep.
+    pid_file = tmpdir.join("pid")
+    output_path = run(
+        tmpdir,
+        "head -c 20000 /dev/zero; sh -c 'echo $$ > %s; exec sleep 10'; true" % (pid_file,),
+        max_output=10000,
+    )
+    wait_until_dead(pid_file)
+    assert output_path.join("a").join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+    assert output_path.join("a").join("out").size() == 10000
+
+
+def test_stops_the_item_writing_once_killed(tmpdir):
+    # The shell would carry on after yes if only yes were killed.
+    output_path = run(tmpdir, "yes; true", max_output=10000)
+    out = output_path.join("a").join("out")
+    assert output_path.join("a").join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+    assert out.size() == 10000
+    time.sleep(0.1)
+    assert out.size() == 10000
+
+
+def test_only_limits_the_streams_given(tmpdir):
+    output_path = run(tmpdir, "head -c 5000 /dev/zero", max_err=1000)
+    assert output_path.join("a").join("status").read() == "0\n"
+    assert output_path.join("a").join("out").size() == 5000
+
+
+def test_leaves_other_files_alone(tmpdir):
+    output_path = run(
+        tmpdir, 'head -c 5000 /dev/zero > "$EACH_SLOT_DIR/big"; echo ok', max_output=1000
+    )
+    assert output_path.join("a").join("status").read() == "0\n"
+    assert output_path.join("a").join("out").read() == "ok\n"
+    (big,) = output_path.join(METADATA_DIR).join("slots").visit("big")
+    assert big.size() == 5000
+
+
+def test_catches_items_that_finish_before_they_are_checked(tmpdir):
+    output_path = run(
+        tmpdir,
+        "head -c 2000 /dev/zero",
+        items=("a",),
+        max_output=1000,
+        wait_timeout=60,
+    )
+    assert output_path.join("a").join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+    assert output_path.join("a").join("out").size() == 1000
+
+
+def test_leaves_items_within_the_limits_alone(tmpdir):
+    output_path = run(tmpdir, "head -c 1000 /dev/zero; sleep 0.3", max_output=1000, max_err=0)
+    assert output_path.join("a").join("status").read() == "0\n"
+    assert output_path.join("a").join("out").size() == 1000
+
+
+def test_only_kills_items_once(tmpdir):
+    output_path = tmpdir.join("output")
+    each = Each(
+        command="yes",
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+        max_output=1000,
+    )
+    each.fill_work_in_progress()
+    (item_in_progress,) = each.work_in_progress.values()
+    while file_size(item_in_progress.out_file) <= 1000:
+        time.sleep(0.01)
+    each.enforce_limits()
+    assert item_in_progress.killed_status == OUTPUT_LIMIT_EXCEEDED
+    # It's not collected yet, but there's no need to kill it again.
+    each.limits_checked = 0.0
+    each.enforce_limits()
+    each.clear_queue()
+    assert output_path.join("a").join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+
+
+def test_kills_detached_items_that_write_too_much(tmpdir):
+    output_path = run(
+        tmpdir, RUNAWAY_COMMAND % ("",), items=("runaway",), max_output=100000, detach=True
+    )
+    runaway = output_path.join("runaway")
+    assert runaway.join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+    assert runaway.join("out").size() == 100000
+
+
+def test_measures_file_sizes(tmpdir):
+    tmpdir.join("a").write("hello")
+    assert file_size(str(tmpdir.join("a"))) == 5
+    assert file_size(str(tmpdir.join("missing"))) == 0
+
+
+def test_limits_output_from_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("")
+    output_path = tmpdir.join("output")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "head -c 2000 /dev/zero >&2",
+            "--max-err=1K",
+            "--destination=%s" % (output_path,),
+        ],
+        check=True,
+    )
+    result = output_path.join("hello")
+    assert result.join("status").read() == "%d\n" % (OUTPUT_LIMIT_EXCEEDED,)
+    assert result.join("err").size() == 1024
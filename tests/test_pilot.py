@@ -0,0 +1,148 @@
+import subprocess
+import sys
+
+import pytest
+
+from each import Each
+from each.each import LineWorkItem, RunAborted
+from each.junkdrawer import percentile
+
+
+def make_each(tmpdir, command, n=10, **kwargs):
+    progress = []
+    each = Each(
+        command=command,
+        work_items=[LineWorkItem(str(i), str(i)) for i in range(n)],
+        destination=tmpdir.mkdir("output"),
+        progress_callback=lambda: progress.append(1),
+        **kwargs
+    )
+    return each, progress
+
+
+def statuses(tmpdir):
+    return [p for p in tmpdir.join("output").listdir() if p.join("status").check()]
+
+
+def test_runs_the_pilot_first_and_reports_on_it(tmpdir):
+    reports = []
+
+    def report(r):
+        reports.append((r, len(progress)))
+
+    each, progress = make_each(
+        tmpdir, "true", pilot=3, processes=2, pilot_callback=report, max_failure_rate=0.5
+    )
+    each.clear_queue()
+
+    [(report, progress_at_report)] = reports
+    assert progress_at_report == 3
+    assert report.items == 3
+    assert report.failures == 0
+    assert report.failure_rate == 0
+    assert len(report.runtimes) == 3
+    assert report.runtime_percentile(50) == report.runtimes[1]
+    assert report.remaining == 7
+    assert report.prediction.percentile(50) > 0
+    assert len(progress) == 10
+
+
+def test_aborts_after_a_failing_pilot(tmpdir):
+    each, _ = make_each(tmpdir, "false", pilot=3, max_failure_rate=0.5)
+    with pytest.raises(RunAborted):
+        each.clear_queue()
+    assert len(statuses(tmpdir)) == 3
+
+
+def test_aborts_after_a_slow_pilot(tmpdir):
+    each, _ = make_each(tmpdir, "sleep 0.1", n=100, pilot=2, max_predicted_time=1)
+    with pytest.raises(RunAborted):
+        each.clear_queue()
+    assert len(statuses(tmpdir)) == 2
+
+
+def test_pilot_of_everything(tmpdir):
+    reports = []
+    each, progress = make_each(tmpdir, "true", n=3, pilot=5, pilot_callback=reports.append)
+    each.clear_queue()
+    [report] = reports
+    assert report.items == 3
+    assert report.prediction is None
+
+
+def test_circuit_breaker_stops_a_failing_run(tmpdir):
+    each, _ = make_each(
+        tmpdir, "false", n=20, processes=1, max_failure_rate=0.5, min_items_for_failure_rate=4
+    )
+    with pytest.raises(RunAborted):
+        each.clear_queue()
+    assert len(statuses(tmpdir)) == 4
+    assert not each.work_in_progress
+
+
+def test_circuit_breaker_lets_running_items_finish(tmpdir):
+    # Item 0 fails at once, while the others take a while to succeed.
+    each, _ = make_each(
+        tmpdir,
+        "test {} -ne 0 && sleep 0.2",
+        n=3,
+        stdin=False,
+        processes=3,
+        max_failure_rate=0.5,
+        min_items_for_failure_rate=1,
+    )
+    with pytest.raises(RunAborted):
+        each.clear_queue()
+    assert len(statuses(tmpdir)) == 3
+    assert each.completed == 3
+    assert not each.work_in_progress
+
+
+def test_circuit_breaker_tolerates_some_failures(tmpdir):
+    each, progress = make_each(
+        tmpdir,
+        "test {} -lt 8",
+        n=10,
+        stdin=False,
+        max_failure_rate=0.5,
+        min_items_for_failure_rate=1,
+    )
+    each.work_queue.sort(key=lambda item: int(item.name), reverse=True)
+    each.clear_queue()
+    assert each.failed == 2
+    assert len(progress) == 10
+
+
+def test_pilot_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    for i in range(5):
+        input_path.join(str(i)).write("")
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "false",
+            "--destination=%s" % (tmpdir.join("output"),),
+            "--pilot=2",
+            "--max-failure-rate=0.1",
+        ],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert process.returncode != 0
+    assert "Pilot: 2 of 2 items failed." in process.stderr
+    assert "maximum failure rate" in process.stderr
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [(0, 1), (10, 1), (50, 5), (51, 6), (100, 10)],
+)
+def test_percentiles(q, expected):
+    assert percentile(list(range(1, 11)), q) == expected
+
+
+def test_percentile_of_nothing():
+    assert percentile([], 50) is None
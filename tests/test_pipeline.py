@@ -0,0 +1,173 @@
+import os
+import subprocess
+import sys
+
+from common import get_contents, result_directories
+from each import Each
+from each.each import FileWorkItem, LineWorkItem, stage_destination
+
+
+def outputs(path):
+    return [get_contents(p.join("out")) for p in result_directories(path)]
+
+
+def lines(*names):
+    return [LineWorkItem(name, name + "\n") for name in names]
+
+
+def test_runs_each_stage_on_the_output_of_the_last(tmpdir):
+    destination = tmpdir.join("output")
+    progress = []
+    each = Each(
+        command="tr a-z A-Z",
+        then=["rev", "wc -c < {}"],
+        work_items=lines("abc", "de"),
+        destination=destination,
+        processes=2,
+        progress_callback=lambda: progress.append(1),
+    )
+    each.clear_queue()
+
+    assert outputs(destination) == ["ABC", "DE"]
+    assert outputs(tmpdir.join("output-2")) == ["CBA", "ED"]
+    assert outputs(tmpdir.join("output-3")) == ["4", "3"]
+    assert os.readlink(str(tmpdir.join("output-2").join("abc").join("in"))) == str(
+        destination.join("abc").join("out")
+    )
+    assert len(progress) == 2
+    assert each.completed == 2
+
+
+def test_stage_destinations(tmpdir):
+    assert stage_destination("results/", 0) == "results/"
+    assert stage_destination("results/", 1) == "results-2"
+    assert stage_destination(tmpdir, 2) == str(tmpdir) + "-3"
+
+
+def run_logged(tmpdir, work_items, **kwargs):
+    log = tmpdir.join("log")
+    each = Each(
+        command='read x; echo "a $x" >> %s; echo $x' % (log,),
+        then=['read x; echo "b $x" >> %s' % (log,)],
+        work_items=work_items,
+        destination=tmpdir.join("output"),
+        **kwargs
+    )
+    each.clear_queue()
+    return [line.split()[0] for line in log.read().splitlines()], each
+
+
+def test_later_stages_go_first_by_default(tmpdir):
+    stages, _ = run_logged(tmpdir, lines("1", "2", "3"))
+    assert stages == ["a", "b"] * 3
+
+
+def test_stage_priorities(tmpdir):
+    stages, _ = run_logged(tmpdir, lines("1", "2", "3"), stage_priorities=[1, 0])
+    assert stages == ["a"] * 3 + ["b"] * 3
+
+
+def test_failed_items_go_no_further(tmpdir):
+    each = Each(
+        command="grep ok",
+        then=["cat"],
+        work_items=lines("ok", "bad"),
+        destination=tmpdir.join("output"),
+    )
+    each.clear_queue()
+    assert [p.basename for p in result_directories(tmpdir.join("output-2"))] == ["ok"]
+    assert each.completed == 2
+    assert each.failed == 1
+
+
+def test_resumes_each_stage(tmpdir):
+    output = tmpdir.mkdir("output")
+    # Done with the first stage.
+    first = output.mkdir("1")
+    first.join("out").write("1\n")
+    first.join("status").write("0\n")
+    # Done with both.
+    for destination in [output, tmpdir.mkdir("output-2")]:
+        done = destination.mkdir("2")
+        done.join("out").write("2\n")
+        done.join("status").write("0\n")
+    # Failed at the first stage.
+    output.mkdir("3").join("status").write("1\n")
+
+    progress = []
+    stages, each = run_logged(
+        tmpdir, lines("1", "2", "3", "4"), progress_callback=lambda: progress.append(1)
+    )
+
+    assert sorted(tmpdir.join("log").read().splitlines()) == ["a 4", "b 1", "b 4"]
+    assert len(progress) == 4
+    assert each.completed == 2
+
+
+def test_retries_are_counted_per_stage(tmpdir):
+    tmpdir.mkdir("input").join("x").write("x")
+    marker = tmpdir.join("failed")
+    each = Each(
+        command="cat",
+        then=["if [ -e %s ]; then cat; else touch %s; exit 1; fi" % (marker, marker)],
+        work_items=[FileWorkItem("x", str(tmpdir.join("input").join("x")))],
+        destination=tmpdir.join("output"),
+        retries=1,
+        retry_policies={1: "retry"},
+    )
+    each.failure_counts["x"] = 1
+    each.clear_queue()
+    assert tmpdir.join("output-2").join("x").join("out").read() == "x"
+    assert each.failure_counts[(1, "x")] == 1
+
+
+def test_predicts_every_stage_still_to_run(tmpdir):
+    each = Each(
+        command="true",
+        then=["true", "true"],
+        work_items=lines("1", "2"),
+        destination=tmpdir.join("output"),
+    )
+    assert each.remaining_tasks([]) == 6
+    each.stages[2].queue.append(FileWorkItem("3", "", stage=2))
+    each.deferred.append((0, 0, FileWorkItem("4", "", stage=1)))
+    assert each.remaining_tasks([]) == 9
+
+
+def test_pipelines_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("hello")
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "cat",
+            "--then=rev",
+            "--then=tr a-z A-Z < {}",
+            "--stage-priorities=0,1,2",
+            "--destination=%s" % (tmpdir.join("output"),),
+        ],
+        check=True,
+    )
+    assert process.returncode == 0
+    assert tmpdir.join("output-3").join("hello").join("out").read() == "OLLEH"
+
+
+def test_needs_a_priority_for_every_stage(tmpdir):
+    for priorities in ["1", "a,b"]:
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "each",
+                str(tmpdir),
+                "cat",
+                "--then=cat",
+                "--stage-priorities=%s" % (priorities,),
+            ],
+            stderr=subprocess.PIPE,
+        )
+        assert process.returncode != 0
+        assert b"--stage-priorities" in process.stderr
@@ -1,6 +1,13 @@
+import subprocess
+import sys
+from random import Random
+
 import pytest
 
-from each.prediction import predict_timing
+from common import result_directories
+from each import Each
+from each.each import LARGEST_FIRST, FileWorkItem, LineWorkItem
+from each.prediction import SizeModel, predict_sized_timing, predict_timing
 
 
 @pytest.mark.parametrize("parallelism", [1, 4, 10])
@@ -16,3 +23,164 @@ def test_predictions_based_on_constant_data_are_fairly_consistent(
     assert prediction.mean != actual
     assert prediction.percentile(1) * 0.1 <= actual <= prediction.percentile(99) * 10
     assert prediction.percentile(1) * 0.1 <= prediction.mean <= prediction.percentile(99) * 10
+
+
+def test_size_model_fits_runtimes_proportional_to_size():
+    model = SizeModel.fit([1, 2, 3], [2, 4, 6])
+    assert model.slope == pytest.approx(2)
+    assert model.intercept == pytest.approx(0, abs=1e-9)
+    assert list(model.ratios) == pytest.approx([1, 1, 1])
+    assert list(model.expected([10])) == pytest.approx([20])
+
+
+@pytest.mark.parametrize("sizes", [[5, 5, 5], [1, 2, 3]])
+def test_size_model_ignores_size_unless_runtimes_grow_with_it(sizes):
+    model = SizeModel.fit(sizes, [3, 2, 1])
+    assert model.slope == 0
+    assert model.intercept == 2
+    assert list(model.expected([1, 100])) == [2, 2]
+
+
+def test_size_model_never_predicts_no_time():
+    model = SizeModel.fit([10, 20], [1, 3])
+    assert model.expected([0])[0] > 0
+
+
+@pytest.mark.parametrize("seed", [0, 384_139_841])
+def test_sized_predictions_agree_with_the_simulator_when_size_does_not_matter(seed):
+    times = [1, 2, 3, 4, 5] * 4
+    plain = predict_timing(times, [], 100, seed=seed, parallelism=4)
+    sized = predict_sized_timing(
+        times, [7] * len(times), [], [], [7] * 100, seed=seed, parallelism=4
+    )
+    assert sized.percentile(50) == pytest.approx(plain.percentile(50), rel=0.2)
+
+
+@pytest.mark.parametrize("seed", [0, 384_139_841])
+def test_sized_predictions_are_not_fooled_by_a_sample_of_small_items(seed):
+    sizes = list(range(1, 11))
+    times = [s * 0.1 for s in sizes]
+    remaining = [100] * 50
+    actual = 50 * 10 / 5
+
+    plain = predict_timing(times, [], len(remaining), seed=seed, parallelism=5)
+    sized = predict_sized_timing(times, sizes, [], [], remaining, seed=seed, parallelism=5)
+
+    assert sized.percentile(50) == pytest.approx(actual, rel=0.1)
+    assert plain.percentile(99) < actual / 5
+
+
+def test_sized_predictions_account_for_items_in_progress():
+    # One item of size 100 has run for 5s of its expected 10s, the other is
+    # overdue and so could take any time.
+    prediction = predict_sized_timing([1, 2], [10, 20], [5, 50], [100, 1], [])
+    assert 5 <= prediction.percentile(50)
+    assert prediction.percentile(1) < 10
+
+
+def lines_of_lengths(lengths):
+    return [LineWorkItem(str(n), "x" * n) for n in lengths]
+
+
+def test_runs_largest_items_first(tmpdir):
+    each = Each(
+        command="true",
+        work_items=lines_of_lengths([3, 1, 4, 5, 9, 2, 6]),
+        destination=tmpdir,
+        order=LARGEST_FIRST,
+    )
+    assert [item.size() for item in reversed(each.work_queue)] == [9, 6, 5, 4, 3, 2, 1]
+
+
+def test_pilot_is_a_random_sample_whatever_the_order(tmpdir):
+    reports = []
+    each = Each(
+        command="true",
+        work_items=lines_of_lengths(range(1, 21)),
+        destination=tmpdir,
+        order=LARGEST_FIRST,
+        pilot=4,
+        random=Random(1),
+        size_model=True,
+        pilot_callback=reports.append,
+    )
+    each.run_pilot()
+    assert len(each.work_queue) == 16
+    assert [item.size() for item in each.work_queue] == sorted(
+        item.size() for item in each.work_queue
+    )
+    ran = {result.basename for result in result_directories(tmpdir)}
+    assert len(ran) == 4
+    assert ran.isdisjoint(item.name for item in each.work_queue)
+    # Not just the first four in the queue, which would be the largest.
+    assert ran != {str(n) for n in range(17, 21)}
+    assert len(each.observed_sizes) == 4
+    [report] = reports
+    assert report.prediction.percentile(50) > 0
+
+
+def test_predicts_from_sizes_while_running(tmpdir):
+    predictions = []
+    each = Each(
+        command="sleep 0.01",
+        work_items=lines_of_lengths(range(1, 11)),
+        destination=tmpdir,
+        processes=2,
+        size_model=True,
+        prediction_callback=predictions.append,
+    )
+    each.retries = 1
+    each.clear_queue()
+    assert predictions
+    assert len(each.observed_sizes) == len(each.runtimes) == 10
+    each.work_queue = lines_of_lengths([100])
+    each.deferred = [(0, 0, LineWorkItem("a", "a"))]
+    assert each.predict([], parallelism=2).percentile(50) > 0
+
+
+def test_sizes_of_items(tmpdir):
+    path = tmpdir.join("hello")
+    path.write("hello")
+    item = FileWorkItem("hello", str(path))
+    assert item.size() == 5
+    path.remove()
+    assert item.size() == 0
+    assert LineWorkItem("snowman", "☃\n").size() == 4
+
+
+def test_cannot_order_streamed_items(tmpdir):
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            "-",
+            "cat",
+            "--destination=%s" % (tmpdir,),
+            "--order=largest-first",
+        ],
+        input=b"",
+        stderr=subprocess.PIPE,
+    )
+    assert process.returncode != 0
+    assert b"order they arrive" in process.stderr
+
+
+def test_size_model_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    for i in range(5):
+        input_path.join(str(i)).write("x" * i)
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "cat",
+            "--destination=%s" % (tmpdir.join("output"),),
+            "--size-model",
+            "--order=largest-first",
+        ],
+        check=True,
+    )
+    assert tmpdir.join("output").join("4").join("out").read() == "xxxx"
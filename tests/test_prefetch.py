@@ -0,0 +1,128 @@
+import os
+import subprocess
+import sys
+
+import attr
+
+from each import Each
+from each.each import FileWorkItem, LineWorkItem
+from each.prefetch import Prefetcher
+
+
+@attr.s()
+class RecordingItem(LineWorkItem):
+    prefetched = attr.ib(default=0)
+
+    def prefetch(self):
+        self.prefetched += 1
+
+
+def recording_items(*sizes):
+    return [RecordingItem(str(i), "x" * (size - 1) + "\n") for i, size in enumerate(sizes)]
+
+
+def test_prefetches_the_next_items_in_order():
+    items = recording_items(10, 10, 10, 10)
+    prefetcher = Prefetcher(depth=2, budget=100)
+    prefetcher.prefetch(iter(items))
+    assert [item.prefetched for item in items] == [1, 1, 0, 0]
+    assert prefetcher.held_bytes == 20
+
+    # Already prefetched items aren't prefetched again.
+    prefetcher.prefetch(iter(items[1:]))
+    assert [item.prefetched for item in items] == [1, 1, 1, 0]
+
+
+def test_stays_within_its_budget():
+    items = recording_items(40, 40, 10, 10)
+    prefetcher = Prefetcher(depth=4, budget=85)
+    prefetcher.prefetch(iter(items))
+    # Stops at the first item that doesn't fit, rather than skipping ahead.
+    assert [item.prefetched for item in items] == [1, 1, 0, 0]
+
+    prefetcher.release(items[0])
+    assert prefetcher.held_bytes == 40
+    prefetcher.prefetch(iter(items[1:]))
+    assert [item.prefetched for item in items] == [1, 1, 1, 1]
+    assert prefetcher.held_bytes == 60
+
+    # Releasing an item we never prefetched changes nothing.
+    prefetcher.release(LineWorkItem("other", ""))
+    assert prefetcher.held_bytes == 60
+
+
+def test_prefetches_files(tmpdir):
+    path = tmpdir.join("input")
+    path.write("hello")
+    FileWorkItem("input", str(path)).prefetch()
+    # Missing files are skipped, as they won't be run.
+    FileWorkItem("missing", str(tmpdir.join("missing"))).prefetch()
+
+
+def test_does_nothing_without_fadvise(tmpdir, monkeypatch):
+    monkeypatch.delattr(os, "posix_fadvise")
+    FileWorkItem("missing", str(tmpdir.join("missing"))).prefetch()
+
+
+def test_prefetches_while_running(tmpdir):
+    items = recording_items(*[5] * 10)
+    items.append(LineWorkItem("plain", "\n"))
+    output_path = tmpdir.join("output")
+    each = Each(
+        command="cat",
+        work_items=items,
+        destination=output_path,
+        processes=2,
+        prefetch=3,
+        prefetch_budget=20,
+    )
+    each.clear_queue()
+
+    for item in items:
+        assert output_path.join(item.name).join("status").read() == "0\n"
+    assert sum(item.prefetched for item in items[:-1]) >= 5
+    assert all(item.prefetched <= 1 for item in items[:-1])
+    assert each.prefetcher.held == {}
+    assert each.prefetcher.held_bytes == 0
+
+
+def test_releases_retried_and_missing_items(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    for name in "abc":
+        input_path.join(name).write(name)
+    items = [FileWorkItem(name, str(input_path.join(name))) for name in "abc"]
+    input_path.join("c").remove()
+    output_path = tmpdir.join("output")
+    each = Each(
+        command="exit 1",
+        work_items=items,
+        destination=output_path,
+        prefetch=3,
+        retries=1,
+        retry_delay=0.01,
+    )
+    each.clear_queue()
+    assert each.failed == 2
+    assert each.prefetcher.held_bytes == 0
+
+
+def test_prefetches_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    for i in range(5):
+        input_path.join(str(i)).write("hello %d\n" % (i,))
+    output_path = tmpdir.join("output")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "cat",
+            "--prefetch=2",
+            "--prefetch-budget=1K",
+            "--destination=%s" % (output_path,),
+        ],
+        check=True,
+    )
+    for i in range(5):
+        assert output_path.join(str(i)).join("out").read() == "hello %d\n" % (i,)
@@ -0,0 +1,164 @@
+import io
+import json
+import subprocess
+import sys
+
+import attr
+
+from each import Each
+from each.each import LineWorkItem
+from each.progress import JsonlProgress, NullProgress, TqdmProgress
+
+
+@attr.s()
+class FakeClock(object):
+    now = attr.ib(default=100.0)
+
+    def __call__(self):
+        return self.now
+
+
+@attr.s()
+class FakePrediction(object):
+    seconds = attr.ib()
+
+    def percentile(self, q):
+        return self.seconds * q / 100
+
+
+def make_each(tmpdir, n=4):
+    return Each(
+        command="true",
+        work_items=[LineWorkItem(str(i), "") for i in range(n)],
+        destination=tmpdir.mkdir("output"),
+    )
+
+
+def test_records_aggregate_progress(tmpdir):
+    clock = FakeClock()
+    progress = JsonlProgress(stream=io.StringIO(), interval=5, clock=clock)
+    each = make_each(tmpdir)
+    each.failed = 1
+
+    clock.now += 10
+    for _ in range(5):
+        progress.update()
+    assert progress.record(each) == {
+        "elapsed": 10.0,
+        "done": 5,
+        "failed": 1,
+        "in_flight": 0,
+        "queued": 4,
+        "rate": 0.5,
+        "eta_p50": None,
+        "eta_p99": None,
+    }
+
+    progress.new_prediction(FakePrediction(100))
+    clock.now += 4
+    progress.update()
+    record = progress.record(each)
+    assert record["rate"] == 0.25
+    assert record["eta_p50"] == 46
+    assert record["eta_p99"] == 95
+
+    clock.now += 200
+    record = progress.record(each)
+    assert record["rate"] == 0
+    assert record["eta_p99"] == 0
+    assert progress.record(each)["rate"] is None
+
+
+def test_reports_periodically_and_at_the_end(tmpdir):
+    stream = io.StringIO()
+    progress = JsonlProgress(stream=stream, interval=0.01)
+    each = make_each(tmpdir)
+    each.progress_callback = progress.update
+    each.command = "sleep 0.1"
+    with progress.running(each):
+        each.clear_queue()
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(records) > 2
+    assert records[-1]["done"] == 4
+    assert records[-1]["queued"] == 0
+
+
+def test_progress_bar(tmpdir, capsys):
+    progress = TqdmProgress()
+    each = make_each(tmpdir, n=2)
+    each.progress_callback = progress.update
+    progress.new_prediction(FakePrediction(1))
+    progress.new_prediction(FakePrediction(3 * 24 * 60 * 60))
+    with progress.running(each):
+        assert progress.bar.total == 2
+        each.clear_queue()
+        progress.write("hello")
+    assert progress.bar.n == 2
+    assert "hello" in capsys.readouterr().err
+
+
+def test_counts_items_queued_for_later_stages(tmpdir):
+    Each(
+        command="true",
+        work_items=[LineWorkItem(str(i), "") for i in range(3)],
+        destination=tmpdir.join("output"),
+    ).clear_queue()
+    # Three items only have the second stage left to run.
+    each = Each(
+        command="true",
+        then=["cat"],
+        work_items=[LineWorkItem(str(i), "") for i in range(4)],
+        destination=tmpdir.join("output"),
+    )
+    assert JsonlProgress(stream=io.StringIO()).record(each)["queued"] == 4
+
+    progress = TqdmProgress()
+    each.progress_callback = progress.update
+    with progress.running(each):
+        assert progress.bar.total == 4
+        each.clear_queue()
+    assert progress.bar.n == 4
+
+
+def test_null_progress(tmpdir, capsys):
+    progress = NullProgress()
+    progress.update()
+    progress.new_prediction(FakePrediction(1))
+    with progress.running(make_each(tmpdir)):
+        progress.write("hello")
+    assert capsys.readouterr().err == "hello\n"
+
+
+def run_each(tmpdir, *args):
+    input_path = tmpdir.mkdir("input")
+    for i in range(3):
+        input_path.join(str(i)).write("")
+    return subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "true",
+            "--destination=%s" % (tmpdir.join("output"),),
+        ]
+        + list(args),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def test_reports_jsonl_without_a_terminal(tmpdir):
+    process = run_each(tmpdir)
+    [record] = [json.loads(line) for line in process.stderr.splitlines()]
+    assert record["done"] == 3
+    assert record["failed"] == 0
+
+
+def test_can_report_nothing(tmpdir):
+    assert run_each(tmpdir, "--progress=none").stderr == ""
+
+
+def test_can_draw_a_progress_bar_anyway(tmpdir):
+    assert "3/3" in run_each(tmpdir, "--progress=tty").stderr
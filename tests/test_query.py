@@ -0,0 +1,122 @@
+import json
+import subprocess
+import sys
+
+from each import Each
+from each.cache import ResultCache
+from each.each import INDEX, METADATA_DIR, LineWorkItem
+from each.query import failures, read_index, summarise
+
+
+def run_items(destination, items):
+    Each(
+        command='read n; echo "$n"; exit "$n"',
+        work_items=[LineWorkItem(name, "%d\n" % (status,)) for name, status in items],
+        destination=destination,
+    ).clear_queue()
+
+
+def test_summarises_a_run(tmpdir):
+    destination = tmpdir.join("output")
+    run_items(destination, [("a", 0), ("b", 0), ("c", 1), ("d", 3)])
+
+    summary = summarise(str(destination))
+    assert summary.items == 4
+    assert summary.succeeded == 2
+    assert summary.unfinished == 0
+    assert summary.statuses == {0: 2, 1: 1, 3: 1}
+    assert summary.failed == ["c", "d"]
+    assert len(summary.runtimes) == 4
+    assert summary.runtime_percentile(100) == max(summary.runtimes)
+    assert failures(str(destination)) == ["c", "d"]
+
+
+def test_reads_status_files_of_items_missing_from_the_index(tmpdir):
+    destination = tmpdir.join("output")
+    run_items(destination, [("a", 0), ("b", 2)])
+    destination.join(METADATA_DIR).join(INDEX).remove()
+    # Interrupted before it had a status.
+    destination.mkdir("c")
+    destination.join("stray-file").write("")
+
+    summary = summarise(str(destination))
+    assert summary.statuses == {0: 1, 2: 1, None: 1}
+    assert summary.unfinished == 1
+    assert summary.failed == ["b"]
+    assert summary.runtimes == []
+
+
+def test_later_index_entries_win(tmpdir):
+    destination = tmpdir.join("output")
+    index = destination.mkdir().mkdir(METADATA_DIR).join(INDEX)
+    index.write(
+        "".join(
+            [
+                json.dumps(["a", 1, 0.5]) + "\n",
+                json.dumps(["b", 0, 0.25]) + "\n",
+                json.dumps(["a", 0, 1.5]) + "\n",
+                '["c", 0',
+            ]
+        )
+    )
+    assert read_index(str(destination)) == {"a": (0, 1.5), "b": (0, 0.25)}
+
+
+def test_leaves_cache_hits_out_of_the_runtimes(tmpdir):
+    cache = ResultCache(str(tmpdir.join("cache")))
+    for destination in ["first", "second"]:
+        Each(
+            command="sleep 0.1",
+            work_items=[LineWorkItem("a", "")],
+            destination=tmpdir.join(destination),
+            cache=cache,
+        ).clear_queue()
+
+    assert read_index(str(tmpdir.join("second"))) == {"a": (0, None)}
+    summary = summarise(str(tmpdir.join("second")))
+    assert summary.succeeded == 1
+    assert summary.runtimes == []
+    assert summary.runtime_percentile(50) is None
+
+
+def test_records_rerun_items_in_the_index(tmpdir):
+    destination = tmpdir.join("output")
+    run_items(destination, [("a", 1)])
+    destination.join("a").remove()
+    run_items(destination, [("a", 0)])
+
+    assert read_index(str(destination))["a"][0] == 0
+    assert failures(str(destination)) == []
+
+
+def test_has_an_empty_summary_without_an_index(tmpdir):
+    summary = summarise(str(tmpdir))
+    assert summary.items == 0
+    assert summary.runtime_percentile(50) is None
+
+
+def each_command(*args):
+    return subprocess.run(
+        [sys.executable, "-m", "each"] + list(args),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+
+
+def test_status_and_failures_on_the_command_line(tmpdir):
+    destination = tmpdir.join("output")
+    run_items(destination, [("a", 0), ("b", 4), ("c", 4)])
+    destination.mkdir("d")
+
+    status = each_command("status", str(destination)).splitlines()
+    assert status[:6] == [
+        "items: 4",
+        "succeeded: 1",
+        "failed: 2",
+        "unfinished: 1",
+        "status 0: 1",
+        "status 4: 2",
+    ]
+    assert status[6].startswith("runtimes: p50 ")
+    assert each_command("failures", str(destination)) == "b\nc\n"
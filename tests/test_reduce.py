@@ -0,0 +1,167 @@
+import os
+import subprocess
+import sys
+
+import attr
+import pytest
+
+from each import SHELL, Each
+from each.each import METADATA_DIR, LineWorkItem
+from each.reduce import Aggregate, CommandReducer, Reducer
+
+SUM = CommandReducer("awk '{ s += $1 } END { print s + 0 }' \"$@\"", SHELL)
+
+
+@attr.s()
+class RecordingSum(Reducer):
+    """Adds up numbers, remembering every file it was asked to read."""
+
+    inputs = attr.ib(default=attr.Factory(list))
+
+    def combine(self, inputs, output):
+        self.inputs.extend(inputs)
+        total = 0
+        for path in inputs:
+            with open(path) as i:
+                total += sum(int(line) for line in i if line.strip())
+        with open(output, "w") as o:
+            print(total, file=o)
+
+
+def numbers(n, start=1):
+    return [LineWorkItem(str(i), "%d\n" % (i,)) for i in range(start, start + n)]
+
+
+def reduce_dir(destination):
+    return destination.join(METADATA_DIR).join("reduce")
+
+
+def test_keeps_a_running_aggregate(tmpdir):
+    destination = tmpdir.join("output")
+    each = Each(
+        command="cat",
+        work_items=numbers(20),
+        destination=destination,
+        reducer=SUM,
+        reduce_batch_size=3,
+        processes=2,
+    )
+    each.clear_queue()
+
+    assert reduce_dir(destination).join("aggregate").read() == "210\n"
+    assert sorted(reduce_dir(destination).listdir("aggregate-*")) == [
+        reduce_dir(destination).join("aggregate-%d" % (each.aggregate.generation,))
+    ]
+    assert each.aggregate.generation > 1
+    log = reduce_dir(destination).join("log").read().splitlines()
+    assert sorted(int(line.split("\t")[1]) for line in log) == list(range(1, 21))
+
+
+def test_only_successful_outputs_are_included(tmpdir):
+    destination = tmpdir.join("output")
+    Each(
+        command="read x; echo $x; test $x -lt 3",
+        work_items=numbers(5),
+        destination=destination,
+        reducer=SUM,
+    ).clear_queue()
+    assert reduce_dir(destination).join("aggregate").read() == "3\n"
+
+
+def test_resumes_without_rereading_finished_items(tmpdir):
+    destination = tmpdir.join("output")
+    Each(command="cat", work_items=numbers(5), destination=destination, reducer=SUM).clear_queue()
+
+    reducer = RecordingSum()
+    Each(
+        command="cat", work_items=numbers(10), destination=destination, reducer=reducer
+    ).clear_queue()
+
+    assert reduce_dir(destination).join("aggregate").read() == "55\n"
+    read = [os.path.basename(os.path.dirname(path)) for path in reducer.inputs]
+    assert sorted(read) == ["10", "6", "7", "8", "9", "reduce"]
+
+
+def test_starts_again_when_recreating(tmpdir):
+    destination = tmpdir.join("output")
+    Each(command="cat", work_items=numbers(3), destination=destination, reducer=SUM).clear_queue()
+    Each(
+        command="cat",
+        work_items=numbers(3),
+        destination=destination,
+        reducer=SUM,
+        recreate=True,
+    ).clear_queue()
+    assert reduce_dir(destination).join("aggregate").read() == "6\n"
+
+
+def test_recovers_from_an_interrupted_fold(tmpdir):
+    path = tmpdir.join("reduce")
+    aggregate = Aggregate(str(path), RecordingSum(), batch_size=1000)
+    for i in range(1, 4):
+        tmpdir.join(str(i)).write("%d\n" % (i,))
+        aggregate.add(str(i), str(tmpdir.join(str(i))))
+    aggregate.flush()
+    # Half way through writing another version.
+    path.join("aggregate-2").write("100\n")
+    path.join("log").write("2\t4\n", mode="a")
+    path.mkdir("tmp").join("0").write("")
+    os.symlink("aggregate-2", str(path.join("aggregate.tmp")))
+
+    aggregate = Aggregate(str(path), RecordingSum())
+    assert aggregate.generation == 1
+    assert aggregate.included == {"1", "2", "3"}
+    assert sorted(p.basename for p in path.listdir()) == ["aggregate", "aggregate-1", "log"]
+    assert path.join("log").read() == "1\t1\n1\t2\n1\t3\n"
+
+
+def test_combines_big_batches_in_groups(tmpdir):
+    reducer = RecordingSum()
+    aggregate = Aggregate(str(tmpdir.join("reduce")), reducer, batch_size=1000, fan_in=2, workers=2)
+    for i in range(1, 8):
+        tmpdir.join(str(i)).write("%d\n" % (i,))
+        aggregate.add(str(i), str(tmpdir.join(str(i))))
+    aggregate.add("1", str(tmpdir.join("1")))
+    aggregate.flush()
+    assert tmpdir.join("reduce").join("aggregate").read() == "28\n"
+    # 7 files, then 4 partial results, then 2.
+    assert len(reducer.inputs) == 7 + 4 + 2
+
+
+def test_folds_after_an_interval(tmpdir):
+    aggregate = Aggregate(str(tmpdir.join("reduce")), RecordingSum(), interval=0)
+    tmpdir.join("1").write("1\n")
+    aggregate.add("1", str(tmpdir.join("1")))
+    assert aggregate.generation == 1
+    aggregate.flush()
+    assert aggregate.generation == 1
+
+
+def test_failures_to_reduce_are_raised(tmpdir):
+    failing = CommandReducer("exit 3", SHELL)
+    each = Each(
+        command="cat", work_items=numbers(1), destination=tmpdir.join("output"), reducer=failing
+    )
+    with pytest.raises(subprocess.CalledProcessError):
+        each.clear_queue()
+
+
+def test_reduces_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    for i in range(1, 5):
+        input_path.join(str(i)).write("%d\n" % (i,))
+    destination = tmpdir.join("output")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "cat",
+            '--reduce=cat "$@" | sort -n',
+            "--reduce-batch-size=2",
+            "--destination=%s" % (destination,),
+        ],
+        check=True,
+    )
+    assert reduce_dir(destination).join("aggregate").read() == "1\n2\n3\n4\n"
@@ -1,6 +1,10 @@
 import sys
+from random import Random
+
+import pytest
 
 from each import Each, work_items_from_path
+from each.each import NEVER, RETRY, LineWorkItem, backoff_delay
 
 
 def test_retries_failures_from_a_previous_run(tmpdir):
@@ -62,3 +66,108 @@ def test_retries_failures_in_the_current_run(tmpdir):
     each.clear_queue()
 
     assert counter.read() == "3"
+
+
+FAIL_ONCE = """
+import os
+import sys
+import time
+
+if __name__ == '__main__':
+    log, name = sys.argv[1:]
+
+    with open(log, 'a') as o:
+        o.write('%s %f\\n' % (name, time.monotonic()))
+
+    marker = log + '-' + name
+    if name.startswith('flaky') and not os.path.exists(marker):
+        open(marker, 'w').close()
+        sys.exit(int(name.split('-')[1]))
+"""
+
+
+def run_logged(tmpdir, names, **kwargs):
+    log = tmpdir.join("log")
+    script = tmpdir.join("fail_once.py")
+    script.write(FAIL_ONCE)
+    each = Each(
+        command="%s %s %s {}" % (sys.executable, script, log),
+        stdin=False,
+        work_items=[LineWorkItem(name, name) for name in names],
+        destination=tmpdir.mkdir("output"),
+        **kwargs
+    )
+    # Make sure the items run in the order given.
+    each.work_queue.sort(key=lambda item: names.index(item.name), reverse=True)
+    each.clear_queue()
+    return [line.split() for line in log.read().splitlines()]
+
+
+def test_backs_off_before_retrying(tmpdir):
+    log = run_logged(tmpdir, ["flaky-1"], retries=1, retry_delay=0.4)
+    assert [name for name, _ in log] == ["flaky-1", "flaky-1"]
+    assert float(log[1][1]) - float(log[0][1]) >= 0.2
+
+
+def test_runs_other_items_while_waiting_to_retry(tmpdir):
+    log = run_logged(tmpdir, ["flaky-1", "healthy"], retries=1, retry_delay=0.5, processes=1)
+    assert [name for name, _ in log] == ["flaky-1", "healthy", "flaky-1"]
+
+
+def test_retries_while_other_items_are_still_running(tmpdir):
+    log = tmpdir.join("log")
+    marker = tmpdir.join("marker")
+    output_files = tmpdir.mkdir("output")
+    Each(
+        command=(
+            'read n; echo "$n" >> {log}; if [ $n = slow ]; then sleep 1; echo done >> {log}; '
+            "elif [ ! -e {marker} ]; then touch {marker}; exit 1; fi"
+        ).format(log=log, marker=marker),
+        work_items=[LineWorkItem(name, name + "\n") for name in ["flaky", "slow"]],
+        destination=output_files,
+        processes=2,
+        retries=1,
+        retry_delay=0.2,
+    ).clear_queue()
+    assert sorted(log.read().splitlines()[:2]) == ["flaky", "slow"]
+    assert log.read().splitlines()[2:] == ["flaky", "done"]
+    assert output_files.join("flaky").join("status").read() == "0\n"
+
+
+def test_immediate_retry_policy(tmpdir):
+    log = run_logged(
+        tmpdir, ["flaky-1", "healthy"], retries=1, retry_delay=10, retry_policies={1: RETRY}
+    )
+    assert [name for name, _ in log] == ["flaky-1", "flaky-1", "healthy"]
+
+
+def test_never_retry_policy(tmpdir):
+    log = run_logged(
+        tmpdir, ["flaky-2", "flaky-3"], retries=1, retry_delay=0.01, retry_policies={2: NEVER}
+    )
+    assert [name for name, _ in log] == ["flaky-2", "flaky-3", "flaky-3"]
+    assert tmpdir.join("output").join("flaky-2").join("status").read().strip() == "2"
+
+
+def test_never_retry_policy_applies_to_previous_runs(tmpdir):
+    output_files = tmpdir.mkdir("output")
+    for status in [2, 3]:
+        output_files.mkdir(str(status)).join("status").write("%d\n" % (status,))
+
+    each = Each(
+        command="true",
+        work_items=[LineWorkItem(str(status), "") for status in [2, 3]],
+        destination=output_files,
+        retries=1,
+        retry_policies={2: NEVER},
+    )
+
+    assert [item.name for item in each.work_queue] == ["3"]
+
+
+@pytest.mark.parametrize("failures", range(1, 10))
+def test_backoff_delay_is_bounded(failures):
+    random = Random(failures)
+    delay = backoff_delay(failures, 1.0, 60.0, random)
+    expected = min(60.0, 2.0 ** (failures - 1))
+    assert expected / 2 <= delay <= expected
@@ -0,0 +1,169 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from common import wait_until_dead
+from each import Each
+from each.each import SCRATCH_QUOTA_EXCEEDED, LineWorkItem, exit_status
+from each.junkdrawer import disk_usage
+
+
+def run(tmpdir, command, items=("a",), **kwargs):
+    scratch = tmpdir.ensure_dir("scratch")
+    output_path = tmpdir.join("output")
+    each = Each(
+        command=command,
+        work_items=[LineWorkItem(name, name + "\n") for name in items],
+        destination=output_path,
+        scratch=str(scratch),
+        wait_timeout=0.1,
+        **kwargs
+    )
+    each.clear_queue()
+    return scratch, output_path
+
+
+def test_gives_each_item_its_own_scratch_directory(tmpdir):
+    scratch, output_path = run(
+        tmpdir,
+        'echo "$EACH_SCRATCH_DIR"; echo "$TMPDIR"; ls -A "$EACH_SCRATCH_DIR"',
+        items=("a", "b"),
+        processes=2,
+    )
+    dirs = set()
+    for name in ("a", "b"):
+        result = output_path.join(name)
+        assert result.join("status").read() == "0\n"
+        scratch_dir, tmp, *contents = result.join("out").read().splitlines()
+        assert scratch_dir == tmp
+        assert scratch_dir.startswith(str(scratch) + os.sep)
+        assert contents == []
+        dirs.add(scratch_dir)
+    assert len(dirs) == 2
+    # Everything is cleaned up afterwards.
+    assert scratch.listdir() == []
+
+
+def test_keeps_matching_files_from_successful_items(tmpdir):
+    command = (
+        'cd "$EACH_SCRATCH_DIR"; read n; mkdir sub; echo $n > result.txt; echo $n > sub/b.txt;'
+        "echo tmp > junk.tmp; [ $n = a ]"
+    )
+    scratch, output_path = run(
+        tmpdir, command, items=("a", "b"), keep_scratch=["*.txt", "sub/*.txt"]
+    )
+
+    a = output_path.join("a")
+    assert a.join("status").read() == "0\n"
+    assert a.join("result.txt").read() == "a\n"
+    assert a.join("sub").join("b.txt").read() == "a\n"
+    assert not a.join("junk.tmp").check()
+
+    b = output_path.join("b")
+    assert b.join("status").read() == "1\n"
+    assert not b.join("result.txt").check()
+    assert scratch.listdir() == []
+
+
+def test_kills_items_over_their_scratch_quota(tmpdir):
+    # The sleep isn't the shell, so only stops if everything the item
+    # started is killed.
+    pid_file = tmpdir.join("pid")
+    command = (
+        'read n; if [ $n = big ]; then head -c 1000000 /dev/zero > "$TMPDIR/big"; '
+        "sh -c 'echo $$ > %s; exec sleep 10'; fi" % (pid_file,)
+    )
+    scratch, output_path = run(
+        tmpdir, command, items=("big", "small"), processes=2, scratch_quota=100000
+    )
+    assert output_path.join("big").join("status").read() == "%d\n" % (SCRATCH_QUOTA_EXCEEDED,)
+    assert output_path.join("small").join("status").read() == "0\n"
+    assert scratch.listdir() == []
+    wait_until_dead(pid_file)
+
+
+def test_records_the_signal_that_killed_an_item(tmpdir):
+    output_path = tmpdir.join("output")
+    Each(
+        command="kill -TERM $$",
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+    ).clear_queue()
+    assert output_path.join("a").join("status").read() == "143\n"
+
+
+@pytest.mark.parametrize("result, status", [(0, 0), (3 << 8, 3), (9, 137)])
+def test_exit_status(result, status):
+    assert exit_status(result) == status
+
+
+def test_measures_disk_usage(tmpdir):
+    tmpdir.join("a").write("x" * 10000)
+    tmpdir.mkdir("sub").join("b").write("x" * 10000)
+    assert disk_usage(str(tmpdir)) >= 20000
+    assert disk_usage(str(tmpdir.join("missing"))) == 0
+
+
+def test_measures_disk_usage_while_files_are_deleted(tmpdir, monkeypatch):
+    tmpdir.join("a").write("x" * 10000)
+    scandir = os.scandir
+
+    def scan_then_delete(path):
+        entries = list(scandir(path))
+        for entry in entries:
+            os.remove(entry.path)
+        return entries
+
+    monkeypatch.setattr(os, "scandir", scan_then_delete)
+    assert disk_usage(str(tmpdir)) == 0
+
+
+def test_cancelling_an_item_throws_away_its_scratch(tmpdir):
+    each = Each(
+        command="sleep 10",
+        work_items=[LineWorkItem("a", "")],
+        destination=tmpdir.join("output"),
+        scratch=str(tmpdir.mkdir("scratch")),
+    )
+    each.fill_work_in_progress()
+    ((key, item_in_progress),) = each.work_in_progress.items()
+    each.cancel(key)
+    assert not os.path.exists(item_in_progress.scratch_dir)
+    assert not os.path.exists(item_in_progress.staging_dir)
+    assert each.free_slots == [0]
+
+
+def test_requires_scratch_for_scratch_options(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    result = subprocess.run(
+        [sys.executable, "-m", "each", str(input_path), "true", "--scratch-quota=1M"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode != 0
+    assert "need --scratch" in result.stderr
+
+
+def test_uses_scratch_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("")
+    scratch = tmpdir.mkdir("scratch")
+    output_path = tmpdir.join("output")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            'echo hi > "$EACH_SCRATCH_DIR/kept"',
+            "--scratch=%s" % (scratch,),
+            "--keep-scratch=kept",
+            "--scratch-quota=1M",
+            "--destination=%s" % (output_path,),
+        ],
+        check=True,
+    )
+    assert output_path.join("hello").join("kept").read() == "hi\n"
+    assert scratch.listdir() == []
@@ -0,0 +1,215 @@
+import json
+import subprocess
+import sys
+from random import Random
+
+import pytest
+
+from each import Each
+from each.each import INDEX, LARGEST_FIRST, METADATA_DIR, NEVER, RANDOM, RETRY, LineWorkItem
+from each.prediction import simulate_schedule
+from each.simulation import (
+    DISTRIBUTIONS,
+    LONGEST_FIRST,
+    PARETO,
+    POLICIES,
+    SimulatedItem,
+    SimulationResult,
+    items_from_results,
+    order_items,
+    simulate,
+    synthetic_items,
+)
+
+
+def items(*runtimes):
+    return [SimulatedItem(str(i), runtime, size=runtime) for i, runtime in enumerate(runtimes)]
+
+
+def test_runs_items_as_soon_as_a_slot_is_free():
+    result = simulate(items(1, 1, 1, 1), processes=2)
+    assert result.makespan == 2
+    assert result.utilisation == 1
+    assert result.failed == 0
+
+
+def test_agrees_with_the_schedule_predictions_are_made_from():
+    simulated = synthetic_items(50, seed=3)
+    for processes in (1, 3, 8):
+        queue = order_items(simulated, RANDOM, Random(0))
+        expected = simulate_schedule([item.runtime for item in reversed(queue)], processes)
+        assert simulate(simulated, processes, seed=0).makespan == pytest.approx(expected)
+
+
+def test_orders_items_as_each_does():
+    simulated = synthetic_items(20)
+    queue = order_items(simulated, LARGEST_FIRST, Random(0))
+    # Run from the end, so the largest goes first.
+    assert [item.size for item in queue] == sorted(item.size for item in simulated)
+    queue = order_items(simulated, LONGEST_FIRST, Random(0))
+    assert queue[-1].runtime == max(item.runtime for item in simulated)
+
+
+@pytest.mark.parametrize("order", [RANDOM, LARGEST_FIRST])
+def test_queues_items_in_exactly_the_order_each_does(tmpdir, order):
+    simulated = synthetic_items(20)
+    each = Each(
+        command="true",
+        work_items=[LineWorkItem(item.name, "x" * item.size) for item in simulated],
+        destination=tmpdir.join("output"),
+        order=order,
+        random=Random(0),
+    )
+    queue = order_items(simulated, order, Random(0))
+    assert [item.name for item in queue] == [item.name for item in each.work_queue]
+
+
+def test_never_retries_with_the_never_policy():
+    simulated = [SimulatedItem("a", 1, failures=1)]
+    result = simulate(simulated, processes=1, retries=3, retry_policy=NEVER)
+    assert result.failed == 1
+    assert result.makespan == 1
+
+
+def test_longest_first_avoids_a_long_tail():
+    simulated = items(*([1] * 20 + [10]))
+    random = simulate(simulated, processes=3, policy=RANDOM, seed=1)
+    longest = simulate(simulated, processes=3, policy=LONGEST_FIRST)
+    assert longest.makespan == 10
+    assert longest.makespan <= random.makespan
+    assert longest.utilisation >= random.utilisation
+
+
+def test_largest_first_beats_random_when_size_predicts_runtime():
+    simulated = synthetic_items(300, distribution=PARETO, seed=7)
+    random = simulate(simulated, processes=8, policy=RANDOM)
+    largest = simulate(simulated, processes=8, policy=LARGEST_FIRST)
+    assert largest.makespan < random.makespan
+
+
+def test_retries_failures():
+    simulated = [SimulatedItem("a", 1, failures=2), SimulatedItem("b", 1, failures=1)]
+    assert simulate(simulated, processes=2).failed == 2
+    immediate = simulate(simulated, processes=2, retries=2, retry_policy=RETRY)
+    assert immediate.failed == 0
+    assert immediate.makespan == 3
+    backoff = simulate(simulated, processes=2, retries=1, retry_delay=5, max_retry_delay=5)
+    assert backoff.failed == 1
+    # Waiting between 2.5 and 5 seconds before the retry.
+    assert 4.5 <= backoff.makespan <= 7
+    assert backoff.utilisation < 1
+
+
+@pytest.mark.parametrize("size_model", [False, True])
+def test_records_how_far_out_predictions_were(size_model):
+    simulated = synthetic_items(200, seed=1)
+    result = simulate(simulated, processes=4, size_model=size_model, prediction_interval=10, seed=1)
+    assert len(result.predictions) >= 5
+    times = [when for when, _ in result.eta_errors]
+    assert times == sorted(times)
+    assert all(
+        actual == pytest.approx(result.makespan - when) for when, _, actual in result.predictions
+    )
+    # Later predictions have more to go on.
+    late = [abs(error) for when, error in result.eta_errors if when > result.makespan / 2]
+    assert sorted(late)[len(late) // 2] < 1
+    assert result.median_eta_error >= 0
+
+
+def test_has_no_eta_error_without_predictions():
+    result = simulate(items(1, 2), processes=1)
+    assert result.predictions == []
+    assert result.median_eta_error is None
+
+
+def test_eta_errors_are_relative():
+    result = SimulationResult("random", 10, 1, 0, predictions=[(0, 15, 10), (5, 4, 5), (10, 1, 0)])
+    assert result.eta_errors == [(0, 0.5), (5, -0.2)]
+    assert result.median_eta_error == 0.2
+
+
+def test_simulates_nothing():
+    result = simulate([], processes=2)
+    assert result.makespan == 0
+    assert result.utilisation == 1
+
+
+@pytest.mark.parametrize("distribution", DISTRIBUTIONS)
+def test_makes_up_items(distribution):
+    simulated = synthetic_items(100, distribution=distribution, failure_rate=0.5)
+    assert len({item.name for item in simulated}) == 100
+    assert all(item.runtime > 0 and item.size > 0 for item in simulated)
+    assert 20 <= sum(item.failures for item in simulated) <= 80
+
+
+def test_simulates_recorded_results(tmpdir):
+    output_path = tmpdir.join("output")
+    Each(
+        command="read n; sleep 0.0$n; [ $n != 3 ]",
+        work_items=[LineWorkItem(str(i), "%d\n" % (i,)) for i in range(1, 5)],
+        destination=output_path,
+    ).clear_queue()
+
+    simulated = items_from_results(str(output_path), sizes={"1": 100})
+    assert [item.name for item in simulated] == ["1", "2", "3", "4"]
+    assert [item.size for item in simulated] == [100, 0, 0, 0]
+    assert simulated[1].runtime >= 0.02
+    result = simulate(simulated, processes=1, retries=3, retry_policy=RETRY)
+    assert result.failed == 1
+    # The failing item runs four times.
+    assert result.makespan == pytest.approx(
+        sum(item.runtime for item in simulated) + 3 * simulated[2].runtime
+    )
+
+
+def simulate_on_the_command_line(*args):
+    return subprocess.run(
+        [sys.executable, "-m", "each", "simulate"] + list(args),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+
+
+def test_compares_orders_on_the_command_line():
+    output = simulate_on_the_command_line("--items=100", "-j", "4").splitlines()
+    assert [line.split(":")[0] for line in output] == list(POLICIES)
+    assert all("median ETA error" in line for line in output)
+
+
+def test_simulates_results_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    for i in range(3):
+        input_path.join(str(i)).write("x" * i)
+    output_path = tmpdir.join("output")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "true",
+            "--destination=%s" % (output_path,),
+        ],
+        check=True,
+    )
+    output = simulate_on_the_command_line(
+        "--results=%s" % (output_path,),
+        "--source=%s" % (input_path,),
+        "--order=largest-first",
+        "--size-model",
+        "--prediction-interval=0",
+        "--jsonl",
+        "-j",
+        "1",
+    )
+    record = json.loads(output)
+    assert record["policy"] == LARGEST_FIRST
+    assert record["failed"] == 0
+    assert len(record["predictions"]) == 2
+
+
+def test_leaves_cache_hits_out_of_recorded_results(tmpdir):
+    index = tmpdir.mkdir(METADATA_DIR).join(INDEX)
+    index.write(json.dumps(["a", 0, 1.5]) + "\n" + json.dumps(["b", 0, None]) + "\n")
+    assert [item.name for item in items_from_results(str(tmpdir))] == ["a"]
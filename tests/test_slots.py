@@ -0,0 +1,70 @@
+import subprocess
+import sys
+
+from each import Each
+from each.each import METADATA_DIR, LineWorkItem
+
+# Records which slot each item ran in, and how many items that slot's
+# directory has seen, as a command using it as a cache would.
+COUNTING_COMMAND = (
+    'echo "$EACH_SLOT"; echo x >> "$EACH_SLOT_DIR/seen"; wc -l < "$EACH_SLOT_DIR/seen"'
+)
+
+
+def slots_used(output_path, names):
+    return {
+        name: [int(line) for line in output_path.join(name).join("out").read().split()]
+        for name in names
+    }
+
+
+def test_items_in_the_same_slot_share_a_directory(tmpdir):
+    output_path = tmpdir.join("output")
+    names = [str(i) for i in range(6)]
+    Each(
+        command=COUNTING_COMMAND,
+        work_items=[LineWorkItem(name, "") for name in names],
+        destination=output_path,
+        processes=2,
+    ).clear_queue()
+
+    used = slots_used(output_path, names)
+    assert {slot for slot, _ in used.values()} <= {0, 1}
+    for slot in (0, 1):
+        counts = sorted(seen for s, seen in used.values() if s == slot)
+        assert counts == list(range(1, len(counts) + 1))
+    slots = output_path.join(METADATA_DIR).join("slots")
+    assert sorted(slots.listdir()) == [slots.join("0"), slots.join("1")]
+
+
+def test_slot_directories_are_kept_between_runs(tmpdir):
+    output_path = tmpdir.join("output")
+    slot_dir = tmpdir.join("slots")
+    for name in ("a", "b"):
+        Each(
+            command=COUNTING_COMMAND,
+            work_items=[LineWorkItem(name, "")],
+            destination=output_path,
+            slot_dir=str(slot_dir),
+        ).clear_queue()
+    assert slots_used(output_path, ["a", "b"]) == {"a": [0, 1], "b": [0, 2]}
+    assert slot_dir.join("0").join("seen").read() == "x\nx\n"
+
+
+def test_sets_the_slot_directory_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("")
+    slot_dir = tmpdir.join("slots")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            'touch "$EACH_SLOT_DIR/warm"',
+            "--slot-dir=%s" % (slot_dir,),
+            "--destination=%s" % (tmpdir.join("output"),),
+        ],
+        check=True,
+    )
+    assert slot_dir.join("0").join("warm").check()
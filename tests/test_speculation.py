@@ -0,0 +1,176 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from common import gather_output, result_directories, wait_until_dead
+from each import Each
+from each.each import CHECKPOINTS_DIR, INDEX, METADATA_DIR, LineWorkItem
+
+
+def test_a_second_copy_overtakes_a_straggler(tmpdir):
+    output_path = tmpdir.mkdir("output")
+    lock = tmpdir.join("lock")
+    pid_file = tmpdir.join("pid")
+    # Only the first attempt at the slow item gets stuck, in a process that
+    # only goes away if everything the attempt started is killed.
+    command = (
+        'read line; if [ "$line" = slow ] && mkdir %s 2>/dev/null; then '
+        "sh -c 'echo $$ > %s; exec sleep 60'; fi; "
+        'echo "$line"' % (lock, pid_file)
+    )
+    each = Each(
+        command=command,
+        work_items=[LineWorkItem(str(i), "%d\n" % (i,)) for i in range(10)]
+        + [LineWorkItem("slow", "slow\n")],
+        destination=output_path,
+        processes=2,
+        wait_timeout=0.1,
+        speculate=2,
+    )
+    start = time.monotonic()
+    each.clear_queue()
+
+    assert time.monotonic() - start < 30
+    assert output_path.join("slow").join("out").read() == "slow\n"
+    assert output_path.join("slow").join("status").read() == "0\n"
+    assert not each.work_in_progress
+    assert sorted(each.free_slots) == [0, 1]
+    assert os.listdir(each.stages[0].staging_root) == []
+    wait_until_dead(pid_file)
+
+
+def test_only_one_copy_of_each_result_is_kept(tmpdir):
+    output_path = tmpdir.mkdir("output")
+    progress = []
+    each = Each(
+        command="sleep 0.05; cat",
+        work_items=[LineWorkItem(str(i), str(i)) for i in range(14)],
+        destination=output_path,
+        processes=4,
+        wait_timeout=0.1,
+        # Everything is a straggler.
+        speculate=0,
+        progress_callback=lambda: progress.append(1),
+    )
+    each.clear_queue()
+
+    assert len(progress) == 14
+    assert [p.basename for p in result_directories(output_path)] == sorted(map(str, range(14)))
+    assert sorted(gather_output(output_path)) == sorted(map(str, range(14)))
+    assert os.listdir(each.stages[0].staging_root) == []
+
+
+def test_does_not_speculate_without_enough_runtimes(tmpdir):
+    each = Each(
+        command="sleep 0.2",
+        work_items=[LineWorkItem(str(i), "") for i in range(3)],
+        destination=tmpdir,
+        processes=4,
+        speculate=0,
+    )
+    each.fill_work_in_progress()
+    assert len(each.work_in_progress) == 3
+    each.clear_queue()
+
+
+def test_speculates_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    input_path.join("hello").write("world")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "cat",
+            "--speculate=3",
+            "--destination=%s" % (tmpdir.join("output"),),
+        ],
+        check=True,
+    )
+    assert tmpdir.join("output").join("hello").join("out").read() == "world"
+
+
+def test_goes_by_the_slowest_runtimes_not_the_latest(tmpdir):
+    each = Each(
+        command="sleep 0.5",
+        work_items=[LineWorkItem("a", "")],
+        destination=tmpdir,
+        processes=2,
+        speculate=1,
+        runtimes=[50.0] * 9 + [0.1],
+    )
+    each.fill_work_in_progress()
+    time.sleep(0.2)
+    each.speculate_on_stragglers()
+    assert len(each.work_in_progress) == 1
+    each.clear_queue()
+
+
+def test_copies_have_checkpoints_of_their_own(tmpdir):
+    output_path = tmpdir.join("output")
+    log = tmpdir.join("log")
+    each = Each(
+        command='read n; echo "$n $EACH_CHECKPOINT_DIR" >> %s; sleep 0.2' % (log,),
+        work_items=[LineWorkItem(name, name + "\n") for name in ("a", "b")],
+        destination=output_path,
+        processes=4,
+        speculate=0,
+        checkpoints=True,
+        # Enough to speculate on, and everything is a straggler.
+        runtimes=[0.0] * 10,
+    )
+    each.clear_queue()
+
+    dirs = {}
+    for line in log.read().splitlines():
+        name, checkpoint_dir = line.split()
+        dirs.setdefault(name, []).append(checkpoint_dir)
+    for name in ("a", "b"):
+        assert len(set(dirs[name])) == len(dirs[name]) == 2
+    assert output_path.join(METADATA_DIR).join(CHECKPOINTS_DIR).listdir() == []
+    assert os.listdir(each.stages[0].staging_root) == []
+
+
+def test_a_failed_copy_leaves_the_other_running(tmpdir):
+    output_path = tmpdir.join("output")
+    lock = tmpdir.join("lock")
+    each = Each(
+        command="if mkdir %s; then sleep 0.5; exit 3; else sleep 1; echo ok; fi" % (lock,),
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+        processes=2,
+        wait_timeout=0.1,
+        speculate=0,
+        runtimes=[0.0] * 10,
+    )
+    each.clear_queue()
+
+    assert output_path.join("a").join("status").read() == "0\n"
+    assert output_path.join("a").join("out").read() == "ok\n"
+    assert (each.completed, each.failed) == (1, 0)
+    (record,) = output_path.join(METADATA_DIR).join(INDEX).read().splitlines()
+    assert json.loads(record)[:2] == ["a", 0]
+    assert os.listdir(each.stages[0].staging_root) == []
+
+
+def test_fails_once_every_copy_has_failed(tmpdir):
+    output_path = tmpdir.join("output")
+    lock = tmpdir.join("lock")
+    each = Each(
+        command="if mkdir %s; then exit 3; else sleep 0.5; exit 4; fi" % (lock,),
+        work_items=[LineWorkItem("a", "")],
+        destination=output_path,
+        processes=2,
+        wait_timeout=0.1,
+        speculate=0,
+        runtimes=[0.0] * 10,
+    )
+    each.clear_queue()
+
+    assert output_path.join("a").join("status").read() == "4\n"
+    assert (each.completed, each.failed) == (1, 1)
+    assert sorted(each.free_slots) == [0, 1]
+    assert os.listdir(each.stages[0].staging_root) == []
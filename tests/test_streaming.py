@@ -0,0 +1,125 @@
+import io
+import subprocess
+import sys
+
+import pytest
+
+from common import gather_output, result_directories, wait_for
+from each import Each
+from each.each import LineWorkItem, work_items_from_stream
+from each.streaming import StreamingWorkSource
+
+
+def test_runs_items_before_the_stream_ends(tmpdir):
+    output_path = tmpdir.mkdir("output")
+
+    def items():
+        for i in range(3):
+            yield LineWorkItem(str(i), "hello %d\n" % (i,))
+            # If each waited for the whole stream before starting, we'd never
+            # see this result.
+            wait_for(lambda: output_path.join(str(i)).join("status").check())
+
+    each = Each(
+        command="cat", work_items=items(), destination=output_path, streaming=True, processes=2
+    )
+    each.clear_queue()
+
+    assert sorted(gather_output(output_path)) == ["hello %d" % (i,) for i in range(3)]
+
+
+def test_stops_reading_when_the_buffer_is_full(tmpdir):
+    completed = 0
+
+    def progress():
+        nonlocal completed
+        completed += 1
+
+    buffer_size = 2
+    processes = 2
+
+    def items():
+        for i in range(20):
+            # One item in the buffer put, and one more in our hands here.
+            assert i - completed <= buffer_size + processes + 2
+            yield LineWorkItem(str(i), "")
+
+    each = Each(
+        command="sleep 0.01",
+        work_items=items(),
+        destination=tmpdir.mkdir("output"),
+        streaming=True,
+        processes=processes,
+        buffer_size=buffer_size,
+        progress_callback=progress,
+    )
+    each.clear_queue()
+
+    assert completed == 20
+
+
+def test_errors_reading_the_stream_are_raised(tmpdir):
+    def items():
+        yield LineWorkItem("hello", "")
+        raise ValueError()
+
+    each = Each(
+        command="true", work_items=items(), destination=tmpdir.mkdir("output"), streaming=True
+    )
+    with pytest.raises(ValueError):
+        each.clear_queue()
+
+
+def test_only_remembers_recent_lines_to_skip():
+    lines = io.StringIO("a\nb\na\nc\na\nb\n")
+    names = [item.line for item in work_items_from_stream(lines, window=2)]
+    # Seeing "a" again keeps it among the two most recent, but "b" has been
+    # forgotten by the time it's repeated.
+    assert names == ["a\n", "b\n", "c\n", "b\n"]
+
+
+def test_skips_completed_and_duplicate_lines(tmpdir):
+    output_path = tmpdir.mkdir("output")
+    lines = io.StringIO("a\nb\na\n")
+    [a, b] = list(work_items_from_stream(lines))
+    output_path.mkdir(a.name).join("status").write("0\n")
+
+    progress = []
+    each = Each(
+        command="cat",
+        work_items=iter([a, b, a]),
+        destination=output_path,
+        streaming=True,
+        progress_callback=lambda: progress.append(1),
+    )
+    each.clear_queue()
+
+    assert [p.basename for p in result_directories(output_path)] == sorted([a.name, b.name])
+    assert not output_path.join(a.name).join("out").check()
+    assert output_path.join(b.name).join("out").read() == "b\n"
+    assert len(progress) == 3
+
+
+def test_an_exhausted_source_stays_exhausted():
+    source = StreamingWorkSource(iter([]))
+    assert source.get(timeout=1) is None
+    assert source.exhausted
+    assert source.get(timeout=1) is None
+
+
+def test_reads_from_stdin_on_the_command_line(tmpdir):
+    output_path = tmpdir.join("output")
+    subprocess.run(
+        [sys.executable, "-m", "each", "-", "cat", "--destination=%s" % (output_path,)],
+        input=b"hello\nworld\n",
+        check=True,
+    )
+    assert sorted(gather_output(output_path)) == ["hello", "world"]
+
+
+def test_requires_a_destination_for_stdin():
+    process = subprocess.run(
+        [sys.executable, "-m", "each", "-", "cat"], input=b"", stderr=subprocess.PIPE
+    )
+    assert process.returncode != 0
+    assert b"--destination" in process.stderr
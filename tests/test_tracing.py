@@ -0,0 +1,81 @@
+import json
+
+from each import Each
+from each.each import LineWorkItem
+from each.tracing import SCHEDULER_TRACK, NullTracer, Tracer, slot_track
+
+
+def test_traces_each_task_on_a_slot(tmpdir):
+    trace_file = tmpdir.join("trace.json")
+    tracer = Tracer(str(trace_file))
+
+    each = Each(
+        command="cat",
+        work_items=[LineWorkItem(str(i), "hello %d\n" % (i,)) for i in range(6)],
+        destination=tmpdir.mkdir("output"),
+        processes=2,
+        tracer=tracer,
+    )
+    each.clear_queue()
+    tracer.close()
+
+    events = json.loads(trace_file.read())
+
+    runs = [e for e in events if e["name"] == "run"]
+    assert sorted(e["args"]["item"] for e in runs) == [str(i) for i in range(6)]
+    assert {e["tid"] for e in runs} <= {slot_track(0), slot_track(1)}
+    assert all(e["dur"] >= 0 for e in events if e["ph"] == "X")
+
+    for name in ["prepare", "fork", "write status"]:
+        assert len([e for e in events if e["name"] == name]) == 6
+
+    scheduler_spans = {e["name"] for e in events if e["tid"] == SCHEDULER_TRACK}
+    assert {
+        "fill_work_in_progress",
+        "update_predicted_timing",
+        "collect_completed_work",
+        "progress_callback",
+    } <= scheduler_spans
+
+    track_names = {e["tid"]: e["args"]["name"] for e in events if e["ph"] == "M"}
+    assert track_names[SCHEDULER_TRACK] == "scheduler"
+    assert track_names[slot_track(0)] == "slot 0"
+
+
+def test_writes_events_as_they_happen(tmpdir):
+    trace_file = tmpdir.join("trace.json")
+    tracer = Tracer(str(trace_file))
+    with tracer.span("first"):
+        pass
+    tracer.counter("tasks", queued=1)
+    tracer.file.flush()
+
+    # Viewers accept a trace that was never closed.
+    events = json.loads(trace_file.read() + "]")
+    assert [e["name"] for e in events] == ["thread_name", "first", "tasks"]
+    tracer.close()
+    assert json.loads(trace_file.read()) == events
+
+
+def test_slots_are_reused(tmpdir):
+    each = Each(
+        command="true",
+        work_items=[LineWorkItem(str(i), "") for i in range(5)],
+        destination=tmpdir.mkdir("output"),
+        processes=1,
+    )
+    slots = []
+    while each.work_queue:
+        each.fill_work_in_progress()
+        slots.extend(w.slot for w in each.work_in_progress.values())
+        each.collect_completed_work()
+    assert slots == [0] * 5
+    assert each.free_slots == [0]
+
+
+def test_null_tracer_records_nothing(tmpdir):
+    tracer = NullTracer()
+    with tracer.span("anything"):
+        tracer.counter("tasks", queued=1)
+    tracer.close()
+    assert tmpdir.listdir() == []
@@ -0,0 +1,162 @@
+import ctypes
+import errno
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from common import wait_for
+from each import Each, watch
+from each.watch import (
+    IN_Q_OVERFLOW,
+    INOTIFY_EVENT,
+    RESCAN,
+    InotifyWatcher,
+    PollingWatcher,
+    watcher_for,
+    work_items_from_watched_directory,
+)
+
+
+def statuses(output_path):
+    return sorted(
+        name for name in os.listdir(str(output_path)) if output_path.join(name, "status").check()
+    )
+
+
+@pytest.mark.parametrize("watcher", [InotifyWatcher, PollingWatcher])
+def test_processes_files_as_they_arrive(tmpdir, watcher):
+    input_path = tmpdir.mkdir("input")
+    output_path = tmpdir.mkdir("output")
+    input_path.join("a").write("a")
+    output_path.mkdir("done").join("status").write("0")
+    input_path.join("done").write("done")
+
+    def write_more():
+        wait_for(lambda: "a" in statuses(output_path))
+        input_path.join("b").write("b")
+        # Renamed into place, as a careful producer would.
+        input_path.join(".c.tmp").write("c")
+        input_path.join(".c.tmp").rename(input_path.join("c"))
+
+    writer = threading.Thread(target=write_more)
+    writer.start()
+
+    each = Each(
+        command="cat",
+        work_items=work_items_from_watched_directory(
+            str(input_path),
+            stop=lambda: len(statuses(output_path)) >= 4,
+            poll_interval=0.05,
+            watcher=watcher(str(input_path)),
+        ),
+        destination=output_path,
+        streaming=True,
+        processes=2,
+    )
+    each.clear_queue()
+    writer.join()
+
+    assert statuses(output_path) == ["a", "b", "c", "done"]
+    assert not output_path.join("done").join("out").check()
+    assert output_path.join("c").join("out").read() == "c"
+
+
+def test_inotify_watcher_reports_closed_files(tmpdir):
+    watcher = InotifyWatcher(str(tmpdir))
+    try:
+        assert watcher.changes(0) == []
+        tmpdir.join("hello").write("")
+        assert watcher.changes(1) == ["hello"]
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_reports_overflows(tmpdir):
+    watcher = InotifyWatcher(str(tmpdir))
+    # Standing in for the inotify queue, which is hard to overflow for real.
+    os.close(watcher.fd)
+    watcher.fd, w = os.pipe()
+    try:
+        os.write(w, INOTIFY_EVENT.pack(-1, IN_Q_OVERFLOW, 0, 0))
+        assert watcher.changes(1) is RESCAN
+    finally:
+        os.close(w)
+        watcher.close()
+
+
+def test_rescans_on_overflow(tmpdir, monkeypatch):
+    class Overflowing(PollingWatcher):
+        def changes(self, timeout):
+            return RESCAN
+
+    tmpdir.join("a").write("")
+    items = work_items_from_watched_directory(str(tmpdir), watcher=Overflowing(str(tmpdir)))
+    assert next(items).name == "a"
+    tmpdir.join("b").write("")
+    assert next(items).name == "b"
+    tmpdir.mkdir("c")
+    tmpdir.join("d").write("")
+    assert next(items).name == "d"
+    items.close()
+
+
+def test_cannot_watch_a_missing_directory(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        watcher_for(str(tmpdir.join("missing")))
+
+
+@pytest.mark.parametrize("error", [AttributeError(), OSError(errno.ENOSPC, "")])
+def test_falls_back_to_polling(tmpdir, monkeypatch, error):
+    def fail(self, path):
+        raise error
+
+    monkeypatch.setattr(InotifyWatcher, "__init__", fail)
+    assert isinstance(watcher_for(str(tmpdir)), PollingWatcher)
+
+
+def test_falls_back_to_polling_when_inotify_runs_out(tmpdir, monkeypatch):
+    class Libc(object):
+        def __init__(self, name, use_errno):
+            pass
+
+        def inotify_init1(self, flags):
+            ctypes.set_errno(errno.EMFILE)
+            return -1
+
+    monkeypatch.setattr(watch.ctypes, "CDLL", Libc)
+    assert isinstance(watcher_for(str(tmpdir)), PollingWatcher)
+
+
+def test_chooses_a_watcher_itself(tmpdir):
+    tmpdir.join("a").write("")
+    items = work_items_from_watched_directory(str(tmpdir), stop=lambda: True)
+    assert [item.name for item in items] == ["a"]
+
+
+def test_watch_on_the_command_line(tmpdir):
+    input_path = tmpdir.mkdir("input")
+    output_path = tmpdir.join("output")
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "each",
+            str(input_path),
+            "cat",
+            "--watch",
+            "--destination=%s" % (output_path,),
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(output_path.check)
+        input_path.join("hello").write("world")
+        wait_for(lambda: output_path.join("hello").join("status").check())
+        assert output_path.join("hello").join("out").read() == "world"
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait()